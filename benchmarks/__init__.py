@@ -0,0 +1,6 @@
+"""
+Benchmarks of the tree operations of every backend, on generated trees of
+different shapes and sizes. Run ``python -m benchmarks --help`` for the
+options.
+"""
+from .runner import run
@@ -0,0 +1,54 @@
+import argparse
+import json
+import sys
+
+from mongoengine import connect, disconnect
+
+from .models import BACKENDS
+from .runner import run
+from .shapes import SHAPES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Times the tree operations of the mongotree backends. '
+                    'Every result is written as a JSON line.')
+    parser.add_argument('--host', default='mongomock://localhost',
+                        help='MongoDB URI, e.g. mongodb://localhost:27017 '
+                             '(default: %(default)s)')
+    parser.add_argument('--db', default='mongotree_benchmarks',
+                        help='database to use, its benchmark collections '
+                             'are dropped (default: %(default)s)')
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help='backend to run, can be repeated (default: all)')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help='tree shape, can be repeated (default: all)')
+    parser.add_argument('--size', action='append', type=int,
+                        help='number of nodes, can be repeated '
+                             '(default: 1000)')
+    parser.add_argument('--ops', type=int, default=10,
+                        help='repetitions of the single node operations '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random shapes and node samples '
+                             '(default: %(default)s)')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='file for the JSON lines (default: stdout)')
+    args = parser.parse_args(argv)
+
+    connect(args.db, host=args.host)
+    try:
+        for backend in args.backend or sorted(BACKENDS):
+            for shape in args.shape or sorted(SHAPES):
+                for size in args.size or [1000]:
+                    for result in run(backend, shape, size, args.ops, args.seed):
+                        args.output.write(json.dumps(result) + '\n')
+                        args.output.flush()
+    finally:
+        disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import mongoengine as models
+from mongotree.tree import (
+    adjacency_list_tree,
+    closure_table_tree,
+    materialized_path_tree,
+    nested_set_tree,
+)
+
+class NS_BenchNode(nested_set_tree):
+    desc = models.StringField()
+
+class NS_BenchNodeGapped(nested_set_tree):
+    nested_set_gap = 8
+    desc = models.StringField()
+
+class MP_BenchNode(materialized_path_tree):
+    desc = models.StringField()
+
+class AL_BenchNode(adjacency_list_tree):
+    desc = models.StringField()
+
+class CT_BenchNode(closure_table_tree):
+    desc = models.StringField()
+
+BACKENDS = {
+    'nested_set': NS_BenchNode,
+    'nested_set_gapped': NS_BenchNodeGapped,
+    'materialized_path': MP_BenchNode,
+    'adjacency_list': AL_BenchNode,
+    'closure_table': CT_BenchNode,
+}
@@ -0,0 +1,107 @@
+import random
+import time
+
+from .models import BACKENDS
+from .shapes import SHAPES
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _get_edge_leaf(model, left):
+    """:returns: the first (``left``) or last leaf of the forest"""
+    if left:
+        node = model.get_first_root_node()
+        get_child = 'get_first_child'
+    else:
+        node = model.get_last_root_node()
+        get_child = 'get_last_child'
+    while node is not None:
+        child = getattr(node, get_child)()
+        if child is None:
+            return node
+        node = child
+
+
+def _get_first_branch(model):
+    """:returns: the first child of the first root with children"""
+    for root in model.get_root_nodes():
+        child = root.get_first_child()
+        if child is not None:
+            return child
+
+
+def run(backend, shape, size, ops=10, seed=None):
+    """
+    Builds a ``shape`` tree of ``size`` nodes with the ``backend`` model and
+    times the tree operations on it. The collections of the model are
+    dropped before and after the run.
+
+    :param ops: how many times the single node operations are repeated
+        (each one on a fresh node)
+    :returns: A generator of result dicts, one per operation, with the
+        total ``seconds`` taken by its ``count`` calls.
+    """
+    model = BACKENDS[backend]
+    rnd = random.Random(seed)
+    data = SHAPES[shape](size, seed)
+
+    def result(operation, seconds, count=1):
+        return {
+            'backend': backend,
+            'shape': shape,
+            'size': size,
+            'operation': operation,
+            'count': count,
+            'seconds': seconds,
+            'per_call': seconds / count if count else None,
+        }
+
+    model.drop_collection()
+    try:
+        yield result('load_bulk', _timed(model.load_bulk, data))
+        yield result('dump_bulk', _timed(model.dump_bulk))
+
+        pks = list(model.objects.scalar('id'))
+        nodes = [model.objects.get(pk=pk)
+                 for pk in rnd.sample(pks, min(ops, len(pks)))]
+        del pks
+        for operation in ('get_descendants', 'get_ancestors'):
+            # some backends return lists, so the call itself is timed too
+            yield result(operation, sum(
+                _timed(lambda: list(getattr(node, operation)()))
+                for node in nodes), len(nodes))
+        yield result('get_descendants_group_count',
+                     _timed(model.get_descendants_group_count))
+
+        for operation, left in (('add_child_left', True),
+                                ('add_child_right', False)):
+            seconds = 0
+            for i in range(ops):
+                node = _get_edge_leaf(model, left)
+                seconds += _timed(node.add_child, desc='new')
+            yield result(operation, seconds, ops)
+
+        seconds = count = 0
+        for i in range(ops):
+            branch = _get_first_branch(model)
+            if branch is None:
+                break
+            target = model.get_last_root_node()
+            seconds += _timed(branch.move, target, 'last-child')
+            count += 1
+        yield result('move', seconds, count)
+
+        seconds = count = 0
+        for i in range(ops):
+            branch = _get_first_branch(model)
+            if branch is None:
+                break
+            seconds += _timed(branch.delete)
+            count += 1
+        yield result('delete', seconds, count)
+    finally:
+        model.drop_collection()
@@ -0,0 +1,56 @@
+"""
+Generators of :meth:`load_bulk` structures with a given number of nodes.
+
+Every node gets a ``desc`` with its position in the generation order, and
+the structures are built without recursion so the deep ones don't hit the
+interpreter limits.
+"""
+import math
+import random
+
+
+def _build(parents):
+    """
+    :param parents: the index of the parent of every node (``None`` for the
+        roots), every parent listed before its children
+    :returns: the nested ``load_bulk`` structure
+    """
+    nodes = []
+    roots = []
+    for i, parent in enumerate(parents):
+        node = {'data': {'desc': str(i)}}
+        nodes.append(node)
+        if parent is None:
+            roots.append(node)
+        else:
+            nodes[parent].setdefault('children', []).append(node)
+    return roots
+
+
+def wide(size, seed=None, fanout=100):
+    """Every node has ``fanout`` children, filled level by level from a
+    single root."""
+    return _build([None] + [(i - 1) // fanout for i in range(1, size)])
+
+
+def deep(size, seed=None):
+    """About ``sqrt(size)`` roots, each one the start of a chain of about
+    ``sqrt(size)`` nodes."""
+    length = max(1, int(math.sqrt(size)))
+    return _build([None if i % length == 0 else i - 1 for i in range(size)])
+
+
+def random_tree(size, seed=None, roots=0.01):
+    """Every node picks its parent uniformly among the previous nodes, or
+    starts a new tree with a ``roots`` probability."""
+    rnd = random.Random(seed)
+    return _build([
+        None if i == 0 or rnd.random() < roots else rnd.randrange(i)
+        for i in range(size)])
+
+
+SHAPES = {
+    'wide': wide,
+    'deep': deep,
+    'random': random_tree,
+}
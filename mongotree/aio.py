@@ -0,0 +1,538 @@
+"""
+Asyncio counterpart of :class:`~mongotree.tree.nested_set_tree`, running the
+same nested set logic on an async driver with the API of motor
+(``pip install motor``, an optional dependency)::
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from mongotree.aio import nested_set_aio
+
+    tree = nested_set_aio(Category, AsyncIOMotorClient().shop)
+    root = await tree.add_root(name='Books')
+    await tree.add_child(root, name='Poetry')
+    async for node in tree.get_tree(root):
+        ...
+
+The nodes are instances of the model, so they can still be used with its
+synchronous methods. The writes keep the numbering (dense or with
+:attr:`~mongotree.tree.nested_set_tree.nested_set_gap`), ``numchild`` and
+the version counters like the synchronous ones, but can't claim the trees
+or run in transactions.
+
+The writes of a :class:`nested_set_aio` run one at a time, and refresh the
+nodes they get once their turn comes, so the tasks of an event loop can
+share it. Nothing serializes them with the writes of other processes (or of
+other instances): only one of them may write to a tree at a time.
+"""
+import asyncio
+from functools import wraps
+
+from pymongo import UpdateMany
+
+from mongotree.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
+from mongotree.models import get_result_class
+
+_current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+def _serialized(get_nodes=None):
+    """
+    Runs a write of :class:`nested_set_aio` holding its write lock, unless
+    the task already holds it (a write made of other writes).
+
+    :param get_nodes: Gets the arguments of the method and returns the nodes
+        to refresh once the lock is held.
+    """
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            task = _current_task()
+            if self._writer is task:
+                return await method(self, *args, **kwargs)
+            if self._write_lock is None:
+                # created in the event loop that runs the writes
+                self._write_lock = asyncio.Lock()
+            async with self._write_lock:
+                self._writer = task
+                try:
+                    if get_nodes:
+                        for node in get_nodes(*args, **kwargs):
+                            await self._refresh(node)
+                    return await method(self, *args, **kwargs)
+                finally:
+                    self._writer = None
+        return wrapper
+    return decorator
+
+
+class nested_set_aio(object):
+    """
+    Async tree methods of a nested set ``model``, on the ``database`` of an
+    async driver (an ``AsyncIOMotorDatabase``, or any object with its API).
+    """
+
+    def __init__(self, model, database):
+        self.model = get_result_class(model)
+        if self.model.nested_set_optimistic or \
+                self.model.nested_set_transactions:
+            raise ValueError(
+                'The async writes of {} can\'t claim the trees or run in '
+                'transactions'.format(self.model.__name__))
+        self.collection = database[self.model._get_collection_name()]
+        self.versions = database[self.collection.name + '_versions']
+        self._write_lock = None
+        self._writer = None
+
+    def _query(self, **query):
+        """:returns: ``query`` restricted to the documents of the model"""
+        if self.model._meta.get('allow_inheritance') is True:
+            subclasses = self.model._subclasses
+            if len(subclasses) == 1:
+                query['_cls'] = subclasses[0]
+            else:
+                query['_cls'] = {'$in': list(subclasses)}
+        return query
+
+    def _get_parent_query(self, tree_id, lft, rgt, depth):
+        return self._query(tree_id=tree_id, depth=depth - 1,
+                           lft={'$lt': lft}, rgt={'$gt': rgt})
+
+    def _from_son(self, son):
+        return self.model._from_son(son)
+
+    async def _refresh(self, node):
+        """Reloads the structural fields of ``node``, if it still exists."""
+        fields = self.model._get_structure_fields()
+        son = await self.collection.find_one(
+            {'_id': node.pk}, dict((field, 1) for field in fields[1:]))
+        if son is not None:
+            for field in fields[1:]:
+                setattr(node, field, son.get(field))
+
+    async def _find(self, query, sort=(('tree_id', 1), ('lft', 1))):
+        async for son in self.collection.find(query).sort(list(sort)):
+            yield self._from_son(son)
+
+    async def _find_one(self, query, sort=None):
+        son = await self.collection.find_one(
+            query, sort=list(sort) if sort else None)
+        return None if son is None else self._from_son(son)
+
+    async def _insert(self, newobjs):
+        for newobj in newobjs:
+            newobj.validate()
+        result = await self.collection.insert_many(
+            [newobj.to_mongo() for newobj in newobjs])
+        for newobj, pk in zip(newobjs, result.inserted_ids):
+            newobj.pk = pk
+            newobj._created = False
+            newobj._clear_changed_fields()
+        return newobjs
+
+    def _new_node(self, kwargs):
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
+            return newobj
+        return self.model(**kwargs)
+
+    async def _bump_versions(self, tree_ids=None, from_tree_id=None):
+        if self.model._has_versions():
+            await self.versions.update_many(
+                self.model._get_versions_query(tree_ids, from_tree_id),
+                {'$inc': {'version': 1}})
+
+    # reads
+
+    def get_tree(self, parent=None):
+        """Async iterator of the nodes of the tree (or of the branch of
+        ``parent``) in preorder."""
+        if parent is None:
+            return self._find(self._query())
+        return self._find(self._query(
+            tree_id=parent.tree_id,
+            lft={'$gte': parent.lft, '$lte': parent.rgt - 1}))
+
+    def get_descendants(self, node):
+        return self._find(self._query(
+            tree_id=node.tree_id, lft={'$gt': node.lft, '$lt': node.rgt}))
+
+    def get_children(self, node):
+        return self._find(self._query(
+            tree_id=node.tree_id, lft={'$gt': node.lft, '$lt': node.rgt},
+            depth=node.depth + 1))
+
+    def get_ancestors(self, node):
+        return self._find(self._query(
+            tree_id=node.tree_id, lft={'$lt': node.lft},
+            rgt={'$gt': node.rgt}))
+
+    def get_root_nodes(self):
+        return self._find(self._query(lft=1))
+
+    async def get_parent(self, node):
+        if node.lft == 1:
+            return None
+        return await self._find_one(self._get_parent_query(
+            node.tree_id, node.lft, node.rgt, node.depth))
+
+    async def get_first_root_node(self):
+        return await self._find_one(self._query(lft=1), [('tree_id', 1)])
+
+    async def get_last_root_node(self):
+        return await self._find_one(self._query(lft=1), [('tree_id', -1)])
+
+    async def get_last_child(self, node):
+        return await self._find_one(self._query(
+            tree_id=node.tree_id, rgt={'$gt': node.lft, '$lt': node.rgt}),
+            [('rgt', -1)])
+
+    async def is_leaf(self, node):
+        if self.model.nested_set_numchild:
+            return not node.numchild
+        if self.model.nested_set_gap > 1:
+            return await self.collection.find_one(self._query(
+                tree_id=node.tree_id, lft={'$gt': node.lft, '$lt': node.rgt}
+            )) is None
+        return node.rgt - node.lft == 1
+
+    async def get_siblings(self, node):
+        """:returns: the list of the siblings of ``node`` (itself included)"""
+        if node.lft == 1:
+            return [o async for o in self.get_root_nodes()]
+        parent = await self.get_parent(node)
+        return [o async for o in self.get_children(parent)]
+
+    # writes
+
+    async def _open_gap(self, tree_id, pos, width):
+        """Async :meth:`~mongotree.tree.nested_set_tree._open_gap`."""
+        model = self.model
+        if model.nested_set_gap == 1:
+            await self._move_right(tree_id, pos, width)
+            return pos, pos + width - 1
+
+        prev = 0
+        for field in ('lft', 'rgt'):
+            node = await self.collection.find_one(
+                self._query(tree_id=tree_id, **{field: {'$lt': pos}}),
+                sort=[(field, -1)])
+            if node is not None:
+                prev = max(prev, node[field])
+        room = pos - prev - 1
+        if room < width:
+            shift = width - room + model.nested_set_gap
+            await self._move_right(tree_id, pos, shift)
+            room += shift
+        return prev + 1, prev + room
+
+    async def _move_right(self, tree_id, pos, incdec):
+        await self.collection.bulk_write(self.model._get_range_requests(
+            self._query(tree_id=tree_id, rgt={'$gte': pos}),
+            self._query(tree_id=tree_id, rgt={'$gte': pos}, lft={'$gte': pos}),
+            self._query(tree_id=tree_id, lft={'$lt': 0}),
+            incdec))
+
+    async def _close_gap(self, drop_lft, drop_rgt, tree_id):
+        if self.model.nested_set_gap > 1:
+            return
+        await self.collection.bulk_write(self.model._get_range_requests(
+            self._query(tree_id=tree_id, rgt={'$gt': drop_lft}),
+            self._query(tree_id=tree_id, lft={'$gt': drop_lft}),
+            self._query(tree_id=tree_id, lft={'$lt': 0}),
+            drop_lft - drop_rgt - 1))
+
+    async def _move_tree_right(self, tree_id, count=1):
+        model = self.model
+        if model.nested_set_unique_lft:
+            await self.collection.bulk_write([
+                UpdateMany(self._query(tree_id={'$gte': tree_id}),
+                           {'$inc': {'tree_id': -model._parking_offset}}),
+                UpdateMany(self._query(tree_id={'$lt': 0}),
+                           {'$inc': {'tree_id': model._parking_offset + count}}),
+            ])
+        else:
+            await self.collection.update_many(
+                self._query(tree_id={'$gte': tree_id}),
+                {'$inc': {'tree_id': count}})
+        await self._bump_versions(from_tree_id=tree_id)
+
+    async def _open_tree_gap(self, before=None):
+        """Async :meth:`~mongotree.tree.nested_set_tree._open_tree_gap`
+        of a single tree.
+
+        :returns: the id of the new tree
+        """
+        gap = self.model.nested_set_tree_gap
+        if before is None:
+            last = await self._find_one(self._query(), [('tree_id', -1)])
+            return (last.tree_id if last else 0) + gap
+        if gap == 1:
+            await self._move_tree_right(before)
+            return before
+
+        prev = await self._find_one(self._query(tree_id={'$lt': before}),
+                                    [('tree_id', -1)])
+        prev = prev.tree_id if prev else 0
+        room = before - prev - 1
+        if room < 1:
+            shift = 1 - room + gap
+            await self._move_tree_right(before, shift)
+            room += shift
+        return self.model._spread_tree_ids(prev, room, 1)[0]
+
+    async def _inc_parent_numchild(self, tree_id, lft, rgt, depth, inc):
+        if self.model.nested_set_numchild and depth > 1:
+            await self.collection.update_one(
+                self._get_parent_query(tree_id, lft, rgt, depth),
+                {'$inc': {'numchild': inc}})
+
+    def _get_sorted_target(self, siblings, newobj):
+        """:returns: the first of the ``siblings`` that goes after
+        ``newobj`` in :attr:`node_order_by` order, or ``None``"""
+        key = lambda node: [getattr(node, field)
+                            for field in self.model.node_order_by]
+        for sibling in siblings:
+            if key(sibling) > key(newobj):
+                return sibling
+
+    async def _resolve_sibling_pos(self, target, pos, node):
+        """
+        Turns the ``sorted-sibling``, ``left`` and ``right`` positions into
+        ``first-sibling``, ``left`` (of the returned target) or
+        ``last-sibling``, like the synchronous methods.
+
+        :returns: ``(target, pos)``
+        """
+        if pos == 'sorted-sibling':
+            sibling = self._get_sorted_target(
+                await self.get_siblings(target), node)
+            if sibling is None:
+                return target, 'last-sibling'
+            target, pos = sibling, 'left'
+        if pos in ('left', 'right', 'first-sibling'):
+            siblings = await self.get_siblings(target)
+            pks = [sibling.pk for sibling in siblings]
+            i = pks.index(target.pk)
+            if pos == 'right':
+                if i == len(siblings) - 1:
+                    return target, 'last-sibling'
+                target, pos, i = siblings[i + 1], 'left', i + 1
+            if pos == 'left' and i == 0:
+                pos = 'first-sibling'
+            if pos == 'first-sibling':
+                target = siblings[0]
+        return target, pos
+
+    @_serialized()
+    async def add_root(self, **kwargs):
+        last_root = await self.get_last_root_node()
+        if last_root and self.model.node_order_by:
+            return await self.add_sibling(last_root, 'sorted-sibling', **kwargs)
+        newobj = self._new_node(kwargs)
+        newobj.depth = 1
+        newobj.tree_id = await self._open_tree_gap()
+        newobj.lft = 1
+        newobj.rgt = 1 + self.model.nested_set_gap
+        if self.model.nested_set_numchild:
+            newobj.numchild = 0
+        await self._insert([newobj])
+        await self._bump_versions([newobj.tree_id])
+        return newobj
+
+    @_serialized(lambda node, **kwargs: [node])
+    async def add_child(self, node, **kwargs):
+        if not await self.is_leaf(node):
+            pos = 'sorted-sibling' if self.model.node_order_by else 'last-sibling'
+            return await self.add_sibling(await self.get_last_child(node), pos,
+                                          **kwargs)
+        newobj = self._new_node(kwargs)
+        first, last = await self._open_gap(node.tree_id, node.rgt, 2)
+        node.rgt = last + 1
+        newobj.tree_id = node.tree_id
+        newobj.depth = node.depth + 1
+        newobj.lft, newobj.rgt = self.model._get_leaf_bounds(first, last)
+        if self.model.nested_set_numchild:
+            newobj.numchild = 0
+        await self._insert([newobj])
+        if self.model.nested_set_numchild:
+            await self.collection.update_one({'_id': node.pk},
+                                             {'$inc': {'numchild': 1}})
+            node.numchild = (node.numchild or 0) + 1
+        await self._bump_versions([node.tree_id])
+        return newobj
+
+    @_serialized(lambda node, *args, **kwargs: [node])
+    async def add_sibling(self, node, pos=None, **kwargs):
+        pos = node._prepare_pos_var_for_add_sibling(pos)
+        newobj = self._new_node(kwargs)
+        newobj.depth = node.depth
+        target, pos = await self._resolve_sibling_pos(node, pos, newobj)
+
+        if target.lft == 1:
+            newobj.lft = 1
+            newobj.rgt = 1 + self.model.nested_set_gap
+            # first-sibling and left go before the tree of target
+            newobj.tree_id = await self._open_tree_gap(
+                None if pos == 'last-sibling' else target.tree_id)
+        else:
+            newobj.tree_id = target.tree_id
+            if pos == 'last-sibling':
+                parent = await self.get_parent(target)
+                newpos = parent.rgt
+            else:
+                newpos = target.lft
+            first, last = await self._open_gap(target.tree_id, newpos, 2)
+            newobj.lft, newobj.rgt = self.model._get_leaf_bounds(first, last)
+
+        if self.model.nested_set_numchild:
+            newobj.numchild = 0
+        await self._insert([newobj])
+        await self._inc_parent_numchild(newobj.tree_id, newobj.lft, newobj.rgt,
+                                        newobj.depth, 1)
+        await self._bump_versions([newobj.tree_id])
+        return newobj
+
+    @_serialized(lambda node, target, *args, **kwargs: [node, target])
+    async def move(self, node, target, pos=None):
+        pos = node._prepare_pos_var_for_move(pos)
+        model = self.model
+        parent = None
+
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            if await self.is_leaf(target):
+                parent = target
+                pos = 'last-child'
+            else:
+                target = await self.get_last_child(target)
+                pos = {
+                    'first-child': 'first-sibling',
+                    'last-child': 'last-sibling',
+                    'sorted-child': 'sorted-sibling'
+                }[pos]
+
+        if target.is_descendant_of(node):
+            raise InvalidMoveToDescendant("Can't move node to a descendant.")
+
+        if target.pk == node.pk and pos != 'last-child':
+            if pos == 'left':
+                return
+            if pos in ('right', 'last-sibling', 'first-sibling'):
+                siblings = await self.get_siblings(node)
+                edge = siblings[0] if pos == 'first-sibling' else siblings[-1]
+                if edge.pk == node.pk:
+                    # not actually moving the node
+                    return
+        if pos != 'last-child':
+            target, pos = await self._resolve_sibling_pos(target, pos, node)
+
+        gap = node.rgt - node.lft + 1
+        target_tree = target.tree_id
+        if pos == 'last-child':
+            first, last = await self._open_gap(target.tree_id, parent.rgt, gap)
+            newpos = model._get_range_start(first, last, gap)
+        elif target.lft == 1:
+            newpos = 1
+            # first-sibling and left go before the tree of target
+            target_tree = await self._open_tree_gap(
+                None if pos == 'last-sibling' else target.tree_id)
+        else:
+            if pos == 'last-sibling':
+                newpos = (await self.get_parent(target)).rgt
+            else:
+                newpos = target.lft
+            first, last = await self._open_gap(target.tree_id, newpos, gap)
+            newpos = model._get_range_start(first, last, gap)
+
+        # the node is reloaded because its numbers may have changed
+        fromobj = await self.collection.find_one({'_id': node.pk})
+        depthdiff = target.depth - fromobj['depth']
+        if parent:
+            depthdiff += 1
+
+        await self._inc_parent_numchild(fromobj['tree_id'], fromobj['lft'],
+                                        fromobj['rgt'], fromobj['depth'], -1)
+        shift = newpos - fromobj['lft']
+        await self.collection.update_many(
+            self._query(tree_id=fromobj['tree_id'],
+                        lft={'$gte': fromobj['lft'], '$lte': fromobj['rgt']}),
+            {'$set': {'tree_id': target_tree},
+             '$inc': {'depth': depthdiff, 'lft': shift, 'rgt': shift}})
+        await self._inc_parent_numchild(target_tree, newpos,
+                                        newpos + fromobj['rgt'] - fromobj['lft'],
+                                        fromobj['depth'] + depthdiff, 1)
+        await self._close_gap(fromobj['lft'], fromobj['rgt'], fromobj['tree_id'])
+        await self._bump_versions([fromobj['tree_id'], target_tree])
+
+    @_serialized()
+    async def delete(self, node):
+        """Deletes ``node`` and its descendants."""
+        son = await self.collection.find_one({'_id': node.pk})
+        if son is None:
+            return
+        tree_id, lft, rgt = son['tree_id'], son['lft'], son['rgt']
+        await self._inc_parent_numchild(tree_id, lft, rgt, son['depth'], -1)
+        await self.collection.delete_many(self._query(
+            tree_id=tree_id, lft={'$gte': lft, '$lte': rgt}))
+        await self._close_gap(lft, rgt, tree_id)
+        await self._bump_versions([tree_id])
+
+    @_serialized(lambda bulk_data, parent=None, *args, **kwargs:
+                 [parent] if parent is not None else [])
+    async def load_bulk(self, bulk_data, parent=None, keep_ids=False):
+        """
+        Async :meth:`~mongotree.tree.nested_set_tree.load_bulk`. The foreign
+        keys are stored as references, without being fetched.
+
+        :returns: the list of the new nodes
+        """
+        model = self.model
+        if model.node_order_by:
+            # every node is placed in its sorted position one by one
+            added = []
+            stack = [(parent, node) for node in bulk_data[::-1]]
+            while stack:
+                node_parent, item = stack.pop()
+                node_data = item['data'].copy()
+                if keep_ids:
+                    node_data['id'] = item['id']
+                if node_parent is None:
+                    newobj = await self.add_root(**node_data)
+                else:
+                    newobj = await self.add_child(node_parent, **node_data)
+                added.append(newobj)
+                stack.extend((newobj, child)
+                             for child in item.get('children', [])[::-1])
+            return added
+
+        step = model.nested_set_gap
+        if parent:
+            tree_id = parent.tree_id
+            depth = parent.depth + 1
+        else:
+            tree_id = await self._open_tree_gap()
+            depth = 1
+
+        newobjs = model._get_bulk_nodes(bulk_data, tree_id, depth, 1, step,
+                                        bool(parent), keep_ids,
+                                        fetch_foreign_keys=False)
+        if not newobjs:
+            return []
+
+        if parent:
+            width = (2 * len(newobjs) - 1) * step + 1
+            first, last = await self._open_gap(parent.tree_id, parent.rgt, width)
+            parent.rgt = last + 1
+            if model.nested_set_numchild:
+                await self.collection.update_one(
+                    {'_id': parent.pk}, {'$inc': {'numchild': len(bulk_data)}})
+                parent.numchild = (parent.numchild or 0) + len(bulk_data)
+            offset = model._get_range_start(first, last, width) - 1
+            for newobj in newobjs:
+                newobj.lft += offset
+                newobj.rgt += offset
+
+        await self._insert(newobjs)
+        await self._bump_versions(range(tree_id, newobjs[-1].tree_id + 1))
+        return newobjs
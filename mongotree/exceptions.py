@@ -16,13 +16,23 @@ class NodeAlreadySaved(Exception):
 class MissingNodeOrderBy(Exception):
     """
     Raised when an operation needs a missing
-    :attr:`~treebeard.MP_Node.node_order_by` attribute
+    :attr:`~mongotree.models.Node.node_order_by` attribute
     """
 
 
 class PathOverflow(Exception):
     """
     Raised when trying to add or move a node to a position where no more nodes
-    can be added (see :attr:`~treebeard.MP_Node.path` and
-    :attr:`~treebeard.MP_Node.alphabet` for more info)
-    """
\ No newline at end of file
+    can be added (see
+    :attr:`~mongotree.tree.materialized_path.materialized_path_tree.path` and
+    :attr:`~mongotree.tree.materialized_path.materialized_path_tree.alphabet`
+    for more info)
+    """
+
+
+class TreeWriteConflict(Exception):
+    """
+    Raised when a structural write keeps conflicting with concurrent writes
+    to the same trees (see
+    :attr:`~mongotree.tree.nested_set_tree.nested_set_optimistic`)
+    """
@@ -3,17 +3,36 @@ import operator
 
 import mongoengine as models
 from mongoengine.queryset.visitor import Q
+from bson.dbref import DBRef
 from mongotree.exceptions import InvalidPosition, MissingNodeOrderBy
 
 if sys.version_info >= (3, 0):
     from functools import reduce
 
 
+def get_result_class(cls):
+    """
+    For the given model class, determine what class we should use for the
+    nodes returned by its tree methods (such as get_children).
+    Usually this will be trivially the same as the initial model class,
+    but there are special cases when model inheritance is in use:
+    the nodes of a concrete subclass of a tree model are returned as
+    instances of that (non abstract) base model.
+    """
+    base = cls.__base__
+    if not getattr(base, '_meta', {}).get('abstract', True):
+        return base
+    else:
+        return cls
+
+
 class Node(models.DynamicDocument):
     meta = {
         'abstract': True
     }
 
+    foreign_keys_batch_size = 1000
+
     @classmethod
     def add_root(cls, **kwargs):
         """
@@ -33,18 +52,68 @@ class Node(models.DynamicDocument):
         return foreign_keys
 
     @classmethod
-    def _process_foreign_keys(cls, foreign_keys, node_data):
+    def _get_foreign_keys_objects(cls, foreign_keys, bulk_data, fetch=True):
+        """Resolve every foreign key value used in a load_bulk structure at
+        once, with one ``$in`` query per referenced model (split in chunks of
+        :attr:`foreign_keys_batch_size` ids).
+        If ``fetch`` is disabled no query is made at all and the values are
+        resolved to ``DBRef`` objects.
+        :returns: A dictionary ``{model: {value: object}}``
+        """
+        values = {}
+        stack = list(bulk_data)
+        while stack:
+            node_struct = stack.pop()
+            for key, model in foreign_keys.items():
+                value = node_struct['data'].get(key)
+                if value is not None and not isinstance(value, models.Document):
+                    values.setdefault(model, set()).add(value)
+            stack.extend(node_struct.get('children', []))
+
+        resolved = {}
+        for model, model_values in values.items():
+            objects = resolved[model] = {}
+            id_field = model._fields[model._meta['id_field']]
+            if not fetch:
+                collection = model._get_collection_name()
+                for value in model_values:
+                    # stored as the id type, so the queries by reference match
+                    objects[value] = DBRef(collection,
+                                           id_field.to_python(value))
+                continue
+            pks = {value: id_field.to_python(value) for value in model_values}
+            found = {}
+            pk_list = list(set(pks.values()))
+            size = cls.foreign_keys_batch_size
+            for i in range(0, len(pk_list), size):
+                for obj in model.objects(pk__in=pk_list[i:i + size]):
+                    found[obj.pk] = obj
+            for value, pk in pks.items():
+                if pk not in found:
+                    raise model.DoesNotExist(
+                        '%s matching query does not exist.' % model.__name__)
+                objects[value] = found[pk]
+        return resolved
+
+    @classmethod
+    def _process_foreign_keys(cls, foreign_keys, node_data, resolved=None):
         """For each foreign key try to load the actual object so load_bulk
         doesn't fail trying to load an int where django expects a
         model instance
+        If ``resolved`` (see :meth:`_get_foreign_keys_objects`) is given, the
+        objects are taken from it instead of being queried one by one.
         """
         for key in foreign_keys.keys():
             if key in node_data:
-                node_data[key] = foreign_keys[key].objects.get(
-                    pk=node_data[key])
+                if resolved is None:
+                    node_data[key] = foreign_keys[key].objects.get(
+                        pk=node_data[key])
+                elif node_data[key] in resolved.get(foreign_keys[key], {}):
+                    node_data[key] = resolved[foreign_keys[key]][node_data[key]]
 
     @classmethod
-    def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False,
+                  fetch_foreign_keys=True):
         """
         Loads a list/dictionary structure to the tree.
         :param bulk_data:
@@ -62,6 +131,10 @@ class Node(models.DynamicDocument):
             If enabled, loads the nodes with the same id that are given in the
             structure. Will error if there are nodes without id info or if the
             ids are already used.
+        :param fetch_foreign_keys:
+            If enabled (the default), the objects referenced by foreign keys
+            are loaded (one query per referenced model), otherwise the
+            references are stored as ``DBRef`` without querying.
         :returns: A list of the added node ids.
         """
         # tree, iterative preorder
@@ -69,12 +142,14 @@ class Node(models.DynamicDocument):
         # stack of nodes to analyze
         stack = [(parent, node) for node in bulk_data[::-1]]
         foreign_keys = cls.get_foreign_keys()
+        resolved = cls._get_foreign_keys_objects(
+            foreign_keys, bulk_data, fetch_foreign_keys)
 
         while stack:
             parent, node_struct = stack.pop()
             # shallow copy of the data structure so it doesn't persist...
             node_data = node_struct['data'].copy()
-            cls._process_foreign_keys(foreign_keys, node_data)
+            cls._process_foreign_keys(foreign_keys, node_data, resolved)
             if keep_ids:
                 node_data['id'] = node_struct['id']
             if parent:
@@ -143,13 +218,16 @@ class Node(models.DynamicDocument):
         raise NotImplementedError
 
     @classmethod
-    def get_descendants_group_count(cls, parent=None):
+    def get_descendants_group_count(cls, parent=None, **filters):
         """
         Helper for a very common case: get a group of siblings and the number
         of *descendants* (not only children) in every sibling.
         :param parent:
             The parent of the siblings to return. If no parent is given, the
             root nodes will be returned.
+        :param filters:
+            Query arguments (as in ``objects.filter``) to only count the
+            descendants matching them.
         :returns:
             A `list` (**NOT** a Queryset) of node objects with an extra
             attribute: `descendants_count`.
@@ -160,7 +238,12 @@ class Node(models.DynamicDocument):
             qset = parent.get_children()
         nodes = list(qset)
         for node in nodes:
-            node.descendants_count = node.get_descendant_count()
+            if filters:
+                node.descendants_count = get_result_class(cls).objects(
+                    pk__in=[obj.pk for obj in node.get_descendants()],
+                    **filters).count()
+            else:
+                node.descendants_count = node.get_descendant_count()
         return nodes
 
     def get_depth(self):
@@ -271,6 +354,39 @@ class Node(models.DynamicDocument):
     def add_sibling(self, pos=None, **kwargs):
         raise NotImplementedError
 
+    def add_children(self, children, pos=None):
+        """
+        Adds many children to the node.
+
+        :param children: the arguments of :meth:`add_child` of every new
+            node, in order
+        :param pos: ``first-child``, ``last-child`` or ``sorted-child``
+        :returns: the new nodes, in the order of ``children``
+        """
+        pos = self._prepare_pos_var_for_add_children(pos)
+        if pos == 'first-child' and not self.is_leaf():
+            return self.get_first_child().add_siblings(children, 'left')
+        return [self.add_child(**kwargs) for kwargs in children]
+
+    def add_siblings(self, siblings, pos=None):
+        """
+        Adds many siblings to the node, keeping them in order.
+
+        :param siblings: the arguments of :meth:`add_sibling` of every new
+            node, in order
+        :param pos: the position of the new nodes, as in :meth:`add_sibling`
+        :returns: the new nodes, in the order of ``siblings``
+        """
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+        target = self
+        newobjs = []
+        for kwargs in siblings:
+            newobjs.append(target.add_sibling(pos, **kwargs))
+            if pos in ('first-sibling', 'left', 'right'):
+                # the next ones go right after it
+                target, pos = newobjs[-1], 'right'
+        return newobjs
+
     def get_root(self):
         raise NotImplementedError
 
@@ -319,6 +435,18 @@ class Node(models.DynamicDocument):
             self._valid_pos_for_add_sibling,
             self._valid_pos_for_sorted_add_sibling)
 
+    _valid_pos_for_add_children = ('first-child', 'last-child', 'sorted-child')
+    _valid_pos_for_sorted_add_children = ('sorted-child',)
+
+    def _prepare_pos_var_for_add_children(self, pos):
+        if pos is None:
+            pos = 'sorted-child' if self.node_order_by else 'last-child'
+        return self._prepare_pos_var(
+            pos,
+            'add_children',
+            self._valid_pos_for_add_children,
+            self._valid_pos_for_sorted_add_children)
+
     _valid_pos_for_move = _valid_pos_for_add_sibling + (
         'first-child', 'last-child', 'sorted-child')
     _valid_pos_for_sorted_move = _valid_pos_for_sorted_add_sibling + (
@@ -1 +1,6 @@
-from .nested_set import nested_set_tree
\ No newline at end of file
+from .nested_set import nested_set_tree
+from .materialized_path import materialized_path_tree
+from .adjacency_list import adjacency_list_tree
+from .closure_table import closure_table_tree
+from .snapshot import nested_set_snapshot
+from .cache import nested_set_cache
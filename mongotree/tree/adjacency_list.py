@@ -0,0 +1,418 @@
+import mongoengine as models
+from bson import ObjectId
+from mongoengine.queryset import (
+    QuerySet,
+    QuerySetManager,
+)
+from mongotree.models import Node, get_result_class
+from mongotree.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
+
+class adjacency_list_query_set(QuerySet):
+    def delete(self):
+        model = get_result_class(self._document)
+        removed = set(self.scalar('id'))
+        if not removed:
+            return
+        # the descendants of all the selected nodes, in one aggregation
+        for node in model._graph_lookup(
+                {'_id': {'$in': list(removed)}}, '$_id', '_id', 'parent',
+                {'$project': {'_id': 1}}):
+            removed.add(node['_id'])
+
+        removed = list(removed)
+        size = model.adjacency_list_batch_size
+        for i in range(0, len(removed), size):
+            super(adjacency_list_query_set, model.objects.filter(
+                pk__in=removed[i:i + size])).delete()
+
+class adjacency_list_manager(QuerySetManager):
+    """Custom manager for nodes in an Adjacency List tree."""
+    queryset_class = adjacency_list_query_set
+
+    @staticmethod
+    def get_queryset(doc_cls, queryset):
+        """Sets the custom queryset as the default."""
+        return queryset().order_by('sib_order')
+
+class adjacency_list_tree(Node):
+    """
+    Tree where every node only stores the id of its ``parent`` and its
+    position among its siblings (``sib_order``).
+
+    Moving a node only updates the node itself (and the order of its new
+    siblings), while subtree and ancestor reads are done with a single
+    ``$graphLookup`` aggregation.
+    """
+    node_order_by = []
+    adjacency_list_batch_size = 1000
+
+    parent = models.ObjectIdField(null=True)
+    sib_order = models.IntField()
+
+    meta = {
+        'indexes': [
+            ('parent', 'sib_order')
+        ],
+        'abstract': True,
+        'allow_inheritance': True
+    }
+
+    objects = adjacency_list_manager()
+
+    @classmethod
+    def _graph_lookup(cls, query, start_with, connect_from, connect_to,
+                      *stages):
+        """
+        Runs a ``$graphLookup`` from the nodes matching ``query``.
+
+        :returns: A cursor over the raw found nodes, each one with its
+            distance to the starting nodes in ``level`` (0 for the children
+            or the parent), followed by the extra ``stages``.
+        """
+        cls = get_result_class(cls)
+        pipeline = [
+            {'$match': query},
+            {'$graphLookup': {
+                'from': cls._get_collection_name(),
+                'startWith': start_with,
+                'connectFromField': connect_from,
+                'connectToField': connect_to,
+                'as': 'nodes',
+                'depthField': 'level'
+            }},
+            # $unwind is coalesced in the lookup, so the result isn't bound
+            # by the document size limit
+            {'$unwind': '$nodes'},
+            {'$replaceRoot': {'newRoot': '$nodes'}}
+        ]
+        return cls._get_collection().aggregate(pipeline + list(stages))
+
+    @classmethod
+    def _from_raw(cls, son, depth=None):
+        son.pop('level', None)
+        node = get_result_class(cls)._from_son(son)
+        if depth is not None:
+            node._cached_depth = depth
+        return node
+
+    @classmethod
+    def _get_preorder(cls, roots, nodes):
+        """:returns: the raw ``roots`` and ``nodes`` sorted in preorder, as
+        ``(node, depth from the roots)`` tuples"""
+        children = {}
+        for node in nodes:
+            children.setdefault(node.get('parent'), []).append(node)
+        for siblings in children.values():
+            siblings.sort(key=lambda node: node['sib_order'])
+
+        stack = [(node, 0) for node in sorted(
+            roots, key=lambda node: node['sib_order'], reverse=True)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            stack.extend([(child, depth + 1)
+                          for child in children.get(node['_id'], [])[::-1]])
+
+    @classmethod
+    def _new_instance(cls, kwargs):
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
+            return newobj
+        return get_result_class(cls)(**kwargs)
+
+    def _save_new_node(self):
+        """Saves a new node, once its ``parent`` and ``sib_order`` are set."""
+        self.save()
+
+    @classmethod
+    def _insert_nodes(cls, newobjs):
+        """
+        Writes the new nodes (in preorder, with their ids and parents set)
+        with a single batched insert.
+
+        :returns: the ids of the inserted nodes
+        """
+        return cls.objects.insert(newobjs, load_bulk=False)
+
+    @classmethod
+    def add_root(cls, **kwargs):
+        """Add root node to tree"""
+        last_root = cls.get_last_root_node()
+
+        if last_root and last_root.node_order_by:
+            return last_root.add_sibling('sorted-sibling', **kwargs)
+
+        newobj = cls._new_instance(kwargs)
+        newobj.parent = None
+        newobj.sib_order = last_root.sib_order + 1 if last_root else 1
+        newobj._save_new_node()
+        return newobj
+
+    def add_child(self, **kwargs):
+        last_child = self.get_last_child()
+        if last_child and self.node_order_by:
+            return last_child.add_sibling('sorted-sibling', **kwargs)
+
+        newobj = self._new_instance(kwargs)
+        newobj.parent = self.pk
+        newobj.sib_order = last_child.sib_order + 1 if last_child else 1
+        newobj._save_new_node()
+        return newobj
+
+    def add_sibling(self, pos=None, **kwargs):
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+
+        newobj = self._new_instance(kwargs)
+        newobj.parent = self.parent
+        newobj.sib_order = self._get_sibling_order(self, pos, newobj)
+        newobj._save_new_node()
+        return newobj
+
+    def _get_sibling_order(self, target, pos, newobj):
+        """
+        :returns: the ``sib_order`` for a new sibling of ``target`` in the
+            ``pos`` position, moving the siblings to its right one place
+        """
+        cls = get_result_class(self.__class__)
+        siblings = target.get_siblings()
+
+        if pos == 'sorted-sibling':
+            found = target.get_sorted_pos_queryset(siblings, newobj).first()
+            if found:
+                pos = 'left'
+                target = found
+            else:
+                pos = 'last-sibling'
+        if pos == 'first-sibling':
+            target = siblings.first()
+            pos = 'left'
+
+        if pos == 'last-sibling':
+            return siblings.order_by('-sib_order').first().sib_order + 1
+
+        order = target.sib_order
+        if pos == 'right':
+            order += 1
+        cls.objects(__raw__={'parent': target.parent}, sib_order__gte=order).update(
+            inc__sib_order=1)
+        return order
+
+    def move(self, target, pos=None):
+        pos = self._prepare_pos_var_for_move(pos)
+        cls = get_result_class(self.__class__)
+
+        if target == self and pos in ('first-child', 'last-child', 'sorted-child') \
+                or target.is_descendant_of(self):
+            raise InvalidMoveToDescendant("Can't move node to a descendant.")
+
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            last_child = target.get_last_child()
+            if last_child is None:
+                parent, order = target.pk, 1
+                pos = 'last-child'
+            else:
+                target = last_child
+                pos = {
+                    'first-child': 'first-sibling',
+                    'last-child': 'last-sibling',
+                    'sorted-child': 'sorted-sibling'
+                }[pos]
+
+        if self == target and (
+            (pos == 'left') or
+            (pos in ('right', 'last-sibling') and
+             target == target.get_last_sibling()) or
+            (pos == 'first-sibling' and
+             target == target.get_first_sibling())):
+            # special cases, not actually moving the node so no need to UPDATE
+            return
+
+        if pos != 'last-child':
+            parent = target.parent
+            order = self._get_sibling_order(target, pos, self)
+
+        cls.objects(pk=self.pk).update(set__parent=parent, set__sib_order=order)
+        self.parent = parent
+        self.sib_order = order
+        self.__dict__.pop('_cached_depth', None)
+
+    @classmethod
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False,
+                  fetch_foreign_keys=True):
+        """Loads a list/dictionary structure to the tree.
+
+        The ids, parents and sibling orders of the whole structure are
+        computed in memory and all the nodes are written with a single
+        batched insert.
+        """
+        cls = get_result_class(cls)
+
+        if cls.node_order_by or not (
+                keep_ids or isinstance(cls._fields[cls._meta['id_field']],
+                                       models.ObjectIdField)):
+            return super(adjacency_list_tree, cls).load_bulk(
+                bulk_data, parent, keep_ids, fetch_foreign_keys)
+
+        if parent:
+            last = parent.get_last_child()
+        else:
+            last = cls.get_last_root_node()
+        first_order = last.sib_order + 1 if last else 1
+
+        foreign_keys = cls.get_foreign_keys()
+        resolved = cls._get_foreign_keys_objects(
+            foreign_keys, bulk_data, fetch_foreign_keys)
+        newobjs = []
+        # stack of (node structure, parent id, sib_order) in preorder
+        stack = [(node, parent.pk if parent else None, first_order + i)
+                 for i, node in enumerate(bulk_data)][::-1]
+        while stack:
+            node_struct, parent_id, order = stack.pop()
+            # shallow copy of the data structure so it doesn't persist...
+            node_data = node_struct['data'].copy()
+            cls._process_foreign_keys(foreign_keys, node_data, resolved)
+            # the ids are needed to link the children before the insert
+            node_data['id'] = node_struct['id'] if keep_ids else ObjectId()
+            newobj = cls(**node_data)
+            newobj.parent = parent_id
+            newobj.sib_order = order
+            newobjs.append(newobj)
+            stack.extend([(node, newobj.pk, i + 1) for i, node in
+                          enumerate(node_struct.get('children', []))][::-1])
+        if not newobjs:
+            return []
+
+        for newobj in newobjs:
+            newobj.validate()
+        return cls._insert_nodes(newobjs)
+
+    @classmethod
+    def dump_bulk(cls, parent=None, keep_ids=True):
+        """Dumps a tree branch to a python data structure."""
+        return list(cls.iter_dump_bulk(parent, keep_ids))
+
+    @classmethod
+    def iter_dump_bulk(cls, parent=None, keep_ids=True):
+        """
+        Generator version of :meth:`dump_bulk`: yields every top level branch
+        of the dump as soon as it is complete (one aggregation per branch).
+        """
+        cls = cls._get_serializable_model()
+        roots = [parent] if parent else cls.get_root_nodes()
+        for root in roots:
+            raw_root = cls.objects(pk=root.pk).as_pymongo().first()
+            nodes = cls._graph_lookup({'_id': root.pk}, '$_id', '_id', 'parent')
+            lnk = {}
+            for serobj, depth in cls._get_preorder([raw_root], nodes):
+                fields = {k: serobj[k] for k in serobj if k not in ['_id', '_cls', 'parent', 'sib_order', 'level']}
+                newobj = {'data': fields}
+                if keep_ids:
+                    newobj['id'] = serobj['_id']
+                if depth:
+                    parentser = lnk[serobj['parent']]
+                    if 'children' not in parentser:
+                        parentser['children'] = []
+                    parentser['children'].append(newobj)
+                lnk[serobj['_id']] = newobj
+            yield lnk[raw_root['_id']]
+
+    @classmethod
+    def get_tree(cls, parent=None):
+        """
+        :returns: A list of the nodes of the tree (or of the branch of
+            ``parent``) in preorder.
+        """
+        cls = get_result_class(cls)
+        if parent is None:
+            nodes = list(cls.objects().as_pymongo())
+            roots = [node for node in nodes if node.get('parent') is None]
+            return [cls._from_raw(node, depth + 1)
+                    for node, depth in cls._get_preorder(roots, nodes)]
+        parent = cls.objects.get(pk=parent.pk)
+        return [parent] + parent.get_descendants()
+
+    @classmethod
+    def get_root_nodes(cls):
+        return get_result_class(cls).objects.filter(__raw__={'parent': None})
+
+    @classmethod
+    def get_last_root_node(cls):
+        return cls.get_root_nodes().order_by('-sib_order').first()
+
+    def get_depth(self):
+        if '_cached_depth' not in self.__dict__:
+            if self.parent is None:
+                self._cached_depth = 1
+            else:
+                self._cached_depth = len(self._get_raw_ancestors()) + 1
+        return self._cached_depth
+
+    def is_root(self):
+        return self.parent is None
+
+    def get_root(self):
+        if self.parent is None:
+            return self
+        return self.get_ancestors()[0]
+
+    def get_parent(self, update=False):
+        if self.parent is None:
+            return
+        return get_result_class(self.__class__).objects.get(pk=self.parent)
+
+    def _get_raw_ancestors(self):
+        nodes = list(self._graph_lookup({'_id': self.pk}, '$parent', 'parent', '_id'))
+        nodes.sort(key=lambda node: node['level'], reverse=True)
+        return nodes
+
+    def get_ancestors(self):
+        """:returns: A list of the ancestors of the node, from the root."""
+        if self.parent is None:
+            return []
+        return [self._from_raw(node, depth + 1)
+                for depth, node in enumerate(self._get_raw_ancestors())]
+
+    def get_siblings(self):
+        return get_result_class(self.__class__).objects.filter(__raw__={'parent': self.parent})
+
+    def get_children(self):
+        return get_result_class(self.__class__).objects.filter(parent=self.pk)
+
+    def get_first_child(self):
+        return self.get_children().first()
+
+    def get_last_child(self):
+        return self.get_children().order_by('-sib_order').first()
+
+    def get_descendants(self):
+        """:returns: A list of the descendants of the node, in preorder."""
+        nodes = self._graph_lookup({'_id': self.pk}, '$_id', '_id', 'parent')
+        roots = []
+        rest = []
+        for node in nodes:
+            (roots if node['level'] == 0 else rest).append(node)
+        depth = self.get_depth()
+        return [self._from_raw(node, depth + level + 1)
+                for node, level in self._get_preorder(roots, rest)]
+
+    def get_descendant_count(self):
+        """:returns: the number of descendants of a node."""
+        for result in self._graph_lookup({'_id': self.pk}, '$_id', '_id', 'parent',
+                                         {'$count': 'count'}):
+            return result['count']
+        return 0
+
+    def is_descendant_of(self, node):
+        """
+        :returns: ``True`` if the node if a descendant of another node given
+            as an argument, else, returns ``False``
+        """
+        if self.parent is None:
+            return False
+        if self.parent == node.pk:
+            return True
+        return any(True for ancestor in self._graph_lookup(
+            {'_id': self.pk}, '$parent', 'parent', '_id',
+            {'$match': {'_id': node.pk}}))
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
+from mongotree.models import get_result_class
+
+
+class nested_set_cache(object):
+    """
+    Process wide LRU cache of the reads of nested set trees, for models with
+    :attr:`~mongotree.tree.nested_set_tree.nested_set_versions` (or
+    ``nested_set_optimistic``) enabled.
+
+    The raw documents read are kept under the version counter of their tree
+    (of the whole forest for :meth:`get_root_nodes` and a full
+    :meth:`get_tree`), so every call costs a single tiny query for the
+    counter, plus the real read on a miss. Any write through the tree
+    methods increases the counter, so the entries of a changed tree are
+    never used again and end up evicted. The nodes returned are fresh
+    objects built from a copy of the cached documents, so they can be
+    changed freely.
+
+    One instance can be shared by any number of models and threads.
+    """
+
+    def __init__(self, max_size=1000):
+        #: Maximum number of reads kept, the least recently used ones are
+        #: evicted first.
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drops all the entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def _get(self, model, tree_id, key, load):
+        """
+        :returns: the nodes read by ``load`` (a queryset factory), from the
+            cache when the tree is still at the version they were read at
+        """
+        model = get_result_class(model)
+        if not model._has_versions():
+            raise ValueError(
+                '{} has no version counters to check, set '
+                'nested_set_versions'.format(model.__name__))
+        version = model.get_tree_version(tree_id)
+        key = (model, tree_id, version['epoch'], version['version']) + key
+        with self._lock:
+            sons = self._entries.get(key)
+            if sons is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if sons is None:
+            sons = list(load().as_pymongo())
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = sons
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return [model._from_son(deepcopy(son)) for son in sons]
+
+    def get_tree(self, model, parent=None):
+        """Cached :meth:`~mongotree.tree.nested_set_tree.get_tree`, as a
+        list."""
+        if parent is None:
+            return self._get(model, 0, ('get_tree',), model.get_tree)
+        return self._get(model, parent.tree_id,
+                         ('get_tree', parent.lft, parent.rgt),
+                         lambda: model.get_tree(parent))
+
+    def get_ancestors(self, node):
+        """Cached :meth:`~mongotree.tree.nested_set_tree.get_ancestors`, as a
+        list."""
+        return self._get(node.__class__, node.tree_id,
+                         ('get_ancestors', node.lft, node.rgt),
+                         node.get_ancestors)
+
+    def get_children(self, node):
+        """Cached :meth:`~mongotree.tree.nested_set_tree.get_children`, as a
+        list."""
+        return self._get(node.__class__, node.tree_id,
+                         ('get_children', node.lft, node.rgt, node.depth),
+                         lambda: node.get_descendants().filter(
+                             depth=node.depth + 1))
+
+    def get_root_nodes(self, model):
+        """Cached :meth:`~mongotree.tree.nested_set_tree.get_root_nodes`, as
+        a list."""
+        return self._get(model, 0, ('get_root_nodes',), model.get_root_nodes)
@@ -0,0 +1,245 @@
+from pymongo import DeleteMany
+from mongotree.models import get_result_class
+from mongotree.tree.adjacency_list import (
+    adjacency_list_manager,
+    adjacency_list_query_set,
+    adjacency_list_tree,
+)
+
+class closure_table_query_set(adjacency_list_query_set):
+    def delete(self):
+        model = get_result_class(self._document)
+        selected = list(self.scalar('id'))
+        if not selected:
+            return
+        closure = model._get_closure_collection()
+        size = model.closure_table_batch_size
+        removed = set(selected)
+        for i in range(0, len(selected), size):
+            for row in closure.find({'ancestor': {'$in': selected[i:i + size]}},
+                                    {'descendant': 1}):
+                removed.add(row['descendant'])
+
+        removed = list(removed)
+        for i in range(0, len(removed), size):
+            batch = removed[i:i + size]
+            super(adjacency_list_query_set, model.objects.filter(
+                pk__in=batch)).delete()
+            # the rows from the removed ancestors always point to removed
+            # descendants too
+            closure.delete_many({'descendant': {'$in': batch}})
+
+class closure_table_manager(adjacency_list_manager):
+    """Custom manager for nodes in a Closure Table tree."""
+    queryset_class = closure_table_query_set
+
+class closure_table_tree(adjacency_list_tree):
+    """
+    Adjacency list tree that also stores every ``(ancestor, descendant,
+    distance)`` pair of the tree in a companion collection.
+
+    Ancestor checks, ancestor lists, depths and (depth bounded) subtree
+    reads are single indexed queries on that collection, and don't depend
+    on how fresh the node instance is. Writes pay for it: adding a node
+    inserts one row per ancestor, and moving a branch rewrites the rows that
+    link it to its old and new ancestors.
+    """
+    #: Name of the companion collection, ``<collection>_closure`` if unset.
+    closure_table_collection = None
+    closure_table_batch_size = 1000
+
+    meta = {
+        'abstract': True,
+        'allow_inheritance': True
+    }
+
+    objects = closure_table_manager()
+
+    @classmethod
+    def _get_closure_collection(cls):
+        """
+        :returns: the companion collection of the tree, with its indexes
+            created on first use
+        """
+        cls = get_result_class(cls)
+        collection = cls._get_collection()
+        cached = cls.__dict__.get('_closure_collection')
+        if cached is None or cached[0] is not collection:
+            name = cls.closure_table_collection or collection.name + '_closure'
+            closure = collection.database[name]
+            closure.create_index([('ancestor', 1), ('descendant', 1)],
+                                 unique=True)
+            closure.create_index([('ancestor', 1), ('distance', 1)])
+            closure.create_index([('descendant', 1), ('distance', 1)])
+            cached = cls._closure_collection = (collection, closure)
+        return cached[1]
+
+    @classmethod
+    def drop_collection(cls):
+        get_result_class(cls)._get_closure_collection().drop()
+        get_result_class(cls)._closure_collection = None
+        super(closure_table_tree, cls).drop_collection()
+
+    @classmethod
+    def _insert_rows(cls, rows):
+        """Inserts the closure ``rows`` (any iterable) in batches."""
+        closure = cls._get_closure_collection()
+        size = cls.closure_table_batch_size
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == size:
+                closure.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            closure.insert_many(batch, ordered=False)
+
+    @classmethod
+    def _link_nodes(cls, newobjs):
+        """
+        Inserts the closure rows of the new nodes, given in preorder (every
+        parent is either saved before or listed before its children).
+        """
+        closure = cls._get_closure_collection()
+        pks = set(newobj.pk for newobj in newobjs)
+        parents = set(newobj.parent for newobj in newobjs
+                      if newobj.parent is not None and newobj.parent not in pks)
+        chains = {}
+        for row in closure.find({'descendant': {'$in': list(parents)}},
+                                {'ancestor': 1, 'descendant': 1, 'distance': 1}):
+            chains.setdefault(row['descendant'], []).append(
+                (row['ancestor'], row['distance']))
+
+        def rows():
+            for newobj in newobjs:
+                chain = [(newobj.pk, 0)]
+                if newobj.parent is not None:
+                    chain.extend((ancestor, distance + 1) for ancestor, distance
+                                 in chains[newobj.parent])
+                chains[newobj.pk] = chain
+                for ancestor, distance in chain:
+                    yield {'ancestor': ancestor, 'descendant': newobj.pk,
+                           'distance': distance}
+
+        cls._insert_rows(rows())
+
+    def _save_new_node(self):
+        super(closure_table_tree, self)._save_new_node()
+        self._link_nodes([self])
+
+    @classmethod
+    def _insert_nodes(cls, newobjs):
+        ids = super(closure_table_tree, cls)._insert_nodes(newobjs)
+        cls._link_nodes(newobjs)
+        return ids
+
+    def move(self, target, pos=None):
+        closure = self._get_closure_collection()
+        row = closure.find_one({'descendant': self.pk, 'distance': 1},
+                               {'ancestor': 1})
+        old_parent = row['ancestor'] if row else None
+        super(closure_table_tree, self).move(target, pos)
+        if self.parent != old_parent:
+            self._relink()
+
+    def _relink(self):
+        """
+        Replaces the rows linking the branch of the node to its old
+        ancestors with rows to the ancestors of its current ``parent``.
+        """
+        cls = get_result_class(self.__class__)
+        closure = cls._get_closure_collection()
+        size = cls.closure_table_batch_size
+        levels = {}
+        for row in closure.find({'ancestor': self.pk},
+                                {'descendant': 1, 'distance': 1}):
+            levels.setdefault(row['distance'], []).append(row['descendant'])
+
+        # a node of the branch at ``distance`` from its root is linked to
+        # the outside of the branch by the rows that are further than that
+        requests = []
+        for distance, descendants in levels.items():
+            for i in range(0, len(descendants), size):
+                requests.append(DeleteMany({
+                    'descendant': {'$in': descendants[i:i + size]},
+                    'distance': {'$gt': distance}}))
+        closure.bulk_write(requests, ordered=False)
+
+        if self.parent is None:
+            return
+        ancestors = list(closure.find({'descendant': self.parent},
+                                      {'ancestor': 1, 'distance': 1}))
+        cls._insert_rows(
+            {'ancestor': ancestor['ancestor'], 'descendant': descendant,
+             'distance': ancestor['distance'] + distance + 1}
+            for distance, descendants in levels.items()
+            for descendant in descendants
+            for ancestor in ancestors)
+
+    def _get_raw_nodes(self, pks):
+        cls = get_result_class(self.__class__)
+        size = cls.closure_table_batch_size
+        nodes = []
+        for i in range(0, len(pks), size):
+            nodes.extend(cls.objects(pk__in=pks[i:i + size]).as_pymongo())
+        return nodes
+
+    def get_depth(self):
+        if '_cached_depth' not in self.__dict__:
+            self._cached_depth = self._get_closure_collection().count_documents(
+                {'descendant': self.pk})
+        return self._cached_depth
+
+    def get_root(self):
+        row = self._get_closure_collection().find_one(
+            {'descendant': self.pk}, {'ancestor': 1}, sort=[('distance', -1)])
+        if row is None or row['ancestor'] == self.pk:
+            return self
+        return get_result_class(self.__class__).objects.get(pk=row['ancestor'])
+
+    def get_ancestors(self):
+        """:returns: A list of the ancestors of the node, from the root."""
+        rows = list(self._get_closure_collection().find(
+            {'descendant': self.pk, 'distance': {'$gt': 0}},
+            {'ancestor': 1}).sort('distance', -1))
+        self._cached_depth = len(rows) + 1
+        if not rows:
+            return []
+        nodes = dict((node['_id'], node) for node in
+                     self._get_raw_nodes([row['ancestor'] for row in rows]))
+        return [self._from_raw(nodes[row['ancestor']], depth + 1)
+                for depth, row in enumerate(rows)]
+
+    def get_descendants(self, depth=None):
+        """
+        :param depth: if given, only the descendants up to ``depth`` levels
+            below the node are returned
+        :returns: A list of the descendants of the node, in preorder.
+        """
+        query = {'ancestor': self.pk, 'distance': {'$gt': 0}}
+        if depth is not None:
+            query['distance']['$lte'] = depth
+        levels = dict((row['descendant'], row['distance']) for row in
+                      self._get_closure_collection().find(
+                          query, {'descendant': 1, 'distance': 1}))
+        roots = []
+        rest = []
+        for node in self._get_raw_nodes(list(levels)):
+            (roots if levels[node['_id']] == 1 else rest).append(node)
+        depth = self.get_depth()
+        return [self._from_raw(node, depth + level + 1)
+                for node, level in self._get_preorder(roots, rest)]
+
+    def get_descendant_count(self):
+        """:returns: the number of descendants of a node."""
+        return self._get_closure_collection().count_documents(
+            {'ancestor': self.pk, 'distance': {'$gt': 0}})
+
+    def is_descendant_of(self, node):
+        """
+        :returns: ``True`` if the node if a descendant of another node given
+            as an argument, else, returns ``False``
+        """
+        return self._get_closure_collection().find_one(
+            {'ancestor': node.pk, 'descendant': self.pk,
+             'distance': {'$gt': 0}}, {'_id': 1}) is not None
@@ -0,0 +1,477 @@
+import sys
+import operator
+if sys.version_info >= (3, 0):
+    from functools import reduce
+
+import mongoengine as models
+from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
+from mongoengine.queryset import (
+    QuerySet,
+    QuerySetManager,
+)
+from mongotree.models import Node, get_result_class
+from mongotree.exceptions import InvalidMoveToDescendant, NodeAlreadySaved, PathOverflow
+
+class materialized_path_query_set(QuerySet):
+    def delete(self):
+        model = get_result_class(self._document)
+        # the selected nodes are sorted by path, so a node is either a
+        # descendant of the last kept node or the start of a new branch
+        removed = []
+        for node in self.order_by('path').only('path').as_pymongo():
+            if removed and node['path'].startswith(removed[-1]):
+                continue
+            removed.append(node['path'])
+        if not removed:
+            return
+
+        # the parents of the removed branches lose some children
+        numchild = {}
+        for path in removed:
+            parentpath = path[:-model.steplen]
+            if parentpath:
+                numchild[parentpath] = numchild.get(parentpath, 0) + 1
+
+        size = model.materialized_path_batch_size
+        for i in range(0, len(removed), size):
+            toremove = [Q(path__startswith=path) for path in removed[i:i + size]]
+            super(materialized_path_query_set, model.objects.filter(
+                reduce(operator.or_, toremove))).delete()
+        if numchild:
+            model._get_collection().bulk_write([
+                UpdateOne({'path': path}, {'$inc': {'numchild': -count}})
+                for path, count in numchild.items()
+            ], ordered=False)
+
+class materialized_path_manager(QuerySetManager):
+    """Custom manager for nodes in a Materialized Path tree."""
+    queryset_class = materialized_path_query_set
+
+    @staticmethod
+    def get_queryset(doc_cls, queryset):
+        """Sets the custom queryset as the default."""
+        return queryset().order_by('path')
+
+class materialized_path_tree(Node):
+    """
+    Tree where every node stores the path of steps from its root, so a
+    subtree is an anchored prefix of the indexed ``path`` field.
+
+    Every step is :attr:`steplen` characters of :attr:`alphabet` long, so a
+    node can have at most ``len(alphabet) ** steplen - 1`` children.
+    """
+    node_order_by = []
+    steplen = 4
+    alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    materialized_path_batch_size = 1000
+
+    path = models.StringField(required=True, unique=True)
+    depth = models.IntField()
+    numchild = models.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            'depth'
+        ],
+        'index_cls': False,
+        'abstract': True,
+        'allow_inheritance': True
+    }
+
+    objects = materialized_path_manager()
+
+    @classmethod
+    def _int2str(cls, num):
+        """:returns: ``num`` written with :attr:`alphabet` digits"""
+        base = len(cls.alphabet)
+        digits = []
+        while True:
+            num, rem = divmod(num, base)
+            digits.append(cls.alphabet[rem])
+            if not num:
+                break
+        return ''.join(reversed(digits))
+
+    @classmethod
+    def _str2int(cls, num):
+        """:returns: the int value of a step written with :attr:`alphabet`"""
+        base = len(cls.alphabet)
+        value = 0
+        for digit in num:
+            value = value * base + cls.alphabet.index(digit)
+        return value
+
+    @classmethod
+    def _get_path(cls, basepath, newstep):
+        """:returns: the path of the ``newstep`` child of ``basepath``"""
+        key = cls._int2str(newstep)
+        if len(key) > cls.steplen:
+            raise PathOverflow("Path overflow from: '{}'".format(basepath))
+        return '{}{}{}'.format(basepath, cls.alphabet[0] * (cls.steplen - len(key)), key)
+
+    @classmethod
+    def _get_step(cls, path):
+        """:returns: the position of a node among its siblings"""
+        return cls._str2int(path[-cls.steplen:])
+
+    @classmethod
+    def _inc_path(cls, path, inc=1):
+        """:returns: the path of the next sibling of ``path``"""
+        return cls._get_path(path[:-cls.steplen], cls._get_step(path) + inc)
+
+    @classmethod
+    def _new_instance(cls, kwargs):
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
+            return newobj
+        return get_result_class(cls)(**kwargs)
+
+    @classmethod
+    def _update_numchild(cls, path, inc):
+        if path:
+            get_result_class(cls).objects(path=path).update(inc__numchild=inc)
+
+    @classmethod
+    def add_root(cls, **kwargs):
+        """Add root node to tree"""
+        last_root = cls.get_last_root_node()
+
+        if last_root and last_root.node_order_by:
+            return last_root.add_sibling('sorted-sibling', **kwargs)
+
+        newobj = cls._new_instance(kwargs)
+        newobj.depth = 1
+        if last_root:
+            newobj.path = cls._inc_path(last_root.path)
+        else:
+            newobj.path = cls._get_path('', 1)
+        newobj.save()
+        return newobj
+
+    def add_child(self, **kwargs):
+        last_child = self.get_last_child()
+        if last_child and self.node_order_by:
+            return last_child.add_sibling('sorted-sibling', **kwargs)
+
+        newobj = self._new_instance(kwargs)
+        newobj.depth = self.depth + 1
+        if last_child:
+            newobj.path = self._inc_path(last_child.path)
+        else:
+            newobj.path = self._get_path(self.path, 1)
+        newobj.save()
+
+        self._update_numchild(self.path, 1)
+        self.numchild += 1
+        return newobj
+
+    def add_sibling(self, pos=None, **kwargs):
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+
+        newobj = self._new_instance(kwargs)
+        newobj.depth = self.depth
+        newobj.path = self._get_sibling_path(self, pos, newobj)
+        newobj.save()
+
+        self._update_numchild(newobj.path[:-self.steplen], 1)
+        return newobj
+
+    def _get_sibling_path(self, target, pos, newobj):
+        """
+        :returns: the path for a new sibling of ``target`` in the ``pos``
+            position, moving the siblings to its right when there is no free
+            step there
+        """
+        cls = get_result_class(self.__class__)
+
+        if pos == 'sorted-sibling':
+            siblings = list(target.get_sorted_pos_queryset(
+                target.get_siblings(), newobj))
+            if siblings:
+                pos = 'left'
+                target = siblings[0]
+            else:
+                pos = 'last-sibling'
+        if pos == 'right':
+            next_sibling = target.get_next_sibling()
+            if next_sibling:
+                pos = 'left'
+                target = next_sibling
+            else:
+                pos = 'last-sibling'
+        if pos == 'first-sibling':
+            target = target.get_first_sibling()
+            pos = 'left'
+
+        if pos == 'last-sibling':
+            return cls._inc_path(target.get_last_sibling().path)
+
+        # left: use the step just before the target if it's free
+        basepath = target.path[:-cls.steplen]
+        step = cls._get_step(target.path)
+        prev = cls.objects(depth=target.depth, path__startswith=basepath,
+                           path__lt=target.path).order_by('-path').scalar('path').first()
+        if step > 1 and (prev is None or cls._get_step(prev) < step - 1):
+            return cls._get_path(basepath, step - 1)
+        cls._shift_right(target.path)
+        return target.path
+
+    @classmethod
+    def _shift_right(cls, path):
+        """Moves the node in ``path`` and its right siblings (with their
+        descendants) one step to the right"""
+        cls = get_result_class(cls)
+        basepath = path[:-cls.steplen]
+        end = len(basepath) + cls.steplen
+        # rightmost first, so the new paths are always free
+        nodes = cls.objects(path__startswith=basepath, path__gte=path).order_by(
+            '-path').only('path').as_pymongo()
+        requests = []
+        for node in nodes:
+            newpath = cls._inc_path(node['path'][:end]) + node['path'][end:]
+            requests.append(UpdateOne({'_id': node['_id']},
+                                      {'$set': {'path': newpath}}))
+        if requests:
+            cls._get_collection().bulk_write(requests)
+
+    def move(self, target, pos=None):
+        pos = self._prepare_pos_var_for_move(pos)
+        cls = get_result_class(self.__class__)
+        parent = None
+
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            last_child = target.get_last_child()
+            if last_child is None:
+                parent = target
+                pos = 'last-child'
+            else:
+                target = last_child
+                pos = {
+                    'first-child': 'first-sibling',
+                    'last-child': 'last-sibling',
+                    'sorted-child': 'sorted-sibling'
+                }[pos]
+
+        if target.is_descendant_of(self) or parent == self:
+            raise InvalidMoveToDescendant("Can't move node to a descendant.")
+
+        if self == target and (
+            (pos == 'left') or
+            (pos in ('right', 'last-sibling') and
+             target == target.get_last_sibling()) or
+            (pos == 'first-sibling' and
+             target == target.get_first_sibling())):
+            # special cases, not actually moving the node so no need to UPDATE
+            return
+
+        if parent:
+            newpath = cls._get_path(parent.path, 1)
+        else:
+            newpath = self._get_sibling_path(target, pos, self)
+
+        # we reload the path because the siblings may have been moved
+        oldpath = cls.objects(pk=self.pk).scalar('path').get()
+        depthdiff = len(newpath) // cls.steplen - len(oldpath) // cls.steplen
+
+        requests = []
+        for node in cls.objects(path__startswith=oldpath).only('path').as_pymongo():
+            requests.append(UpdateOne(
+                {'_id': node['_id']},
+                {'$set': {'path': newpath + node['path'][len(oldpath):]},
+                 '$inc': {'depth': depthdiff}}))
+        cls._get_collection().bulk_write(requests)
+
+        if oldpath[:-cls.steplen] != newpath[:-cls.steplen]:
+            cls._update_numchild(oldpath[:-cls.steplen], -1)
+            cls._update_numchild(newpath[:-cls.steplen], 1)
+
+        self.path = newpath
+        self.depth += depthdiff
+
+    @classmethod
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False,
+                  fetch_foreign_keys=True):
+        """Loads a list/dictionary structure to the tree.
+
+        The paths of the whole structure are computed in memory and all the
+        nodes are written with a single batched insert.
+        """
+        cls = get_result_class(cls)
+
+        if cls.node_order_by:
+            return super(materialized_path_tree, cls).load_bulk(
+                bulk_data, parent, keep_ids, fetch_foreign_keys)
+
+        if parent:
+            last = parent.get_last_child()
+            basepath = parent.path
+        else:
+            last = cls.get_last_root_node()
+            basepath = ''
+        step = cls._get_step(last.path) + 1 if last else 1
+
+        foreign_keys = cls.get_foreign_keys()
+        resolved = cls._get_foreign_keys_objects(
+            foreign_keys, bulk_data, fetch_foreign_keys)
+        newobjs = []
+        # stack of (node structure, path) in preorder
+        stack = [(node, cls._get_path(basepath, step + i))
+                 for i, node in enumerate(bulk_data)][::-1]
+        while stack:
+            node_struct, path = stack.pop()
+            # shallow copy of the data structure so it doesn't persist...
+            node_data = node_struct['data'].copy()
+            cls._process_foreign_keys(foreign_keys, node_data, resolved)
+            if keep_ids:
+                node_data['id'] = node_struct['id']
+            children = node_struct.get('children', [])
+            newobj = cls(**node_data)
+            newobj.path = path
+            newobj.depth = len(path) // cls.steplen
+            newobj.numchild = len(children)
+            newobjs.append(newobj)
+            stack.extend([(node, cls._get_path(path, i + 1))
+                          for i, node in enumerate(children)][::-1])
+        if not newobjs:
+            return []
+
+        for newobj in newobjs:
+            newobj.validate()
+        ids = cls.objects.insert(newobjs, load_bulk=False)
+        if parent:
+            cls._update_numchild(parent.path, len(bulk_data))
+            parent.numchild += len(bulk_data)
+        return ids
+
+    @classmethod
+    def dump_bulk(cls, parent=None, keep_ids=True):
+        """Dumps a tree branch to a python data structure."""
+        return list(cls.iter_dump_bulk(parent, keep_ids))
+
+    @classmethod
+    def iter_dump_bulk(cls, parent=None, keep_ids=True):
+        """
+        Generator version of :meth:`dump_bulk`: yields every top level branch
+        of the dump as soon as it is complete.
+        """
+        qset = cls._get_serializable_model().get_tree(parent).as_pymongo()
+        # stack of (path, serialized node) of the open branch
+        stack = []
+        for serobj in qset:
+            while stack and not serobj['path'].startswith(stack[-1][0]):
+                closed = stack.pop()
+                if not stack:
+                    yield closed[1]
+
+            fields = {k: serobj[k] for k in serobj if k not in ['_id', '_cls', 'path', 'depth', 'numchild']}
+            newobj = {'data': fields}
+            if keep_ids:
+                newobj['id'] = serobj['_id']
+
+            if stack:
+                parentser = stack[-1][1]
+                if 'children' not in parentser:
+                    parentser['children'] = []
+                parentser['children'].append(newobj)
+            stack.append((serobj['path'], newobj))
+        if stack:
+            yield stack[0][1]
+
+    @classmethod
+    def get_tree(cls, parent=None):
+        cls = get_result_class(cls)
+        if parent is None:
+            return cls.objects()
+        return cls.objects(path__startswith=parent.path)
+
+    @classmethod
+    def get_root_nodes(cls):
+        return get_result_class(cls).objects.filter(depth=1)
+
+    @classmethod
+    def get_descendants_group_count(cls, parent=None, **filters):
+        """
+        Same as :meth:`Node.get_descendants_group_count`, with the counts of
+        all the siblings computed by a single aggregation that groups the
+        descendants by the path prefix of their sibling.
+        """
+        cls = get_result_class(cls)
+        if parent is None:
+            nodes = list(cls.get_root_nodes())
+            query = cls.objects(depth__gt=1, **filters)._query
+            length = cls.steplen
+        else:
+            nodes = list(parent.get_children())
+            query = cls.objects(depth__gt=parent.depth + 1,
+                                path__startswith=parent.path,
+                                **filters)._query
+            length = len(parent.path) + cls.steplen
+
+        counts = {}
+        if nodes:
+            # the alphabet is ascii, so byte offsets are character offsets
+            pipeline = [
+                {'$match': query},
+                {'$group': {'_id': {'$substr': ['$path', 0, length]},
+                            'count': {'$sum': 1}}}
+            ]
+            for result in cls._get_collection().aggregate(pipeline):
+                counts[result['_id']] = result['count']
+        for node in nodes:
+            node.descendants_count = counts.get(node.path, 0)
+        return nodes
+
+    @classmethod
+    def get_last_root_node(cls):
+        return cls.get_root_nodes().order_by('-path').first()
+
+    def get_depth(self):
+        return self.depth
+
+    def is_root(self):
+        return self.depth == 1
+
+    def is_leaf(self):
+        return self.numchild == 0
+
+    def get_root(self):
+        if self.depth == 1:
+            return self
+        return get_result_class(self.__class__).objects.get(path=self.path[:self.steplen])
+
+    def get_parent(self, update=False):
+        if self.depth <= 1:
+            return
+        return get_result_class(self.__class__).objects.get(path=self.path[:-self.steplen])
+
+    def get_ancestors(self):
+        paths = [self.path[:pos] for pos in range(self.steplen, len(self.path), self.steplen)]
+        return get_result_class(self.__class__).objects.filter(path__in=paths)
+
+    def get_siblings(self):
+        return get_result_class(self.__class__).objects.filter(
+            depth=self.depth, path__startswith=self.path[:-self.steplen])
+
+    def get_children(self):
+        return get_result_class(self.__class__).objects.filter(
+            depth=self.depth + 1, path__startswith=self.path)
+
+    def get_first_child(self):
+        return self.get_children().first()
+
+    def get_last_child(self):
+        return self.get_children().order_by('-path').first()
+
+    def get_descendants(self):
+        return get_result_class(self.__class__).objects.filter(
+            depth__gt=self.depth, path__startswith=self.path)
+
+    def is_descendant_of(self, node):
+        """
+        :returns: ``True`` if the node if a descendant of another node given
+            as an argument, else, returns ``False``
+        """
+        return self.path.startswith(node.path) and self.depth > node.depth
@@ -1,55 +1,203 @@
-import sys
-import operator
-if sys.version_info >= (3, 0):
-    from functools import reduce
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial, wraps
 
 import mongoengine as models
-from mongoengine.queryset.visitor import Q
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError, WriteError
 from mongoengine.queryset import (
     QuerySet,
     QuerySetManager,
 )
-from mongotree.models import Node
-from mongotree.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
+from mongotree.models import Node, get_result_class
+from mongotree.tree.snapshot import nested_set_snapshot
+from mongotree.exceptions import (
+    InvalidMoveToDescendant,
+    NodeAlreadySaved,
+    TreeWriteConflict,
+)
 
-def get_result_class(cls):
+#: Marks the links of a node that weren't prefetched.
+_missing = object()
+#: ``active`` while the thread runs a structural write, so the writes it is
+#: made of don't claim the trees or start a transaction again, and the
+#: ``session`` of the transaction it runs in.
+_write_state = threading.local()
+
+#: Codes of the errors of the servers without pipeline updates (< 4.2) for
+#: an update given as a list: TypeMismatch, and FailedToParse.
+_pipeline_unsupported_codes = frozenset([14, 9])
+
+#: Collection methods that take a ``session``.
+_session_methods = frozenset([
+    'aggregate', 'bulk_write', 'count_documents', 'delete_many', 'delete_one',
+    'distinct', 'find', 'find_one', 'find_one_and_delete',
+    'find_one_and_replace', 'find_one_and_update', 'insert_many',
+    'insert_one', 'replace_one', 'update_many', 'update_one',
+])
+
+class _session_collection(object):
+    """Collection proxy that runs every operation in ``session``."""
+
+    def __init__(self, collection, session):
+        self._collection = collection
+        self._session = session
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name == 'with_options':
+            return lambda *args, **kwargs: _session_collection(
+                attr(*args, **kwargs), self._session)
+        if name in _session_methods:
+            return partial(attr, session=self._session)
+        return attr
+
+def _structural_write(get_scope, get_nodes=None):
     """
-    For the given model class, determine what class we should use for the
-    nodes returned by its tree methods (such as get_children).
-    Usually this will be trivially the same as the initial model class,
-    but there are special cases when model inheritance is in use:
-
+    Runs a structural write through :meth:`nested_set_tree._write_optimistic`
+    for models with ``nested_set_optimistic``, and in a transaction for
+    models with ``nested_set_transactions``.
+
+    :param get_scope: Gets the arguments of the method and returns the ids
+        of the trees it changes, or ``None`` when it changes the forest.
+    :param get_nodes: Gets the arguments of the method and returns the nodes
+        to refresh before the write.
     """
-    if len(cls._superclasses) > 2:
-        return cls.__base__
-    else:
-        return cls
+    def decorator(method):
+        @wraps(method)
+        def wrapper(obj, *args, **kwargs):
+            if isinstance(obj, QuerySet):
+                model = get_result_class(obj._document)
+            elif isinstance(obj, type):
+                model = get_result_class(obj)
+            else:
+                model = get_result_class(obj.__class__)
+            in_transaction = getattr(_write_state, 'session', None) is not None
+            transactional = model.nested_set_transactions and \
+                not in_transaction
+            if not (model.nested_set_optimistic or transactional) or \
+                    getattr(_write_state, 'active', False):
+                return method(obj, *args, **kwargs)
+            nodes = get_nodes(obj, *args, **kwargs) if get_nodes else ()
+            refresh = lambda: [model._refresh_structure(node) for node in nodes]
+
+            def write():
+                _write_state.active = True
+                try:
+                    if transactional:
+                        # an aborted attempt leaves the nodes changed
+                        return model._run_in_transaction(
+                            lambda: method(obj, *args, **kwargs), refresh)
+                    return method(obj, *args, **kwargs)
+                finally:
+                    _write_state.active = False
+
+            if model.nested_set_optimistic:
+                return model._write_optimistic(
+                    lambda: get_scope(obj, *args, **kwargs), refresh, write)
+            return write()
+        return wrapper
+    return decorator
+
+def _forest_scope(cls, *args, **kwargs):
+    return None
+
+def _tree_scope(cls, tree_id=None):
+    return None if tree_id is None else {tree_id}
+
+def _fix_tree_scope(cls, tree_id=None):
+    # the extra top level nodes of a tree move to new trees allocated after
+    # the last one, which only a writer of the whole forest can do safely
+    if tree_id is None:
+        return None
+    qset = get_result_class(cls).objects(tree_id=tree_id).only(
+        'lft', 'rgt').order_by('lft').as_pymongo()
+    first = qset.first()
+    if first is not None and qset.filter(
+            lft__gte=max(first['lft'], first['rgt']),
+            pk__ne=first['_id']).first() is not None:
+        return None
+    return {tree_id}
+
+def _node_scope(node, *args, **kwargs):
+    return {node.tree_id}
+
+def _sibling_scope(node, *args, **kwargs):
+    return None if node.is_root() else {node.tree_id}
+
+def _move_scope(node, target, pos=None):
+    if node.is_root() or (target.is_root() and pos not in (
+            'first-child', 'last-child', 'sorted-child')):
+        return None
+    return {node.tree_id, target.tree_id}
+
+def _move_many_scope(cls, moves):
+    trees = set()
+    for node, target, pos in moves:
+        scope = _move_scope(node, target, pos)
+        if scope is None:
+            return None
+        trees |= scope
+    return trees
+
+def _load_bulk_scope(cls, bulk_data, parent=None, *args, **kwargs):
+    return None if parent is None else {parent.tree_id}
+
+def _delete_scope(qset, removed_ranges=None):
+    if qset.filter(lft=1).count():
+        return None
+    return set(qset.distinct('tree_id'))
+
+def _self_node(node, *args, **kwargs):
+    return [node]
+
+def _move_nodes(node, target, pos=None):
+    return [node, target]
+
+def _load_bulk_nodes(cls, bulk_data, parent=None, *args, **kwargs):
+    return [parent] if parent is not None else []
+
+def _move_many_nodes(cls, moves):
+    return [node for move in moves for node in move[:2]]
 
 class nested_set_query_set(QuerySet):
+    @_structural_write(_delete_scope)
     def delete(self, removed_ranges=None):
         model = get_result_class(self._document)
         if removed_ranges is not None:
+            if model.nested_set_numchild:
+                model._dec_parents_numchild(removed_ranges)
             super(nested_set_query_set, self).delete()
-
-            for tree_id, drop_lft, drop_rgt in sorted(removed_ranges, reverse=True):
-                model._get_close_gap(drop_lft, drop_rgt, tree_id)
+            model._close_gaps(removed_ranges)
+            model._bump_versions(tree_id for tree_id, lft, rgt in removed_ranges)
         else:
-            removed = {}
-            for node in self.order_by('tree_id', 'lft'):
-                found = False
-                for rid, rnode in removed.items():
-                    if node.is_descendant_of(rnode):
-                        found = True
-                        break
-                if not found:
-                    removed[node.pk] = node
-            toremove = []
+            # in (tree_id, lft) order a selected node is below another one
+            # only if it falls in the last range kept, so a single sweep
+            # finds the topmost selected nodes
             ranges = []
-            for id, node in removed.items():
-                toremove.append(Q(lft__gte=node.lft) & Q(lft__lte=node.rgt) & Q(tree_id=node.tree_id))
-                ranges.append((node.tree_id, node.lft, node.rgt))
-            if toremove:
-                model.objects.filter(reduce(operator.or_, toremove)).delete(removed_ranges=ranges)
+            qset = self.order_by('tree_id', 'lft').only(
+                'tree_id', 'lft', 'rgt').as_pymongo()
+            for node in qset:
+                if ranges and ranges[-1][0] == node['tree_id'] and \
+                        node['lft'] < ranges[-1][2]:
+                    continue
+                ranges.append((node['tree_id'], node['lft'], node['rgt']))
+
+            if model.nested_set_numchild:
+                model._dec_parents_numchild(ranges)
+            # the numbers don't change until all the batches are deleted
+            size = model.nested_set_batch_size
+            for i in range(0, len(ranges), size):
+                super(nested_set_query_set, model.objects(__raw__={'$or': [
+                    {'tree_id': tree_id, 'lft': {'$gte': lft, '$lte': rgt}}
+                    for tree_id, lft, rgt in ranges[i:i + size]
+                ]})).delete()
+            model._close_gaps(ranges)
+            model._bump_versions(tree_id for tree_id, lft, rgt in ranges)
 
 class nested_set_manager(QuerySetManager):
     """Custom manager for nodes in a Nested Sets tree."""
@@ -60,21 +208,117 @@ class nested_set_manager(QuerySetManager):
         """Sets the custom queryset as the default."""
         return queryset().order_by('tree_id', 'lft')
 
+class nested_set_ref(object):
+    """
+    The structural fields of a nested set node, read without loading (or
+    hydrating) the rest of its document.
+    """
+    __slots__ = ('pk', 'tree_id', 'lft', 'rgt', 'depth')
+
+    def __init__(self, son):
+        self.pk = son['_id']
+        self.tree_id = son['tree_id']
+        self.lft = son['lft']
+        self.rgt = son['rgt']
+        self.depth = son['depth']
+
+    def __repr__(self):
+        return '<nested_set_ref {} ({}, {}, {})>'.format(
+            self.pk, self.tree_id, self.lft, self.rgt)
+
+class _planned_node(object):
+    """A node of the in-memory copy of the trees changed by
+    :meth:`nested_set_tree.move_many`."""
+    __slots__ = ('son', 'parent', 'children')
+
+    def __init__(self, son, parent):
+        self.son = son
+        self.parent = parent
+        self.children = []
+
+class nested_set_prefetch(object):
+    """
+    Shared state of the nodes loaded by ``get_tree(parent, prefetch=True)``.
+    Once invalidated, all of them go back to querying the database.
+    """
+    __slots__ = ('valid', 'roots')
+
+    def __init__(self, roots=None):
+        self.valid = True
+        #: The loaded root nodes, when the whole forest was loaded.
+        self.roots = roots
+
 class nested_set_tree(Node):
     node_order_by = []
+    use_pipeline_updates = True
+    #: Spacing between consecutive ``lft``/``rgt`` numbers. With the default
+    #: (1) the numbering is dense and every insert shifts the nodes to its
+    #: right. With a bigger value the numbers are allocated sparsely, so
+    #: most inserts land in a free interval and only shift nodes when that
+    #: interval is exhausted (see :meth:`rebalance`).
+    nested_set_gap = 1
+    #: Spacing between the ``tree_id`` of consecutive new trees, which also
+    #: orders the roots. With the default (1) adding or moving a root before
+    #: another one shifts the ``tree_id`` of every tree after it. With a
+    #: bigger value the root takes a free ``tree_id`` between its neighbours,
+    #: so only its own tree is written, and the following trees are only
+    #: shifted when no free id is left there.
+    nested_set_tree_gap = 1
+    nested_set_batch_size = 1000
+    #: Makes the ``(tree_id, lft)`` index unique. The writes that shift
+    #: ``lft`` or ``tree_id`` values then park the shifted nodes out of the
+    #: numbering first, as the server checks the constraint after every
+    #: document of a multi update. An existing non unique index must be
+    #: dropped before enabling it.
+    nested_set_unique_lft = False
+    _parking_offset = 1 << 40
+    #: Keeps the number of children of every node in ``numchild``, updated
+    #: with the same writes that change the tree, so child counts and leaf
+    #: checks don't need queries. Existing trees need a
+    #: :meth:`recompute_numchild` when it is enabled.
+    nested_set_numchild = False
+    #: Keeps a version counter for every tree, and one for the whole forest
+    #: (``tree_id`` 0), in the ``<collection>_versions`` collection. Every
+    #: write that changes a tree increases its counter and the forest one,
+    #: so readers like :class:`~mongotree.tree.cache.nested_set_cache` can
+    #: tell whether a tree changed with a single tiny query.
+    nested_set_versions = False
+    #: Makes the structural writes safe against concurrent writers without a
+    #: global lock (see :meth:`_write_optimistic`). It implies
+    #: :attr:`nested_set_versions`.
+    nested_set_optimistic = False
+    #: Attempts of an optimistic write after the first one, before giving up
+    #: with :class:`~mongotree.exceptions.TreeWriteConflict`.
+    nested_set_retries = 10
+    #: Base of the random exponential backoff between attempts, in seconds.
+    nested_set_retry_delay = 0.005
+    #: Seconds after which the claim of a writer that didn't release it (a
+    #: crashed one) is ignored, measured by the server clock. A running
+    #: writer renews its claims every third of it.
+    nested_set_claim_timeout = 60
+    #: Runs every structural write in a transaction (which needs a replica
+    #: set or a sharded cluster), see :meth:`run_in_transaction`. The writes
+    #: of a :meth:`transaction` block always run in its transaction.
+    nested_set_transactions = False
+    #: Attempts of a transaction after the first one when it fails with a
+    #: transient error, and of its commit when the result is unknown.
+    nested_set_transaction_retries = 3
 
     lft = models.IntField()
     rgt = models.IntField()
     tree_id = models.IntField()
     depth = models.IntField()
+    numchild = models.IntField()
 
+    # every tree query filters on a tree_id and sorts by lft, the
+    # (tree_id, lft) index is created by ensure_indexes
     meta = {
         'indexes': [
-            'lft',
-            'rgt',
-            'tree_id',
-            'depth'
+            ('tree_id', 'rgt'),
+            ('tree_id', 'depth', 'lft'),
+            ('lft', 'tree_id'),
         ],
+        'index_cls': False,
         'abstract': True,
         'allow_inheritance': True
     }
@@ -82,6 +326,407 @@ class nested_set_tree(Node):
     objects = nested_set_manager()
 
     @classmethod
+    def ensure_indexes(cls):
+        super(nested_set_tree, cls).ensure_indexes()
+        cls._get_collection().create_index(
+            [('tree_id', 1), ('lft', 1)],
+            background=cls._meta.get('index_background', False),
+            unique=cls.nested_set_unique_lft)
+
+    @classmethod
+    def explain_queries(cls, node):
+        """
+        Asks the server how it runs the queries of the tree methods for
+        ``node`` (which needs a server with ``explain`` support).
+
+        :returns: A dict with the name of every query and the names of the
+            indexes it uses (``[]`` for a collection scan), plus
+            ``in_memory_sort`` when its results are sorted in memory.
+        """
+        cls = get_result_class(cls)
+        tree = {'tree_id': node.tree_id, 'lft__gte': node.lft,
+                'lft__lte': node.rgt}
+        queries = {
+            'get_tree': cls.objects(**tree),
+            'get_children': cls.objects(depth=node.depth + 1, **tree),
+            'get_ancestors': cls.objects(tree_id=node.tree_id,
+                                         lft__lt=node.lft, rgt__gt=node.rgt),
+            'get_root_nodes': cls.objects(lft=1),
+            'shift_rgt': cls.objects(tree_id=node.tree_id, rgt__gte=node.rgt),
+            'shift_lft': cls.objects(tree_id=node.tree_id, lft__gte=node.rgt),
+            'prev_lft': cls.objects(tree_id=node.tree_id,
+                                    lft__lt=node.rgt).order_by('-lft'),
+            'prev_rgt': cls.objects(tree_id=node.tree_id,
+                                    rgt__lt=node.rgt).order_by('-rgt'),
+        }
+        report = {}
+        for name, qset in queries.items():
+            plan = qset.explain()
+            report[name] = cls._get_plan_usage(
+                plan.get('queryPlanner', plan)['winningPlan'])
+        return report
+
+    @staticmethod
+    def _get_plan_usage(plan):
+        """:returns: the indexes used by a ``winningPlan`` of an explain,
+        and whether it has an in memory ``SORT`` stage"""
+        usage = {'indexes': [], 'in_memory_sort': False}
+        stages = [plan]
+        while stages:
+            stage = stages.pop()
+            if stage.get('indexName'):
+                usage['indexes'].append(stage['indexName'])
+            if stage.get('stage') == 'SORT':
+                usage['in_memory_sort'] = True
+            if 'inputStage' in stage:
+                stages.append(stage['inputStage'])
+            stages.extend(stage.get('inputStages', []))
+        return usage
+
+    @classmethod
+    def _get_structure_fields(cls):
+        fields = ['id', 'tree_id', 'lft', 'rgt', 'depth']
+        if cls.nested_set_numchild:
+            fields.append('numchild')
+        return fields
+
+    @classmethod
+    def _project(cls, qset, only):
+        """
+        Loads only the ``only`` fields (plus the structural ones, so the
+        nodes can still be navigated) of the nodes of ``qset``.
+        """
+        if only is None or isinstance(qset, list):
+            return qset
+        return qset.only(*set(only).union(cls._get_structure_fields()))
+
+    @classmethod
+    def _get_refs(cls, qset):
+        """:returns: a generator of :class:`nested_set_ref` for the nodes of
+        ``qset``"""
+        for son in qset.only('tree_id', 'lft', 'rgt', 'depth').as_pymongo():
+            yield nested_set_ref(son)
+
+    @classmethod
+    def get_snapshot(cls, tree_id=None):
+        """
+        :returns: A :class:`~mongotree.tree.snapshot.nested_set_snapshot` of
+            a tree (or of all the trees), read with a single ordered scan.
+        """
+        qset = get_result_class(cls).objects()
+        if tree_id is not None:
+            qset = qset.filter(tree_id=tree_id)
+        return nested_set_snapshot(
+            qset.only('tree_id', 'lft', 'rgt', 'depth').as_pymongo())
+
+    @classmethod
+    def get_tree_refs(cls, parent=None):
+        """
+        :returns: A generator of :class:`nested_set_ref` for the nodes of the
+            tree (or of the branch of ``parent``) in preorder.
+        """
+        return cls._get_refs(cls.get_tree(parent))
+
+    @classmethod
+    def _get_collection(cls):
+        """:returns: the collection, bound to the session of the current
+        transaction if there is one"""
+        collection = super(nested_set_tree, cls)._get_collection()
+        session = getattr(_write_state, 'session', None)
+        if session is None:
+            return collection
+        return _session_collection(collection, session)
+
+    @property
+    def _qs(self):
+        """The queryset of the saves, updates and deletes of the node, built
+        for every use on the collection of the current transaction."""
+        return QuerySet(self, self._get_collection())
+
+    @classmethod
+    def _get_versions_collection(cls):
+        cls = get_result_class(cls)
+        # the counters are shared right away, outside the transactions
+        collection = super(nested_set_tree, cls)._get_collection()
+        cached = cls.__dict__.get('_versions_collection')
+        if cached is None or cached[0] is not collection:
+            versions = collection.database[collection.name + '_versions']
+            cached = cls._versions_collection = (collection, versions)
+        return cached[1]
+
+    @classmethod
+    def _has_versions(cls):
+        return cls.nested_set_versions or cls.nested_set_optimistic
+
+    @classmethod
+    def drop_collection(cls):
+        if cls._has_versions():
+            get_result_class(cls)._get_versions_collection().drop()
+        super(nested_set_tree, cls).drop_collection()
+
+    @classmethod
+    def get_tree_version(cls, tree_id=0):
+        """
+        Reads the version counter of a tree (of the whole forest with
+        ``tree_id`` 0), creating it on first use.
+
+        Only a missing counter is written, so cached reads of a known tree
+        stay plain reads.
+
+        :returns: A dict with the ``version`` and the ``epoch`` of the
+            counter, an ObjectId that changes when the counters are dropped
+            with the collection.
+        """
+        versions = get_result_class(cls)._get_versions_collection()
+        version = versions.find_one({'_id': tree_id})
+        if version is None:
+            version = versions.find_one_and_update(
+                {'_id': tree_id},
+                {'$setOnInsert': {'version': 0, 'epoch': ObjectId()}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        return version
+
+    @classmethod
+    def _bump_versions(cls, tree_ids=None, from_tree_id=None):
+        """
+        Increases the version counters of the forest and of the trees
+        ``tree_ids`` (or of the trees from ``from_tree_id`` on, or of all the
+        trees). It must be called after the writes, so a reader never keeps
+        what it read under the new version. Only the existing counters
+        change: one that wasn't read yet has no reader to warn.
+        """
+        if cls._has_versions():
+            get_result_class(cls)._get_versions_collection().update_many(
+                cls._get_versions_query(tree_ids, from_tree_id),
+                {'$inc': {'version': 1}})
+
+    @staticmethod
+    def _get_versions_query(tree_ids=None, from_tree_id=None):
+        """:returns: the raw query of the counters :meth:`_bump_versions`
+        increases"""
+        if from_tree_id is not None:
+            return {'$or': [{'_id': 0}, {'_id': {'$gte': from_tree_id}}]}
+        if tree_ids is not None:
+            return {'_id': {'$in': [0] + sorted(set(tree_ids))}}
+        return {}
+
+    @classmethod
+    def _write_optimistic(cls, get_scope, refresh, write):
+        """
+        Runs the structural write ``write`` once the version counters of the
+        trees it changes (``get_scope()``) are claimed.
+
+        The counters are read first, then the nodes are refreshed with
+        ``refresh()``, and every counter is claimed (and increased) only if
+        it is still at the version read, so the write is computed from nodes
+        that no other writer changed since. The claims are renewed while the
+        write runs and released when it ends. A write that changes the forest
+        (moves or renumbers trees) claims the forest counter instead, which
+        excludes all the other writers while it runs. On a conflict the whole
+        attempt is retried after a random backoff, with freshly loaded nodes.
+
+        :raises TreeWriteConflict: When the write ran past the expiry of its
+            claims (a stalled process), so another writer may have changed
+            the same trees: check them with :meth:`find_problems`.
+        """
+        cls = get_result_class(cls)
+        versions = cls._get_versions_collection()
+        for attempt in range(cls.nested_set_retries + 1):
+            if attempt:
+                time.sleep(random.uniform(
+                    0, cls.nested_set_retry_delay * 2 ** min(attempt, 8)))
+            token = ObjectId()
+            claimed = cls._claim_versions(get_scope, refresh, token)
+            if claimed is None:
+                continue
+            stop = cls._keep_claims(claimed, token)
+            try:
+                result = write()
+            finally:
+                stop.set()
+                released = versions.update_many(
+                    {'_id': {'$in': claimed}, 'writer': token},
+                    {'$unset': {'writer': '', 'claimed': ''}})
+            if released.matched_count < len(claimed):
+                raise TreeWriteConflict(
+                    'Lost the claims of {} on trees {} while writing'.format(
+                        cls.__name__, claimed))
+            return result
+        raise TreeWriteConflict(
+            'Gave up writing to {} after {} conflicts'.format(
+                cls.__name__, cls.nested_set_retries + 1))
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """
+        Context manager that runs all the writes (and reads) of the nested
+        set models made in the block by the current thread in a single
+        transaction, committed at the end of the block, or aborted if it
+        raises. The block can't be retried, so the whole transaction fails
+        on a transient error: use :meth:`run_in_transaction` to retry it.
+        Nested blocks join the outer transaction.
+        """
+        session = getattr(_write_state, 'session', None)
+        if session is not None:
+            yield session
+            return
+        client = super(nested_set_tree, get_result_class(cls))._get_collection(
+            ).database.client
+        with client.start_session() as session:
+            session.start_transaction()
+            _write_state.session = session
+            try:
+                yield session
+            except BaseException:
+                _write_state.session = None
+                if session.in_transaction:
+                    session.abort_transaction()
+                raise
+            _write_state.session = None
+            cls._commit_transaction(session)
+
+    @classmethod
+    def run_in_transaction(cls, func, *args, **kwargs):
+        """
+        Calls ``func(*args, **kwargs)`` in a :meth:`transaction`, calling it
+        again in a new transaction when it fails with a transient error (up
+        to :attr:`nested_set_transaction_retries` times), so every batched
+        write commits once. ``func`` must reload the nodes it uses.
+
+        :returns: the result of ``func``
+        """
+        return cls._run_in_transaction(lambda: func(*args, **kwargs))
+
+    @classmethod
+    def _run_in_transaction(cls, func, refresh=None):
+        cls = get_result_class(cls)
+        if getattr(_write_state, 'session', None) is not None:
+            return func()
+        retries = cls.nested_set_transaction_retries
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(random.uniform(
+                    0, cls.nested_set_retry_delay * 2 ** min(attempt, 8)))
+                if refresh is not None:
+                    refresh()
+            try:
+                with cls.transaction():
+                    return func()
+            except PyMongoError as error:
+                if attempt == retries or not error.has_error_label(
+                        'TransientTransactionError'):
+                    raise
+
+    @classmethod
+    def _commit_transaction(cls, session):
+        retries = cls.nested_set_transaction_retries
+        for attempt in range(retries + 1):
+            try:
+                session.commit_transaction()
+                return
+            except PyMongoError as error:
+                if attempt == retries or not error.has_error_label(
+                        'UnknownTransactionCommitResult'):
+                    raise
+
+    @classmethod
+    def _get_server_time(cls):
+        """:returns: the (naive UTC) time of the server, which all the
+        writers share whatever the skew of their own clocks"""
+        admin = cls._get_versions_collection().database.client.admin
+        for command in ('hello', 'isMaster'):
+            try:
+                return admin.command(command)['localTime']
+            except OperationFailure:
+                # hello needs MongoDB 4.4.2
+                continue
+            except NotImplementedError:
+                # mongomock shares the clock of the process anyway
+                break
+        return datetime.utcnow()
+
+    @classmethod
+    def _keep_claims(cls, claimed, token):
+        """
+        Renews the claims of ``token`` on the counters ``claimed`` from a
+        background thread, every third of :attr:`nested_set_claim_timeout`.
+
+        :returns: The event that stops the renewals.
+        """
+        versions = cls._get_versions_collection()
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(cls.nested_set_claim_timeout / 3.0):
+                versions.update_many({'_id': {'$in': claimed}, 'writer': token},
+                                     {'$currentDate': {'claimed': True}})
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    @classmethod
+    def _claim_versions(cls, get_scope, refresh, token):
+        """:returns: the ids of the claimed counters, ``None`` on a
+        conflict"""
+        versions = cls._get_versions_collection()
+        expired = cls._get_server_time() - timedelta(
+            seconds=cls.nested_set_claim_timeout)
+        free = {'$or': [{'claimed': None}, {'claimed': {'$lt': expired}}]}
+        claim = {'$set': {'writer': token}, '$currentDate': {'claimed': True}}
+        release = lambda claimed: versions.update_many(
+            {'_id': {'$in': claimed}, 'writer': token},
+            {'$unset': {'writer': '', 'claimed': ''}})
+
+        scope = get_scope()
+        if scope is None:
+            cls.get_tree_version(0)
+            if not versions.update_one(dict(free, _id=0), claim).modified_count:
+                return None
+            # a tree writer claims its trees before checking the forest, so
+            # one of the two always sees the other
+            if versions.find_one({'_id': {'$ne': 0},
+                                  'claimed': {'$gt': expired}}) is not None:
+                release([0])
+                return None
+            refresh()
+            return [0]
+
+        expected = {}
+        for tree_id in sorted(scope):
+            doc = cls.get_tree_version(tree_id)
+            if doc.get('claimed') is not None and doc['claimed'] > expired:
+                return None
+            expected[tree_id] = doc['version']
+        refresh()
+        if get_scope() != scope:
+            return None
+        claimed = []
+        for tree_id, version in sorted(expected.items()):
+            query = dict(free, _id=tree_id, version=version)
+            if not versions.update_one(query, dict(claim, **{
+                    '$inc': {'version': 1}})).modified_count:
+                release(claimed)
+                return None
+            claimed.append(tree_id)
+        forest = versions.find_one({'_id': 0}) or {}
+        if forest.get('claimed') is not None and forest['claimed'] > expired:
+            release(claimed)
+            return None
+        return claimed
+
+    @classmethod
+    def _refresh_structure(cls, node):
+        """Reloads the structural fields of ``node``."""
+        son = get_result_class(cls).objects(pk=node.pk).only(
+            *cls._get_structure_fields()).as_pymongo().get()
+        for field in cls._get_structure_fields()[1:]:
+            setattr(node, field, son.get(field))
+
+    @classmethod
+    @_structural_write(_forest_scope)
     def add_root(cls, **kwargs):
         """Add root node to tree"""
         last_root = cls.get_last_root_node()
@@ -89,11 +734,7 @@ class nested_set_tree(Node):
         if last_root and last_root.node_order_by:
           return last_root.add_sibling('sorted-sibling', **kwargs)
 
-        if last_root:
-            newtree_id = last_root.tree_id + 1
-        else:
-            # add first root node
-            newtree_id = 1
+        newtree_id = cls._open_tree_gap()[0][0]
 
         if len(kwargs) == 1 and 'instance' in kwargs:
             newobj = kwargs['instance']
@@ -106,8 +747,11 @@ class nested_set_tree(Node):
         newobj.depth = 1
         newobj.tree_id = newtree_id
         newobj.lft = 1
-        newobj.rgt = 2
+        newobj.rgt = 1 + cls.nested_set_gap
+        if cls.nested_set_numchild:
+            newobj.numchild = 0
         newobj.save()
+        cls._bump_versions([newtree_id])
         return newobj
 
     @classmethod
@@ -116,14 +760,384 @@ class nested_set_tree(Node):
             lftop = 'gte'
         else:
             lftop = 'gt'
-        get_result_class(cls).objects(tree_id=tree_id, rgt__gte=rgt).update(inc__rgt=incdec)
-        get_result_class(cls).objects(tree_id=tree_id, rgt__gte=rgt, **{'lft__{}'.format(lftop):rgt}).update(inc__lft=incdec)
+        cls._update_range(
+            {'tree_id': tree_id, 'rgt__gte': rgt},
+            {'tree_id': tree_id, 'rgt__gte': rgt, 'lft__{}'.format(lftop): rgt},
+            '$' + lftop, rgt, incdec)
+
+    @classmethod
+    def _update_range(cls, rgt_filter, lft_filter, lftop, value, incdec):
+        """
+        Adds ``incdec`` to ``rgt`` in the nodes matching ``rgt_filter`` and to
+        ``lft`` in the ones matching ``lft_filter``, which must be the subset
+        of them with ``lft`` ``lftop`` ``value``.
+
+        Both shifts are done by a single pipeline update. Servers without
+        pipeline updates (MongoDB < 4.2) reject it before writing anything,
+        and get a single ordered bulk write with one update per field
+        instead, and :attr:`use_pipeline_updates` is disabled for the model.
+        Any other error is raised as is. With :attr:`nested_set_unique_lft` the
+        ``lft`` values are parked below zero before being shifted.
+        """
+        cls = get_result_class(cls)
+        rgt_query = cls.objects(**rgt_filter)._query
+        if cls.nested_set_unique_lft or not cls.use_pipeline_updates:
+            cls._get_collection().bulk_write(cls._get_range_requests(
+                rgt_query, cls.objects(**lft_filter)._query,
+                cls.objects(tree_id=lft_filter['tree_id'], lft__lt=0)._query,
+                incdec))
+            return
+        if cls.use_pipeline_updates:
+            pipeline = [{'$set': {
+                'rgt': {'$add': ['$rgt', incdec]},
+                'lft': {'$cond': [{lftop: ['$lft', value]},
+                                  {'$add': ['$lft', incdec]},
+                                  '$lft']}
+            }}]
+            try:
+                cls._get_collection().update_many(rgt_query, pipeline)
+                return
+            except (TypeError, ValueError):
+                # rejected by the driver, nothing was written
+                cls.use_pipeline_updates = False
+            except OperationFailure as exc:
+                # any other error may come after some of the nodes were
+                # shifted, so shifting them again would break the numbering
+                if isinstance(exc, WriteError) or \
+                        exc.code not in _pipeline_unsupported_codes:
+                    raise
+                cls.use_pipeline_updates = False
+        cls._get_collection().bulk_write(cls._get_range_requests(
+            rgt_query, cls.objects(**lft_filter)._query, None, incdec))
+
+    @classmethod
+    def _get_range_requests(cls, rgt_query, lft_query, parked_query, incdec):
+        """
+        :returns: The bulk write requests adding ``incdec`` to ``rgt`` in the
+            nodes matching ``rgt_query`` and to ``lft`` in the ones matching
+            ``lft_query``. With :attr:`nested_set_unique_lft` the ``lft``
+            values are parked below zero first, and moved back with
+            ``parked_query``, the raw query of the parked nodes of the tree.
+        """
+        if cls.nested_set_unique_lft:
+            return [
+                UpdateMany(rgt_query, {'$inc': {'rgt': incdec}}),
+                UpdateMany(lft_query, {'$inc': {'lft': -cls._parking_offset}}),
+                UpdateMany(parked_query,
+                           {'$inc': {'lft': cls._parking_offset + incdec}}),
+            ]
+        return [
+            UpdateMany(rgt_query, {'$inc': {'rgt': incdec}}),
+            UpdateMany(lft_query, {'$inc': {'lft': incdec}}),
+        ]
+
+    @classmethod
+    def _move_tree_right(cls, tree_id, count=1):
+        cls = get_result_class(cls)
+        if cls.nested_set_unique_lft:
+            cls.objects(tree_id__gte=tree_id).update(
+                inc__tree_id=-cls._parking_offset)
+            cls.objects(tree_id__lt=0).update(
+                inc__tree_id=cls._parking_offset + count)
+        else:
+            cls.objects(tree_id__gte=tree_id).update(inc__tree_id=count)
+        cls._bump_versions(from_tree_id=tree_id)
+
+    @classmethod
+    def _get_last_tree_id(cls):
+        """:returns: the biggest ``tree_id`` in use, 0 without nodes"""
+        return get_result_class(cls).objects.order_by('-tree_id').scalar(
+            'tree_id').first() or 0
+
+    @classmethod
+    def _open_tree_gap(cls, before=None, count=1):
+        """
+        Makes room for ``count`` new trees right before the tree ``before``,
+        or after the last tree.
+
+        In dense mode the trees from ``before`` are shifted ``count`` to the
+        right. With :attr:`nested_set_tree_gap` the free ids after the
+        previous tree are used when there are enough, otherwise the trees
+        from ``before`` are shifted (leaving ``nested_set_tree_gap`` spare
+        ids).
+
+        :returns: The ids of the new trees, and how much the trees from
+            ``before`` were shifted.
+        """
+        cls = get_result_class(cls)
+        gap = cls.nested_set_tree_gap
+        if before is None:
+            last = cls._get_last_tree_id()
+            return [last + gap * (i + 1) for i in range(count)], 0
+        if gap == 1:
+            cls._move_tree_right(before, count)
+            return list(range(before, before + count)), count
+
+        prev = cls.objects(tree_id__lt=before).order_by('-tree_id').scalar(
+            'tree_id').first() or 0
+        room = before - prev - 1
+        shift = 0
+        if room < count:
+            shift = count - room + gap
+            cls._move_tree_right(before, shift)
+            room += shift
+        return cls._spread_tree_ids(prev, room, count), shift
+
+    @classmethod
+    def _get_root_tree_id(cls, target, pos):
+        """:returns: the ``tree_id`` of the tree a new root at the
+        sibling position ``pos`` of the root ``target`` goes before, ``None``
+        after the last tree"""
+        cls = get_result_class(cls)
+        if pos == 'first-sibling':
+            return cls.get_first_root_node().tree_id
+        if pos == 'left':
+            return target.tree_id
+        if pos == 'right':
+            return cls.objects(tree_id__gt=target.tree_id).scalar(
+                'tree_id').first()
+        return None
+
+    @classmethod
+    def _spread_tree_ids(cls, prev, room, count):
+        """:returns: ``count`` tree ids spread in the ``room`` free ids
+        after ``prev``"""
+        step = max(1, min(cls.nested_set_tree_gap, (room + 1) // (count + 1)))
+        return [prev + step * (i + 1) for i in range(count)]
+
+    @classmethod
+    def _open_gap(cls, tree_id, pos, width):
+        """
+        Makes room for at least ``width`` numbers right before the ``lft`` or
+        ``rgt`` value ``pos`` of the tree.
+
+        In dense mode everything from ``pos`` is shifted ``width`` to the
+        right. With :attr:`nested_set_gap` the free interval before ``pos``
+        is used when it is wide enough, otherwise it is widened by shifting
+        the nodes from ``pos`` (leaving ``nested_set_gap`` spare numbers).
+
+        :returns: The ``(first, last)`` free numbers now available.
+        """
+        if cls.nested_set_gap == 1:
+            cls._move_right(tree_id, pos, True, width)
+            return pos, pos + width - 1
+
+        prev = cls._get_prev_number(tree_id, pos)
+        room = pos - prev - 1
+        if room < width:
+            shift = width - room + cls.nested_set_gap
+            cls._move_right(tree_id, pos, True, shift)
+            room += shift
+        return prev + 1, prev + room
+
+    @classmethod
+    def _get_prev_number(cls, tree_id, pos):
+        """:returns: the greatest ``lft`` or ``rgt`` value lower than ``pos``
+        in the tree (0 if there is none)"""
+        qset = get_result_class(cls).objects(tree_id=tree_id)
+        prev = [0]
+        for field in ('lft', 'rgt'):
+            value = qset.filter(**{'%s__lt' % field: pos}).order_by(
+                '-' + field).scalar(field).first()
+            if value is not None:
+                prev.append(value)
+        return max(prev)
+
+    @classmethod
+    def _get_leaf_bounds(cls, first, last):
+        """:returns: the ``(lft, rgt)`` of a new leaf in the free numbers
+        ``first``..``last``, keeping free numbers around and inside it"""
+        step = max(1, min(cls.nested_set_gap, (last - first + 2) // 3))
+        return first - 1 + step, first - 1 + 2 * step
 
     @classmethod
-    def _move_tree_right(cls, tree_id):
-        get_result_class(cls).objects(tree_id__gte=tree_id).update(inc__tree_id=1)
+    def _get_range_start(cls, first, last, width):
+        """:returns: the first number of a ``width`` wide range placed in the
+        free numbers ``first``..``last``"""
+        return first + min(cls.nested_set_gap - 1, (last - first + 1 - width) // 2)
+
+    @classmethod
+    @_structural_write(_fix_tree_scope)
+    def rebalance(cls, tree_id=None):
+        """
+        Renumbers the ``lft``/``rgt`` values of a tree (or of all the trees),
+        spreading them :attr:`nested_set_gap` apart. In dense mode this
+        closes any hole left in the numbering.
+        """
+        get_result_class(cls).fix_tree(tree_id)
+
+    @classmethod
+    def find_problems(cls, tree_id=None):
+        """
+        Checks the numbering of a tree (or of all the trees) in a single
+        ordered scan, keeping only the open branch in memory.
+
+        :returns: A tuple of five lists:
+
+            1. the pks of the nodes with an empty range (``lft >= rgt``)
+            2. the pks of the nodes whose range overlaps the range of one of
+               their ancestors without being inside it, or starts where
+               another range starts or ends
+            3. the pks of the nodes with a ``depth`` that doesn't match their
+               nesting
+            4. the pks of the nodes with a wrong ``numchild`` (always empty
+               without :attr:`nested_set_numchild`)
+            5. the ids of the trees with several top level nodes, without a
+               root at ``lft`` 1, or with holes in their numbering (in dense
+               mode)
+        """
+        cls = get_result_class(cls)
+        qset = cls.objects()
+        if tree_id is not None:
+            qset = qset.filter(tree_id=tree_id)
+        qset = qset.only(*cls._get_structure_fields()).as_pymongo()
+
+        bad_ranges, overlaps, wrong_depth, wrong_numchild = [], [], [], []
+        bad_trees = []
+        dense = cls.nested_set_gap == 1
+        # the last lft/rgt number seen in the tree, and the tree state
+        state = {'tree_id': None, 'last': 0, 'roots': 0, 'bad': False}
+
+        def number(value):
+            if value <= state['last'] or (dense and value != state['last'] + 1):
+                state['bad'] = True
+            state['last'] = max(state['last'], value)
+
+        def close():
+            node, numchild = stack.pop()
+            number(node['rgt'])
+            if cls.nested_set_numchild and node.get('numchild') != numchild:
+                wrong_numchild.append(node['_id'])
+
+        def end_tree():
+            while stack:
+                close()
+            if state['bad'] or state['roots'] > 1:
+                bad_trees.append(state['tree_id'])
+
+        # stack of [node, number of children] of the open nodes
+        stack = []
+        for node in qset:
+            lft, rgt = node['lft'], node['rgt']
+            if node['tree_id'] != state['tree_id']:
+                if state['tree_id'] is not None:
+                    end_tree()
+                state.update(tree_id=node['tree_id'], last=0, roots=0,
+                             bad=False)
+            if lft >= rgt:
+                bad_ranges.append(node['_id'])
+                continue
+            while stack and stack[-1][0]['rgt'] < lft:
+                close()
+            if lft <= state['last'] or (stack and rgt >= stack[-1][0]['rgt']):
+                overlaps.append(node['_id'])
+                continue
+            number(lft)
+            if node['depth'] != len(stack) + 1:
+                wrong_depth.append(node['_id'])
+            if stack:
+                stack[-1][1] += 1
+            else:
+                state['roots'] += 1
+                if lft != 1:
+                    state['bad'] = True
+            stack.append([node, 0])
+        if state['tree_id'] is not None:
+            end_tree()
+        return bad_ranges, overlaps, wrong_depth, wrong_numchild, bad_trees
 
+    @classmethod
+    @_structural_write(_fix_tree_scope)
+    def fix_tree(cls, tree_id=None):
+        """
+        Rebuilds the numbering of a tree (or of all the trees) from the order
+        of the ``lft`` values, in a single ordered scan, and writes the
+        changed nodes back with batched bulk writes. Fixing different trees
+        can run in parallel, unless a tree has to be split into new trees:
+        the optimistic writes then claim the whole forest.
+
+        Every node is placed below the open nodes whose range contains its
+        ``lft``: a range that ends after the range of its parent is cut, an
+        empty one becomes a leaf, and every extra top level node of a tree
+        starts a new tree after the last one. The ``lft``/``rgt`` values are
+        spread :attr:`nested_set_gap` apart, and ``depth`` (and
+        ``numchild``) are recomputed.
+        """
+        cls = get_result_class(cls)
+        qset = cls.objects()
+        if tree_id is not None:
+            qset = qset.filter(tree_id=tree_id)
+        qset = qset.only(*cls._get_structure_fields()).as_pymongo()
+        last_tree_id = cls._get_last_tree_id()
+        new_tree_ids = []
+
+        step = cls.nested_set_gap
+        requests = []
+        # the new lft values are parked below zero and moved back at the end
+        # when they must be unique
+        offset = cls._parking_offset if cls.nested_set_unique_lft else 0
+        counter = [1]
+
+        def close():
+            node, end, lft, depth, target, numchild = stack.pop()
+            values = {'tree_id': target, 'lft': lft, 'rgt': counter[0],
+                      'depth': depth}
+            if cls.nested_set_numchild:
+                values['numchild'] = numchild
+            changes = dict((field, value) for field, value in values.items()
+                           if node.get(field) != value)
+            if 'lft' in changes:
+                changes['lft'] -= offset
+            if changes:
+                requests.append(UpdateOne({'_id': node['_id']},
+                                          {'$set': changes}))
+            counter[0] += step
+            if len(requests) >= cls.nested_set_batch_size:
+                cls._get_collection().bulk_write(requests, ordered=False)
+                del requests[:]
+
+        # stack of [node, end of its range, new lft, new depth, new tree_id,
+        # number of children] of the open nodes of the current tree
+        stack = []
+        current = target = None
+        for node in qset:
+            lft = node['lft']
+            if node['tree_id'] != current:
+                while stack:
+                    close()
+                current = target = None
+            while stack and stack[-1][1] <= lft:
+                close()
+            if stack:
+                stack[-1][5] += 1
+            else:
+                if target is None:
+                    target = node['tree_id']
+                else:
+                    last_tree_id += cls.nested_set_tree_gap
+                    target = last_tree_id
+                    new_tree_ids.append(target)
+                current = node['tree_id']
+                counter[0] = 1
+            end = max(lft, node['rgt'])
+            if stack:
+                end = min(end, stack[-1][1])
+            stack.append([node, end, counter[0], len(stack) + 1, target, 0])
+            counter[0] += step
+        while stack:
+            close()
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+        if offset:
+            parked = cls.objects(lft__lt=0)
+            if tree_id is not None:
+                parked = parked.filter(tree_id__in=[tree_id] + new_tree_ids)
+            parked.update(inc__lft=offset)
+        cls._bump_versions(None if tree_id is None else [tree_id] + new_tree_ids)
+
+    @_structural_write(_node_scope, _self_node)
     def add_child(self, **kwargs):
+        self.invalidate_prefetch()
         if not self.is_leaf():
             if self.node_order_by:
                 pos = 'sorted-sibling'
@@ -133,37 +1147,32 @@ class nested_set_tree(Node):
             # last_child._cached_parend_obj self
             return last_child.add_sibling(pos, **kwargs)
 
-        # cls.objects(tree_id=self.tree_id, rgt__gte=self.rgt).update(inc__rgt=2)
-        self.__class__._move_right(self.tree_id, self.rgt, False, 2)
-        self.rgt += 2
+        newobj = self._new_node(kwargs)
 
-        if len(kwargs) == 1 and 'instance' in kwargs:
-            # adding the passed (unsaved) instance to the tree
-            newobj = kwargs['instance']
-            if newobj.pk:
-                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
-        else:
-            # creating a new object
-            newobj = get_result_class(self.__class__)(**kwargs)
+        first, last = self.__class__._open_gap(self.tree_id, self.rgt, 2)
+        self.rgt = last + 1
 
         newobj.tree_id = self.tree_id
         newobj.depth = self.depth + 1
-        newobj.lft = self.lft + 1
-        newobj.rgt = self.lft + 2
+        newobj.lft, newobj.rgt = self._get_leaf_bounds(first, last)
 
+        if self.nested_set_numchild:
+            newobj.numchild = 0
         newobj.save()
+        if self.nested_set_numchild:
+            get_result_class(self.__class__).objects(pk=self.pk).update_one(
+                inc__numchild=1)
+            self.numchild = (self.numchild or 0) + 1
+        self._bump_versions([self.tree_id])
 
         return newobj
 
+    @_structural_write(_sibling_scope, _self_node)
     def add_sibling(self, pos=None, **kwargs):
         pos = self._prepare_pos_var_for_add_sibling(pos)
+        self.invalidate_prefetch()
 
-        if len(kwargs) ==1 and 'instance' in kwargs:
-            newobj = kwargs['instance']
-            if newobj.pk:
-                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
-        else:
-            newobj = get_result_class(self.__class__)(**kwargs)
+        newobj = self._new_node(kwargs)
 
         newobj.depth = self.depth
 
@@ -171,7 +1180,7 @@ class nested_set_tree(Node):
 
         if target.is_root():
             newobj.lft = 1
-            newobj.rgt = 2
+            newobj.rgt = 1 + self.nested_set_gap
             if pos == 'sorted-sibling':
                 siblings = list(target.get_sorted_pos_queryset(target.get_siblings(), newobj))
                 if siblings:
@@ -179,20 +1188,8 @@ class nested_set_tree(Node):
                     target = siblings[0]
                 else:
                     pos = 'last-sibling'
-            last_root = target.__class__.get_last_root_node()
-            if ((pos == 'last-sibling') or 
-                (pos == 'right' and target == last_root)
-                ):
-                newobj.tree_id = last_root.tree_id + 1
-            else:
-                newpos = {
-                    'first-sibling': 1,
-                    'left': target.tree_id,
-                    'right': target.tree_id +1
-                }[pos]
-                # move tree right
-                target.__class__._move_tree_right(newpos)
-                newobj.tree_id = newpos
+            newobj.tree_id = self._open_tree_gap(
+                self._get_root_tree_id(target, pos))[0][0]
         else:
             newobj.tree_id = target.tree_id
 
@@ -205,7 +1202,7 @@ class nested_set_tree(Node):
                     pos = 'last-sibling'
 
             if pos in ('left', 'right', 'first-sibling'):
-                siblings = list(target.get_siblings())
+                siblings = list(self._project(target.get_siblings(), ()))
 
                 if pos == 'right':
                     if target == siblings[-1]:
@@ -225,28 +1222,195 @@ class nested_set_tree(Node):
                 elif pos == 'first-sibling':
                     target = siblings[0]
 
-            move_right = self.__class__._move_right
-
             if pos == 'last-sibling':
-                newpos = target.get_parent().rgt
-                move_right(target.tree_id, newpos, False, 2)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                move_right(target.tree_id, newpos - 1, False, 2)
-            elif pos == 'left':
+                newpos = target._get_parent_ref().rgt
+            else:
+                # first-sibling and left
                 newpos = target.lft
-                move_right(target.tree_id, newpos, True, 2)
 
-            newobj.lft = newpos
-            newobj.rgt = newpos + 1
+            first, last = self.__class__._open_gap(target.tree_id, newpos, 2)
+            newobj.lft, newobj.rgt = self._get_leaf_bounds(first, last)
 
+        if self.nested_set_numchild:
+            newobj.numchild = 0
         newobj.save()
+        if self.nested_set_numchild:
+            newobj._inc_parent_numchild(newobj.tree_id, newobj.lft, newobj.rgt,
+                                        newobj.depth, 1)
+        self._bump_versions([newobj.tree_id])
         return newobj
 
+    @_structural_write(_node_scope, _self_node)
+    def add_children(self, children, pos=None):
+        """
+        Adds many children to the node with one shift of the numbers per run
+        of adjacent new nodes (a single one without :attr:`node_order_by`)
+        and a single ``insert_many``.
+        """
+        pos = self._prepare_pos_var_for_add_children(pos)
+        self.invalidate_prefetch()
+        newobjs = [self._new_node(kwargs) for kwargs in children]
+        if not newobjs:
+            return []
+        if pos == 'last-child':
+            groups = [(self.rgt, newobjs)]
+        else:
+            siblings = list(self.get_children())
+            if pos == 'sorted-child':
+                groups = self._get_sorted_groups(
+                    [(sibling, sibling.lft) for sibling in siblings],
+                    self.rgt, newobjs)
+            else:
+                groups = [(siblings[0].lft if siblings else self.rgt,
+                           newobjs)]
+        shift = self._insert_leaves(self.tree_id, self.depth + 1, groups)
+        self.rgt += shift
+        if self.nested_set_numchild:
+            self.numchild = (self.numchild or 0) + len(newobjs)
+        return newobjs
+
+    @_structural_write(_sibling_scope, _self_node)
+    def add_siblings(self, siblings, pos=None):
+        """
+        Adds many siblings to the node with at most one shift of the numbers
+        (or of the following trees, for roots) per run of adjacent new nodes
+        (a single one without :attr:`node_order_by`) and a single
+        ``insert_many``.
+        """
+        pos = self._prepare_pos_var_for_add_sibling(pos)
+        cls = get_result_class(self.__class__)
+        self.invalidate_prefetch()
+        newobjs = [self._new_node(kwargs) for kwargs in siblings]
+        if not newobjs:
+            return []
+
+        if self.is_root():
+            if pos == 'sorted-sibling':
+                roots = list(cls.get_root_nodes())
+                end = roots[-1].tree_id + 1
+                groups = self._get_sorted_groups(
+                    [(root, root.tree_id) for root in roots], end, newobjs)
+            else:
+                end = None
+                groups = [(self._get_root_tree_id(self, pos), newobjs)]
+            shift = 0
+            for before, group in groups:
+                if before == end:
+                    before = None
+                else:
+                    before += shift
+                tree_ids, moved = cls._open_tree_gap(before, len(group))
+                shift += moved
+                for newobj, tree_id in zip(group, tree_ids):
+                    newobj.tree_id = tree_id
+                    newobj.depth = 1
+                    newobj.lft = 1
+                    newobj.rgt = 1 + cls.nested_set_gap
+            cls._insert_nodes(newobjs)
+            cls._bump_versions(newobj.tree_id for newobj in newobjs)
+            return newobjs
+
+        end = self._get_parent_ref().rgt
+        if pos == 'sorted-sibling':
+            groups = self._get_sorted_groups(
+                [(sibling, sibling.lft) for sibling in self.get_siblings()],
+                end, newobjs)
+        else:
+            if pos == 'first-sibling':
+                anchor = self.get_first_sibling().lft
+            elif pos == 'left':
+                anchor = self.lft
+            elif pos == 'right':
+                next_sibling = self.get_next_sibling()
+                anchor = next_sibling.lft if next_sibling else end
+            else:
+                anchor = end
+            groups = [(anchor, newobjs)]
+        self._insert_leaves(self.tree_id, self.depth, groups)
+        return newobjs
+
+    @classmethod
+    def _new_node(cls, kwargs):
+        """:returns: the unsaved node to add, built from the ``kwargs`` of
+        :meth:`add_child` or :meth:`add_sibling`"""
+        if len(kwargs) == 1 and 'instance' in kwargs:
+            newobj = kwargs['instance']
+            if newobj.pk:
+                raise NodeAlreadySaved("Attemped to add a tree node that is already exists")
+            return newobj
+        return get_result_class(cls)(**kwargs)
+
+    def _get_sorted_groups(self, siblings, end, newobjs):
+        """
+        :param siblings: the ``(node, position)`` of the existing siblings,
+            in order
+        :param end: the position after the last sibling
+        :returns: The ``(position, new nodes)`` runs of the ``newobjs`` in
+            :attr:`node_order_by` order, each one going right before the
+            existing node at ``position`` (or at ``end``), from left to right.
+        """
+        key = lambda node: [getattr(node, field)
+                            for field in self.node_order_by]
+        groups = {}
+        for newobj in sorted(newobjs, key=key):
+            # the first existing sibling that goes after the new node, like
+            # get_sorted_pos_queryset
+            position = next((position for sibling, position in siblings
+                             if key(sibling) > key(newobj)), end)
+            groups.setdefault(position, []).append(newobj)
+        return sorted(groups.items(), key=lambda group: group[0])
+
+    @classmethod
+    def _insert_leaves(cls, tree_id, depth, groups):
+        """
+        Inserts the runs of new leaves of ``groups``, the ``(number, new
+        nodes)`` placed right before the ``lft`` or ``rgt`` ``number`` of the
+        tree, from left to right.
+
+        :returns: how much the numbers after the last run were shifted
+        """
+        cls = get_result_class(cls)
+        newobjs = []
+        shift = 0
+        for number, group in groups:
+            number += shift
+            first, last = cls._open_gap(tree_id, number, 2 * len(group))
+            shift += last + 1 - number
+            step = max(1, min(cls.nested_set_gap,
+                              (last - first + 2) // (2 * len(group) + 1)))
+            for i, newobj in enumerate(group):
+                newobj.tree_id = tree_id
+                newobj.depth = depth
+                newobj.lft = first - 1 + (2 * i + 1) * step
+                newobj.rgt = newobj.lft + step
+            newobjs.extend(group)
+        cls._insert_nodes(newobjs)
+        if cls.nested_set_numchild:
+            newobj = newobjs[0]
+            cls._inc_parent_numchild(tree_id, newobj.lft, newobj.rgt, depth,
+                                     len(newobjs))
+        cls._bump_versions([tree_id])
+        return shift
+
+    @classmethod
+    def _insert_nodes(cls, newobjs):
+        """Saves the new nodes with a single ``insert_many``."""
+        for newobj in newobjs:
+            if cls.nested_set_numchild:
+                newobj.numchild = 0
+            newobj.validate()
+        get_result_class(cls).objects.insert(newobjs, load_bulk=False)
+        for newobj in newobjs:
+            newobj._created = False
+            newobj._clear_changed_fields()
+
+    @_structural_write(_move_scope, _move_nodes)
     def move(self, target, pos=None):
         pos = self._prepare_pos_var_for_move(pos)
         cls = get_result_class(self.__class__)
         parent = None
+        self.invalidate_prefetch()
+        target.invalidate_prefetch()
 
         if pos in ('first-child', 'last-child', 'sorted-child'):
             if target.is_leaf():
@@ -281,7 +1445,7 @@ class nested_set_tree(Node):
             else:
                 pos = 'last-sibling'
         if pos in ('left', 'right', 'first-sibling'):
-            siblings = list(target.get_siblings())
+            siblings = list(cls._project(target.get_siblings(), ()))
 
             if pos == 'right':
                 if target == siblings[-1]:
@@ -301,154 +1465,673 @@ class nested_set_tree(Node):
             if pos == 'first-sibling':
                 target = siblings[0]
 
-        move_right = cls._move_right
         gap = self.rgt - self.lft + 1
         target_tree = target.tree_id
 
         if pos == 'last-child':
-            newpos = parent.rgt
-            move_right(target.tree_id, newpos, False, gap)
+            first, last = cls._open_gap(target.tree_id, parent.rgt, gap)
+            newpos = cls._get_range_start(first, last, gap)
         elif target.is_root():
             newpos = 1
-            if pos == 'last-sibling':
-                target_tree = list(target.get_siblings())[-1].tree_id + 1
-            elif pos == 'first-sibling':
-                target_tree = 1
-                cls._move_tree_right(1)
-            elif pos == 'left':
-                cls._move_tree_right(target.tree_id)
+            target_tree = cls._open_tree_gap(
+                cls._get_root_tree_id(target, pos))[0][0]
         else:
             if pos == 'last-sibling':
-                newpos = target.get_parent().rgt
-                move_right(target.tree_id, newpos, False, gap)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                move_right(target.tree_id, newpos - 1, False, gap)
-            elif pos == 'left':
+                newpos = target._get_parent_ref().rgt
+            else:
+                # first-sibling and left
                 newpos = target.lft
-                move_right(target.tree_id, newpos, True, gap)
+            first, last = cls._open_gap(target.tree_id, newpos, gap)
+            newpos = cls._get_range_start(first, last, gap)
 
         # we reload 'self' because lft/rgt may have changed
 
-        fromobj = cls.objects.get(pk=self.pk)
+        fromobj = next(cls._get_refs(cls.objects(pk=self.pk)))
         depthdiff = target.depth - fromobj.depth
         if parent:
             depthdiff += 1
 
+        if cls.nested_set_numchild:
+            cls._inc_parent_numchild(fromobj.tree_id, fromobj.lft, fromobj.rgt,
+                                     fromobj.depth, -1)
         cls.objects(tree_id=fromobj.tree_id, lft__gte=fromobj.lft, lft__lte=fromobj.rgt).update(tree_id=target_tree, inc__depth=depthdiff, inc__lft=newpos-fromobj.lft, inc__rgt=newpos-fromobj.lft)
+        if cls.nested_set_numchild:
+            cls._inc_parent_numchild(target_tree, newpos,
+                                     newpos + fromobj.rgt - fromobj.lft,
+                                     fromobj.depth + depthdiff, 1)
 
         cls._get_close_gap(fromobj.lft, fromobj.rgt,  fromobj.tree_id)
+        cls._bump_versions([fromobj.tree_id, target_tree])
+
+    @classmethod
+    @_structural_write(_move_many_scope, _move_many_nodes)
+    def move_many(cls, moves):
+        """
+        Moves many nodes, like calling :meth:`move` with every
+        ``(node, target, pos)`` of ``moves`` in order.
+
+        The moves below the roots are planned in memory, on a copy of the
+        trees they change, and the final numbering is written with one bulk
+        write per tree (a single one for all the trees with
+        :attr:`nested_set_unique_lft`, so the parked values never clash).
+        The moves of roots, or to the root level, renumber the trees, so they
+        run one by one with :meth:`move` between the planned ones.
+        """
+        cls = get_result_class(cls)
+        planned = []
+        stale = False
+        for node, target, pos in moves:
+            if stale:
+                cls._refresh_structure(node)
+                cls._refresh_structure(target)
+            pos = node._prepare_pos_var_for_move(pos)
+            if _move_scope(node, target, pos) is None:
+                # the planned moves are written first, so the numbers of the
+                # nodes are read again after them
+                cls._apply_moves(planned)
+                planned = []
+                cls._refresh_structure(node)
+                cls._refresh_structure(target)
+                node.move(target, pos)
+                stale = True
+            else:
+                planned.append((node, target, pos))
+        cls._apply_moves(planned)
+
+    @classmethod
+    def _apply_moves(cls, moves):
+        """
+        Applies ``moves`` (none of them from or to the root level) to an
+        in-memory copy of their trees, and writes the changed numbers.
+        """
+        if not moves:
+            return
+        tree_ids = sorted(set(node.tree_id for move in moves
+                              for node in move[:2]))
+        qset = cls.objects(tree_id__in=tree_ids).only(
+            *(cls._get_structure_fields() + list(cls.node_order_by or ())))
+        order_fields = [cls._fields[field].db_field
+                        for field in cls.node_order_by or ()]
+        key = lambda node: [node.son.get(field) for field in order_fields]
+
+        nodes = {}
+        roots = []
+        parent = None
+        for son in qset.as_pymongo():
+            while parent is not None and (
+                    parent.son['tree_id'] != son['tree_id'] or
+                    parent.son['rgt'] < son['lft']):
+                parent = parent.parent
+            node = _planned_node(son, parent)
+            (roots if parent is None else parent.children).append(node)
+            nodes[son['_id']] = node
+            parent = node
+
+        error = None
+        for node, target, pos in moves:
+            node, target = nodes[node.pk], nodes[target.pk]
+            child_pos = pos in ('first-child', 'last-child', 'sorted-child')
+            ancestor = target
+            while ancestor is not None and ancestor is not node:
+                ancestor = ancestor.parent
+            if ancestor is node and (target is not node or child_pos):
+                # the moves before it are still written
+                error = InvalidMoveToDescendant(
+                    "Can't move node to a descendant.")
+                break
+            if target is node and pos in ('left', 'right'):
+                continue
+            parent = target if child_pos else target.parent
+            node.parent.children.remove(node)
+            siblings = parent.children
+            if pos in ('first-child', 'first-sibling'):
+                i = 0
+            elif pos in ('left', 'right'):
+                i = siblings.index(target) + (pos == 'right')
+            elif pos in ('sorted-child', 'sorted-sibling'):
+                i = next((i for i, sibling in enumerate(siblings)
+                          if key(sibling) > key(node)), len(siblings))
+            else:
+                i = len(siblings)
+            siblings.insert(i, node)
+            node.parent = parent
+
+        step = cls.nested_set_gap
+        # the changed lft values are parked below zero and moved back at the
+        # end when they must be unique
+        offset = cls._parking_offset if cls.nested_set_unique_lft else 0
+        requests = dict((tree_id, []) for tree_id in tree_ids)
+        for root in roots:
+            tree_id = root.son['tree_id']
+            counter = 1
+            # stack of [node, depth, new lft] of the nodes to number, the
+            # lft is set once their children are on top of them
+            stack = [[root, 1, None]]
+            while stack:
+                item = stack[-1]
+                node, depth, lft = item
+                if lft is None:
+                    item[2] = counter
+                    counter += step
+                    stack.extend([child, depth + 1, None]
+                                 for child in reversed(node.children))
+                    continue
+                stack.pop()
+                values = {'tree_id': tree_id, 'lft': lft, 'rgt': counter,
+                          'depth': depth}
+                counter += step
+                if cls.nested_set_numchild:
+                    values['numchild'] = len(node.children)
+                changes = dict((field, value) for field, value
+                               in values.items()
+                               if node.son.get(field) != value)
+                if offset and ('lft' in changes or 'tree_id' in changes):
+                    changes['lft'] = lft - offset
+                if changes:
+                    requests[tree_id].append(UpdateOne(
+                        {'_id': node.son['_id']}, {'$set': changes}))
+                node.son.update(values)
+
+        collection = cls._get_collection()
+        if offset:
+            batch = [request for tree_id in tree_ids
+                     for request in requests[tree_id]]
+            if batch:
+                batch.append(UpdateMany(
+                    cls.objects(tree_id__in=tree_ids, lft__lt=0)._query,
+                    {'$inc': {'lft': offset}}))
+                collection.bulk_write(batch)
+        else:
+            for tree_id in tree_ids:
+                if requests[tree_id]:
+                    collection.bulk_write(requests[tree_id], ordered=False)
+        cls._bump_versions(tree_ids)
+
+        for move in moves:
+            for node in move[:2]:
+                son = nodes[node.pk].son
+                for field in cls._get_structure_fields()[1:]:
+                    setattr(node, field, son.get(field))
+                node.invalidate_prefetch()
+        if error is not None:
+            raise error
+
+    @classmethod
+    def _get_parent_query(cls, tree_id, lft, rgt, depth):
+        """:returns: the raw query of the parent of the node with these
+        numbers"""
+        return get_result_class(cls).objects(
+            tree_id=tree_id, depth=depth - 1, lft__lt=lft, rgt__gt=rgt)._query
+
+    @classmethod
+    def _inc_parent_numchild(cls, tree_id, lft, rgt, depth, inc):
+        if depth > 1:
+            get_result_class(cls)._get_collection().update_one(
+                cls._get_parent_query(tree_id, lft, rgt, depth),
+                {'$inc': {'numchild': inc}})
+
+    @classmethod
+    def _dec_parents_numchild(cls, ranges):
+        """Takes the (topmost) removed ``(tree_id, lft, rgt)`` ranges off
+        the ``numchild`` of their parents."""
+        cls = get_result_class(cls)
+        size = cls.nested_set_batch_size
+        for i in range(0, len(ranges), size):
+            tops = cls.objects(__raw__={'$or': [
+                {'tree_id': tree_id, 'lft': lft}
+                for tree_id, lft, rgt in ranges[i:i + size]
+            ]}).only('tree_id', 'lft', 'rgt', 'depth').as_pymongo()
+            requests = [
+                UpdateOne(cls._get_parent_query(node['tree_id'], node['lft'],
+                                                node['rgt'], node['depth']),
+                          {'$inc': {'numchild': -1}})
+                for node in tops if node['depth'] > 1]
+            if requests:
+                cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    @_structural_write(_tree_scope)
+    def recompute_numchild(cls, tree_id=None):
+        """
+        Rebuilds the ``numchild`` values of a tree (or of all the trees) from
+        the numbering, in a single ordered scan.
+        """
+        cls = get_result_class(cls)
+        qset = cls.objects()
+        if tree_id is not None:
+            qset = qset.filter(tree_id=tree_id)
+        qset = qset.only('tree_id', 'lft', 'rgt', 'numchild').as_pymongo()
+
+        requests = []
+
+        def close(item):
+            node, numchild = item
+            if node.get('numchild') != numchild:
+                requests.append(UpdateOne({'_id': node['_id']},
+                                          {'$set': {'numchild': numchild}}))
+            if len(requests) >= cls.nested_set_batch_size:
+                cls._get_collection().bulk_write(requests, ordered=False)
+                del requests[:]
+
+        # stack of [node, number of children] of the open nodes
+        stack = []
+        for node in qset:
+            while stack and (stack[-1][0]['tree_id'] != node['tree_id'] or
+                             stack[-1][0]['rgt'] < node['lft']):
+                close(stack.pop())
+            if stack:
+                stack[-1][1] += 1
+            stack.append([node, 0])
+        while stack:
+            close(stack.pop())
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+        cls._bump_versions(None if tree_id is None else [tree_id])
 
     @classmethod
     def _get_close_gap(cls, drop_lft, drop_rgt, tree_id):
+        if cls.nested_set_gap > 1:
+            # the freed numbers are reused by the next inserts
+            return
         gapsize = drop_rgt - drop_lft + 1
-        get_result_class(cls).objects(tree_id=tree_id, rgt__gt=drop_lft).update(dec__rgt=gapsize)
-        get_result_class(cls).objects(tree_id=tree_id, lft__gt=drop_lft).update(dec__lft=gapsize)
+        cls._update_range(
+            {'tree_id': tree_id, 'rgt__gt': drop_lft},
+            {'tree_id': tree_id, 'lft__gt': drop_lft},
+            '$gt', drop_lft, -gapsize)
 
     @classmethod
-    def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
-        """Loads a list/dictionary structure to the tree."""
+    def _close_gaps(cls, ranges):
+        """
+        Closes the gaps left by the removed (disjoint) ``(tree_id, lft,
+        rgt)`` ranges, with one bulk write per tree.
 
+        The numbers between two consecutive gaps of a tree are shifted left
+        by the total width of the gaps before them. The intervals are
+        shifted from the left, so the moved numbers only land in intervals
+        that are already done.
+        """
         cls = get_result_class(cls)
+        if cls.nested_set_gap > 1:
+            return
+        trees = {}
+        for tree_id, drop_lft, drop_rgt in sorted(ranges):
+            trees.setdefault(tree_id, []).append((drop_lft, drop_rgt))
+
+        # with a unique lft the shifted values are parked below zero
+        offset = cls._parking_offset if cls.nested_set_unique_lft else 0
+        for tree_id, gaps in trees.items():
+            if len(gaps) == 1:
+                cls._get_close_gap(gaps[0][0], gaps[0][1], tree_id)
+                continue
+            requests = []
+            shift = 0
+            for i, (drop_lft, drop_rgt) in enumerate(gaps):
+                shift += drop_rgt - drop_lft + 1
+                for field in ('lft', 'rgt'):
+                    interval = {field + '__gt': drop_rgt}
+                    if i + 1 < len(gaps):
+                        interval[field + '__lt'] = gaps[i + 1][0]
+                    inc = -shift - offset if field == 'lft' else -shift
+                    requests.append(UpdateMany(
+                        cls.objects(tree_id=tree_id, **interval)._query,
+                        {'$inc': {field: inc}}))
+            if offset:
+                requests.append(UpdateMany(
+                    cls.objects(tree_id=tree_id, lft__lt=0)._query,
+                    {'$inc': {'lft': offset}}))
+            cls._get_collection().bulk_write(requests)
+
+    @classmethod
+    @_structural_write(_load_bulk_scope, _load_bulk_nodes)
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False,
+                  fetch_foreign_keys=True):
+        """Loads a list/dictionary structure to the tree.
+
+        The ``lft``/``rgt``/``depth``/``tree_id`` values of the whole
+        structure are computed in memory, the target range is shifted once
+        and all the nodes are written with a single batched insert.
+        """
+
+        cls = get_result_class(cls)
+
+        if cls.node_order_by:
+            # every node must be placed in its sorted position among the
+            # existing siblings, so use the node by node insertion
+            return super(nested_set_tree, cls).load_bulk(
+                bulk_data, parent, keep_ids, fetch_foreign_keys)
+
+        step = cls.nested_set_gap
+        if parent:
+            tree_id = parent.tree_id
+            depth = parent.depth + 1
+        else:
+            tree_id = cls._open_tree_gap()[0][0]
+            depth = 1
+
+        newobjs = cls._get_bulk_nodes(bulk_data, tree_id, depth, 1, step,
+                                      bool(parent), keep_ids,
+                                      fetch_foreign_keys)
+        if not newobjs:
+            return []
+
+        if parent:
+            width = (2 * len(newobjs) - 1) * step + 1
+            first, last = cls._open_gap(parent.tree_id, parent.rgt, width)
+            parent.rgt = last + 1
+            if cls.nested_set_numchild:
+                cls.objects(pk=parent.pk).update_one(
+                    inc__numchild=len(bulk_data))
+                parent.numchild = (parent.numchild or 0) + len(bulk_data)
+            offset = cls._get_range_start(first, last, width) - 1
+            for newobj in newobjs:
+                newobj.lft += offset
+                newobj.rgt += offset
+
+        for newobj in newobjs:
+            newobj.validate()
+        ids = cls.objects.insert(newobjs, load_bulk=False)
+        cls._bump_versions(range(tree_id, newobjs[-1].tree_id + 1))
+        return ids
 
-        # tree, iterative preorder
-        added = []
-        # stack of nodes to analyze
-        stack = [(parent, node) for node in bulk_data[::-1]]
+    @classmethod
+    def _get_bulk_nodes(cls, bulk_data, tree_id, depth, lft, step, in_tree,
+                        keep_ids, fetch_foreign_keys=True):
+        """
+        Builds the (unsaved) node objects of a load_bulk structure in
+        preorder, numbering them in a single traversal.
+
+        :param step:
+            Difference between two consecutive ``lft``/``rgt`` numbers.
+        :param in_tree:
+            If ``True`` the first level of the structure is numbered
+            consecutively inside ``tree_id`` starting at ``lft``, otherwise
+            every node of the first level starts a new tree.
+        """
         foreign_keys = cls.get_foreign_keys()
+        resolved = cls._get_foreign_keys_objects(
+            foreign_keys, bulk_data, fetch_foreign_keys)
+        newobjs = []
+        counter = lft
+        # stack of (node structure, depth) to open, or (node object, None)
+        # to close once all its descendants have been numbered
+        stack = [(node, depth) for node in bulk_data[::-1]]
 
         while stack:
-            parent, node_struct = stack.pop()
+            item, node_depth = stack.pop()
+            if node_depth is None:
+                item.rgt = counter
+                counter += step
+                if not in_tree and item.depth == depth:
+                    tree_id += cls.nested_set_tree_gap
+                    counter = lft
+                continue
+
             # shallow copy of the data structure so it doesn't persist...
-            node_data = node_struct['data'].copy()
-            cls._process_foreign_keys(foreign_keys, node_data)
+            node_data = item['data'].copy()
+            cls._process_foreign_keys(foreign_keys, node_data, resolved)
             if keep_ids:
-                node_data['id'] = node_struct['id']
-            if parent:
-                node_obj = parent.add_child(**node_data)
-            else:
-                node_obj = cls.add_root(**node_data)
-            added.append(node_obj.pk)
-            if 'children' in node_struct:
-                # extending the stack with the current node as the parent of
-                # the new nodes
-                stack.extend([
-                    (node_obj, node)
-                    for node in node_struct['children'][::-1]
-                ])
-        return added
-
-    def get_children(self):
-        return self.get_descendants().filter(depth=self.depth + 1)
+                node_data['id'] = item['id']
+            newobj = cls(**node_data)
+            newobj.tree_id = tree_id
+            newobj.depth = node_depth
+            newobj.lft = counter
+            if cls.nested_set_numchild:
+                newobj.numchild = len(item.get('children', []))
+            counter += step
+            newobjs.append(newobj)
+
+            stack.append((newobj, None))
+            stack.extend([
+                (node, node_depth + 1)
+                for node in item.get('children', [])[::-1]
+            ])
+        return newobjs
+
+    def delete(self):
+        self.invalidate_prefetch()
+        super(nested_set_tree, self).delete()
+
+    def get_children(self, only=None):
+        children = self._get_prefetched('_prefetch_children')
+        if children is not _missing:
+            return list(children)
+        return self.get_descendants(only).filter(depth=self.depth + 1)
+
+    def get_children_count(self):
+        children = self._get_prefetched('_prefetch_children')
+        if children is not _missing:
+            return len(children)
+        if self.nested_set_numchild:
+            return self.numchild
+        return super(nested_set_tree, self).get_children_count()
+
+    def get_first_child(self):
+        children = self._get_prefetched('_prefetch_children')
+        if children is not _missing:
+            return children[0] if children else None
+        if self.is_leaf():
+            return None
+        # the first child is the next node in preorder
+        return get_result_class(self.__class__).objects(
+            tree_id=self.tree_id, lft__gt=self.lft).first()
+
+    def get_last_child(self):
+        children = self._get_prefetched('_prefetch_children')
+        if children is not _missing:
+            return children[-1] if children else None
+        if self.is_leaf():
+            return None
+        # the last child closes right before the node
+        return get_result_class(self.__class__).objects(
+            tree_id=self.tree_id, rgt__gt=self.lft, rgt__lt=self.rgt
+        ).order_by('-rgt').first()
+
+    def is_child_of(self, node):
+        return self.is_descendant_of(node) and self.depth == node.depth + 1
+
+    def is_sibling_of(self, node):
+        siblings = self.get_siblings()
+        if isinstance(siblings, list):
+            return any(sibling.pk == node.pk for sibling in siblings)
+        return super(nested_set_tree, self).is_sibling_of(node)
 
     def get_depth(self):
         return self.depth
 
     def is_leaf(self):
+        children = self._get_prefetched('_prefetch_children')
+        if children is not _missing:
+            return not children
+        if self.nested_set_numchild:
+            return not self.numchild
+        if self.nested_set_gap > 1:
+            return get_result_class(self.__class__).objects(
+                tree_id=self.tree_id, lft__gt=self.lft, lft__lt=self.rgt
+            ).only('id').first() is None
         return self.rgt - self.lft == 1
 
     def get_root(self):
         if self.lft == 1:
             return self
+        node = self
+        parent = self._get_prefetched('_prefetch_parent')
+        while parent is not _missing:
+            if parent is None:
+                return node
+            node = parent
+            parent = node._get_prefetched('_prefetch_parent')
         return get_result_class(self.__class__).objects.get(tree_id=self.tree_id, lft=1)
 
     def is_root(self):
         return self.lft == 1
 
     def get_siblings(self):
+        parent = self._get_prefetched('_prefetch_parent')
+        if parent is not None and parent is not _missing:
+            return parent.get_children()
         if self.lft == 1:
+            if parent is None and self._prefetch.roots is not None:
+                return list(self._prefetch.roots)
             return self.get_root_nodes()
         return self.get_parent(True).get_children()
 
     @classmethod
     def dump_bulk(cls, parent=None, keep_ids=True):
         """Dumps a tree branch to a python data structure."""
-        qset = cls._get_serializable_model().get_tree(parent)
-        ret, lnk = [], {}
-        for pyobj in qset:
-            serobj = pyobj.to_mongo()
-            serobj['pk'] = serobj['_id']
-            fields = {k: serobj[k] for k in serobj if k not in ['pk', '_id', '_cls', 'lft', 'rgt', 'tree_id', 'depth']}
-            depth = serobj['depth']
+        return list(cls.iter_dump_bulk(parent, keep_ids))
+
+    @classmethod
+    def iter_dump_bulk(cls, parent=None, keep_ids=True):
+        """
+        Generator version of :meth:`dump_bulk`: yields every top level branch
+        of the dump as soon as it is complete.
 
+        The parent links are rebuilt from the ``lft``/``rgt`` ordering of a
+        single cursor, so only the branch being built is kept in memory.
+        """
+        qset = cls._get_serializable_model().get_tree(parent).as_pymongo()
+        # stack of (tree_id, rgt, serialized node) of the open branch
+        stack = []
+        for serobj in qset:
+            tree_id, lft = serobj['tree_id'], serobj['lft']
+            while stack and (stack[-1][0] != tree_id or stack[-1][1] < lft):
+                closed = stack.pop()
+                if not stack:
+                    yield closed[2]
+
+            fields = {k: serobj[k] for k in serobj if k not in ['_id', '_cls', 'lft', 'rgt', 'tree_id', 'depth', 'numchild']}
             newobj = {'data': fields}
             if keep_ids:
-                newobj['id'] = serobj['pk']
+                newobj['id'] = serobj['_id']
 
-            if (not parent and depth == 1) or\
-               (parent and depth == parent.depth):
-                ret.append(newobj)
-            else:
-                parentobj = pyobj.get_parent()
-                parentser = lnk[parentobj.pk]
+            if stack:
+                parentser = stack[-1][2]
                 if 'children' not in parentser:
                     parentser['children'] = []
                 parentser['children'].append(newobj)
-            lnk[pyobj.pk] = newobj
-        return ret
+            stack.append((tree_id, serobj['rgt'], newobj))
+        if stack:
+            yield stack[0][2]
 
     @classmethod
-    def get_tree(cls, parent=None):
+    def get_tree(cls, parent=None, prefetch=False, only=None):
+        """
+        :param only: names of the fields to load (the structural fields are
+            always loaded), as in ``QuerySet.only``.
+        :param prefetch: if ``True`` a list of the nodes is returned, linked
+            to each other so :meth:`get_parent`, :meth:`get_root`,
+            :meth:`get_siblings`, :meth:`get_children` and the methods based
+            on them answer from memory (with lists instead of querysets),
+            until one of the nodes is changed by :meth:`add_child`,
+            :meth:`add_sibling`, :meth:`move` or :meth:`delete`, or
+            :meth:`invalidate_prefetch` is called.
+        """
         cls = get_result_class(cls)
         if parent is None:
-            return cls.objects()
-        if parent.is_leaf():
-            return cls.objects.filter(pk=parent.pk)
-        return cls.objects(__raw__={"$and": [{"tree_id": parent.tree_id}, {"lft": {"$gte": parent.lft, "$lte": parent.rgt - 1}}]})
-
-    def get_descendants(self):
-        if self.is_leaf():
+            qset = cls.objects()
+        elif cls.nested_set_gap == 1 and parent.is_leaf():
+            qset = cls.objects.filter(pk=parent.pk)
+        else:
+            qset = cls.objects(__raw__={"$and": [{"tree_id": parent.tree_id}, {"lft": {"$gte": parent.lft, "$lte": parent.rgt - 1}}]})
+        qset = cls._project(qset, only)
+        if not prefetch:
+            return qset
+
+        nodes = list(qset)
+        state = nested_set_prefetch([] if parent is None else None)
+        stack = []
+        for node in nodes:
+            while stack and (stack[-1].tree_id != node.tree_id or
+                             stack[-1].rgt < node.lft):
+                stack.pop()
+            node._prefetch = state
+            node._prefetch_children = []
+            if stack:
+                node._prefetch_parent = stack[-1]
+                stack[-1]._prefetch_children.append(node)
+            elif node.lft == 1:
+                node._prefetch_parent = None
+                if state.roots is not None:
+                    state.roots.append(node)
+            stack.append(node)
+        return nodes
+
+    def _get_prefetched(self, name):
+        """:returns: the prefetched ``name`` link of the node, or
+        ``_missing`` when it wasn't loaded or was invalidated"""
+        state = self.__dict__.get('_prefetch')
+        if state is None or not state.valid:
+            return _missing
+        return self.__dict__.get(name, _missing)
+
+    def invalidate_prefetch(self):
+        """Makes all the nodes prefetched with this one query the database
+        again."""
+        state = self.__dict__.get('_prefetch')
+        if state is not None:
+            state.valid = False
+
+    def get_descendants(self, only=None):
+        if self.nested_set_gap == 1 and self.is_leaf():
             return get_result_class(self.__class__).objects().none()
-        return self.__class__.get_tree(self).filter(pk__ne=self.pk)
+        return self.__class__.get_tree(self, only=only).filter(pk__ne=self.pk)
 
     def get_descendant_count(self):
         """:returns: the number of descendants of a node."""
-        return (self.rgt - self.lft - 1) / 2
+        if self.nested_set_gap > 1:
+            return self.get_descendants().count()
+        return (self.rgt - self.lft - 1) // 2
 
-    def get_ancestors(self):
+    @classmethod
+    def get_descendants_group_count(cls, parent=None, **filters):
+        """
+        Same as :meth:`Node.get_descendants_group_count`, with the counts of
+        all the siblings computed by a single aggregation (or from the
+        numbering in dense mode without ``filters``).
+        """
+        cls = get_result_class(cls)
+        if parent is None:
+            nodes = list(cls.get_root_nodes())
+        else:
+            nodes = list(parent.get_children())
+        if not filters and cls.nested_set_gap == 1:
+            for node in nodes:
+                node.descendants_count = (node.rgt - node.lft - 1) // 2
+            return nodes
+
+        counts = {}
+        if nodes:
+            if parent is None:
+                # every node below a root has the tree_id of the root
+                query = {'lft': {'$gt': 1}}
+                group = {'$group': {'_id': '$tree_id',
+                                    'count': {'$sum': 1}}}
+                key = 'tree_id'
+            else:
+                # the siblings are sorted and disjoint, so their lft values
+                # are the bucket boundaries of their descendants
+                query = {'tree_id': parent.tree_id,
+                         'lft': {'$gt': parent.lft, '$lt': parent.rgt},
+                         'depth': {'$gt': parent.depth + 1}}
+                group = {'$bucket': {
+                    'groupBy': '$lft',
+                    'boundaries': [node.lft for node in nodes] + [nodes[-1].rgt],
+                    'output': {'count': {'$sum': 1}}}}
+                key = 'lft'
+            pipeline = [
+                {'$match': {'$and': [query, cls.objects(**filters)._query]}},
+                group
+            ]
+            for result in cls._get_collection().aggregate(pipeline):
+                counts[result['_id']] = result['count']
+        for node in nodes:
+            node.descendants_count = counts.get(getattr(node, key), 0)
+        return nodes
+
+    def get_ancestors(self, only=None):
         if self.is_root():
             return get_result_class(self.__class__).objects().none()
-        return get_result_class(self.__class__).objects.filter(tree_id=self.tree_id, lft__lt=self.lft, rgt__gt=self.rgt)
+        return self._project(get_result_class(self.__class__).objects.filter(tree_id=self.tree_id, lft__lt=self.lft, rgt__gt=self.rgt), only)
 
     def is_descendant_of(self, node):
         """
@@ -464,9 +2147,23 @@ class nested_set_tree(Node):
     def get_parent(self, update=False):
         if self.is_root():
             return
+        parent = self._get_prefetched('_prefetch_parent')
+        if parent is not _missing:
+            return parent
+
+        return get_result_class(self.__class__).objects(
+            __raw__=self._get_parent_query(self.tree_id, self.lft, self.rgt,
+                                           self.depth)).first()
 
-        return list(self.get_ancestors())[-1]
+    def _get_parent_ref(self):
+        return next(self._get_refs(get_result_class(self.__class__).objects(
+            __raw__=self._get_parent_query(self.tree_id, self.lft, self.rgt,
+                                           self.depth))))
 
     @classmethod
     def get_root_nodes(cls):
         return get_result_class(cls).objects.filter(lft=1)
+
+    @classmethod
+    def get_last_root_node(cls):
+        return cls.get_root_nodes().order_by('-tree_id').first()
@@ -0,0 +1,158 @@
+from array import array
+from bisect import bisect_left
+
+
+class nested_set_snapshot(object):
+    """
+    Read only copy of the structure of nested set trees, kept in parallel
+    arrays (``tree_ids``, ``lfts``, ``rgts``, ``depths`` and ``parents``,
+    the index of the parent of every node or -1) in ``(tree_id, lft)``
+    order, plus the list of the ``pks``.
+
+    A node is located by bisecting its ``lft`` in the slice of its tree, so
+    every query takes O(log n), except the ones walking the ancestors,
+    which take O(depth). Nothing changes after it is built, so a snapshot
+    can be shared by any number of threads. The arrays support the buffer
+    protocol, so they can be wrapped without copies, e.g. with
+    ``numpy.frombuffer(snapshot.lfts, dtype='int64')``.
+
+    The nodes given to the methods can be any object with the ``tree_id``
+    and ``lft`` of a node of the snapshot (a node, a
+    :class:`~mongotree.tree.nested_set.nested_set_ref`...), and the nodes
+    returned are pks.
+    """
+
+    def __init__(self, nodes):
+        """
+        :param nodes: the raw ``_id``, ``tree_id``, ``lft``, ``rgt`` and
+            ``depth`` of the nodes, in ``(tree_id, lft)`` order
+        """
+        self.pks = []
+        self.tree_ids = array('q')
+        self.lfts = array('q')
+        self.rgts = array('q')
+        self.depths = array('i')
+        self.parents = array('q')
+        #: ``tree_id: (first index, last index + 1)`` of every tree.
+        self.trees = {}
+
+        # stack of the indexes of the open nodes of the current tree
+        stack = []
+        start = 0
+        for i, node in enumerate(nodes):
+            tree_id, lft = node['tree_id'], node['lft']
+            if i and self.tree_ids[-1] != tree_id:
+                self.trees[self.tree_ids[-1]] = (start, i)
+                start = i
+                del stack[:]
+            while stack and self.rgts[stack[-1]] < lft:
+                stack.pop()
+            self.pks.append(node['_id'])
+            self.tree_ids.append(tree_id)
+            self.lfts.append(lft)
+            self.rgts.append(node['rgt'])
+            self.depths.append(node['depth'])
+            self.parents.append(stack[-1] if stack else -1)
+            stack.append(i)
+        if self.pks:
+            self.trees[self.tree_ids[-1]] = (start, len(self.pks))
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _locate(self, node):
+        """:returns: the index of ``node``"""
+        try:
+            first, last = self.trees[node.tree_id]
+        except KeyError:
+            raise KeyError('Node not in the snapshot: {!r}'.format(node))
+        i = bisect_left(self.lfts, node.lft, first, last)
+        if i == last or self.lfts[i] != node.lft:
+            raise KeyError('Node not in the snapshot: {!r}'.format(node))
+        return i
+
+    def _get_end(self, i):
+        """:returns: the index after the last descendant of the node ``i``"""
+        return bisect_left(self.lfts, self.rgts[i], i + 1,
+                           self.trees[self.tree_ids[i]][1])
+
+    def _get_ancestor_indexes(self, i):
+        indexes = []
+        i = self.parents[i]
+        while i != -1:
+            indexes.append(i)
+            i = self.parents[i]
+        return indexes[::-1]
+
+    def get_depth(self, node):
+        return self.depths[self._locate(node)]
+
+    def get_parent(self, node):
+        """:returns: the pk of the parent, ``None`` for a root"""
+        i = self.parents[self._locate(node)]
+        return self.pks[i] if i != -1 else None
+
+    def get_root(self, node):
+        return self.pks[self.trees[node.tree_id][0]]
+
+    def get_ancestors(self, node):
+        """:returns: the pks of the ancestors, from the root"""
+        return [self.pks[i] for i in
+                self._get_ancestor_indexes(self._locate(node))]
+
+    def get_descendants_range(self, node):
+        """
+        :returns: The ``(start, stop)`` slice of the descendants of the node
+            in ``pks`` and the arrays.
+        """
+        i = self._locate(node)
+        return i + 1, self._get_end(i)
+
+    def get_descendants(self, node):
+        """:returns: the pks of the descendants, in preorder"""
+        start, stop = self.get_descendants_range(node)
+        return self.pks[start:stop]
+
+    def get_descendant_count(self, node):
+        start, stop = self.get_descendants_range(node)
+        return stop - start
+
+    def get_subtree_size(self, node):
+        """:returns: the number of nodes in the branch of the node,
+        including itself"""
+        return self.get_descendant_count(node) + 1
+
+    def get_children(self, node):
+        """:returns: the pks of the children, skipping a whole branch at a
+        time"""
+        i = self._locate(node)
+        end = self._get_end(i)
+        children = []
+        child = i + 1
+        while child < end:
+            children.append(self.pks[child])
+            child = self._get_end(child)
+        return children
+
+    def is_descendant_of(self, node, ancestor):
+        i = self._locate(node)
+        j = self._locate(ancestor)
+        return (self.tree_ids[i] == self.tree_ids[j] and
+                self.lfts[j] < self.lfts[i] and self.rgts[i] < self.rgts[j])
+
+    def get_lowest_common_ancestor(self, node1, node2):
+        """
+        :returns: The pk of the deepest node that is (or is an ancestor of)
+            both nodes, ``None`` if they are in different trees.
+        """
+        i = self._locate(node1)
+        j = self._locate(node2)
+        if self.tree_ids[i] != self.tree_ids[j]:
+            return None
+        if self.lfts[j] < self.lfts[i]:
+            i, j = j, i
+        # the first ancestor (or self) of the leftmost node that closes after
+        # the other one
+        while self.rgts[i] < self.rgts[j]:
+            i = self.parents[i]
+        return self.pks[i]
@@ -1,5 +1,6 @@
 import mongoengine as models
-from mongotree.tree import nested_set_tree
+from mongotree.tree import nested_set_tree, materialized_path_tree, adjacency_list_tree, \
+    closure_table_tree
 
 class RelatedModel(models.DynamicDocument):
     desc = models.StringField()
@@ -7,12 +8,135 @@ class RelatedModel(models.DynamicDocument):
     def __str__(self):
         return self.desc
 
+class CT_TestNode(closure_table_tree):
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
+class CT_TestNodeSomeDep(models.DynamicDocument):
+    node = models.ReferenceField('CT_TestNode', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class CT_TestNodeRelated(closure_table_tree):
+    desc = models.StringField()
+    related = models.ReferenceField('RelatedModel', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class CT_TestNodeInherited(CT_TestNode):
+    extra_desc = models.StringField()
+
+class CT_TestNodeSorted(closure_table_tree):
+    node_order_by = ['val1', 'val2', 'desc']
+    val1 = models.IntField()
+    val2 = models.IntField()
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class AL_TestNode(adjacency_list_tree):
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
+class AL_TestNodeSomeDep(models.DynamicDocument):
+    node = models.ReferenceField('AL_TestNode', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class AL_TestNodeRelated(adjacency_list_tree):
+    desc = models.StringField()
+    related = models.ReferenceField('RelatedModel', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class AL_TestNodeInherited(AL_TestNode):
+    extra_desc = models.StringField()
+
+class AL_TestNodeSorted(adjacency_list_tree):
+    node_order_by = ['val1', 'val2', 'desc']
+    val1 = models.IntField()
+    val2 = models.IntField()
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class MP_TestNode(materialized_path_tree):
+    steplen = 3
+
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
+class MP_TestNodeSomeDep(models.DynamicDocument):
+    node = models.ReferenceField('MP_TestNode', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class MP_TestNodeRelated(materialized_path_tree):
+    steplen = 1
+    alphabet = '0123456789'
+    desc = models.StringField()
+    related = models.ReferenceField('RelatedModel', reverse_delete_rule=models.CASCADE)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+class MP_TestNodeInherited(MP_TestNode):
+    extra_desc = models.StringField()
+
+class MP_TestNodeSorted(materialized_path_tree):
+    steplen = 2
+    node_order_by = ['val1', 'val2', 'desc']
+    alphabet = '0123456789'
+    val1 = models.IntField()
+    val2 = models.IntField()
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
 class NS_TestNode(nested_set_tree):
     desc = models.StringField()
 
     def __str__(self):  # pragma: no cover
         return 'Node {}'.format(self.pk)
 
+class NS_TestNodeGapped(nested_set_tree):
+    nested_set_gap = 8
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
+class NS_TestNodeTreeGapped(nested_set_tree):
+    nested_set_tree_gap = 4
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
+class NS_TestNodeUnique(nested_set_tree):
+    nested_set_unique_lft = True
+    nested_set_numchild = True
+    nested_set_versions = True
+    nested_set_optimistic = True
+    desc = models.StringField()
+
+    def __str__(self):  # pragma: no cover
+        return 'Node {}'.format(self.pk)
+
 class NS_TestNodeSomeDep(models.DynamicDocument):
     node = models.ReferenceField('NS_TestNode', reverse_delete_rule=models.CASCADE)
 
@@ -38,11 +162,13 @@ class NS_TestNodeSorted(nested_set_tree):
     def __str__(self):  # pragma: no cover
         return 'Node %d' % self.pk
 
-BASE_MODELS = NS_TestNode,
-SORTED_MODELS = NS_TestNodeSorted,
-DEP_MODELS = NS_TestNodeSomeDep,
-RELATED_MODELS = NS_TestNodeRelated,
-INHERITED_MODELS = NS_TestNodeInherited,
+BASE_MODELS = CT_TestNode, AL_TestNode, MP_TestNode, NS_TestNode, NS_TestNodeGapped, \
+    NS_TestNodeUnique, NS_TestNodeTreeGapped
+NS_MODELS = NS_TestNode, NS_TestNodeGapped, NS_TestNodeUnique, NS_TestNodeTreeGapped
+SORTED_MODELS = CT_TestNodeSorted, AL_TestNodeSorted, MP_TestNodeSorted, NS_TestNodeSorted
+DEP_MODELS = CT_TestNodeSomeDep, AL_TestNodeSomeDep, MP_TestNodeSomeDep, NS_TestNodeSomeDep
+RELATED_MODELS = CT_TestNodeRelated, AL_TestNodeRelated, MP_TestNodeRelated, NS_TestNodeRelated
+INHERITED_MODELS = CT_TestNodeInherited, AL_TestNodeInherited, MP_TestNodeInherited, NS_TestNodeInherited
 
 def empty_models_tables(models):
     for model in models:
@@ -0,0 +1,238 @@
+import asyncio
+
+from mongoengine import connect, disconnect
+import pytest
+
+from . import models
+from .test_mongotree import BASE_DATA, TestTreeBase
+from mongotree.aio import nested_set_aio
+from mongotree.exceptions import InvalidMoveToDescendant
+
+
+class async_cursor(object):
+    """Async iterator over a (mongomock) cursor, like a motor cursor."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class async_collection(object):
+    """In-process collection with the async API of motor."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return async_cursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            # gives the other tasks a chance to run, like real I/O
+            await asyncio.sleep(0)
+            return method(*args, **kwargs)
+        return call
+
+
+class async_database(object):
+
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return async_collection(self._database[name])
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def collect(nodes):
+    return [node async for node in nodes]
+
+
+NS_MODELS = [models.NS_TestNode, models.NS_TestNodeGapped,
+             models.NS_TestNodeUnique, models.NS_TestNodeTreeGapped]
+
+# operations as (method, node desc, args), run with the synchronous and
+# the async methods on the same tree
+SCENARIOS = {
+    'add_root': [('add_root', None, {'desc': '5'})],
+    'add_child_leaf': [('add_child', '231', {'desc': '2311'})],
+    'add_child_branch': [('add_child', '2', {'desc': '25'})],
+    'add_sibling_left': [('add_sibling', '23', ('left', {'desc': '225'}))],
+    'add_sibling_root': [('add_sibling', '3', ('left', {'desc': '25'})),
+                         ('add_sibling', '1', ('first-sibling', {'desc': '0'}))],
+    'move_branch': [('move', '23', ('41', 'first-child'))],
+    'move_to_root': [('move', '23', ('3', 'left'))],
+    'move_root': [('move', '4', ('22', 'right'))],
+    'move_last': [('move', '21', ('24', 'last-sibling')),
+                  ('move', '1', ('4', 'last-sibling'))],
+    'delete': [('delete', '23', ()), ('delete', '4', ())],
+    'load_bulk': [('load_bulk', '231', BASE_DATA[1:2]),
+                  ('load_bulk', None, BASE_DATA[3:])],
+}
+
+
+class TestNestedSetAio(object):
+
+    def setup_method(self):
+        connect('mongoenginetest', host='mongomock://localhost')
+
+    def teardown_method(self):
+        models.empty_models_tables(NS_MODELS + [models.NS_TestNodeSorted])
+        disconnect()
+
+    def get_tree(self, model, monkeypatch):
+        # the async writes can't claim the trees
+        monkeypatch.setattr(models.NS_TestNodeUnique, 'nested_set_optimistic',
+                            False)
+        database = async_database(model._get_collection().database)
+        return nested_set_aio(model, database)
+
+    def raw(self, model):
+        return [(o.desc, o.tree_id, o.lft, o.rgt, o.depth, o.numchild)
+                for o in model.objects.all()]
+
+    def apply(self, model, tree, operations):
+        get = lambda desc: desc and model.objects.get(desc=desc)
+        for method, desc, args in operations:
+            node = get(desc)
+            if method == 'add_root':
+                run(tree.add_root(**args)) if tree else model.add_root(**args)
+            elif method == 'add_child':
+                run(tree.add_child(node, **args)) if tree else node.add_child(**args)
+            elif method == 'add_sibling':
+                pos, kwargs = args
+                if tree:
+                    run(tree.add_sibling(node, pos, **kwargs))
+                else:
+                    node.add_sibling(pos, **kwargs)
+            elif method == 'move':
+                target, pos = get(args[0]), args[1]
+                run(tree.move(node, target, pos)) if tree else node.move(target, pos)
+            elif method == 'delete':
+                run(tree.delete(node)) if tree else node.delete()
+            elif method == 'load_bulk':
+                if tree:
+                    run(tree.load_bulk(args, node))
+                else:
+                    model.load_bulk(args, node)
+
+    @pytest.mark.parametrize('scenario', sorted(SCENARIOS))
+    @pytest.mark.parametrize('model', NS_MODELS, ids=lambda m: m.__name__)
+    def test_same_as_sync(self, model, scenario, monkeypatch):
+        tree = self.get_tree(model, monkeypatch)
+        model.load_bulk(BASE_DATA)
+        self.apply(model, None, SCENARIOS[scenario])
+        expected = self.raw(model)
+        got = TestTreeBase().got(model)
+
+        model.objects.delete()
+        run(tree.load_bulk(BASE_DATA))
+        self.apply(model, tree, SCENARIOS[scenario])
+        assert self.raw(model) == expected
+        assert TestTreeBase().got(model) == got
+
+    def test_reads(self, monkeypatch):
+        model = models.NS_TestNode
+        tree = self.get_tree(model, monkeypatch)
+        model.load_bulk(BASE_DATA)
+        node = model.objects.get(desc='23')
+        descs = lambda nodes: [o.desc for o in run(collect(nodes))]
+        assert descs(tree.get_tree()) == [o.desc for o in model.get_tree()]
+        assert descs(tree.get_tree(node)) == ['23', '231']
+        assert descs(tree.get_children(model.objects.get(desc='2'))) == \
+            ['21', '22', '23', '24']
+        assert descs(tree.get_descendants(model.objects.get(desc='2'))) == \
+            ['21', '22', '23', '231', '24']
+        assert descs(tree.get_ancestors(model.objects.get(desc='231'))) == \
+            ['2', '23']
+        assert descs(tree.get_root_nodes()) == ['1', '2', '3', '4']
+        assert run(tree.get_parent(node)).desc == '2'
+        assert run(tree.get_last_root_node()).desc == '4'
+        # the nodes work with the synchronous methods too
+        assert [o.desc for o in run(tree.get_parent(node)).get_children()] == \
+            ['21', '22', '23', '24']
+
+    def test_concurrent_reads(self, monkeypatch):
+        model = models.NS_TestNode
+        tree = self.get_tree(model, monkeypatch)
+        model.load_bulk(BASE_DATA)
+        roots = list(model.get_root_nodes())
+
+        async def read_all():
+            return await asyncio.gather(*[collect(tree.get_tree(root))
+                                          for root in roots])
+
+        assert [[o.desc for o in nodes] for nodes in run(read_all())] == [
+            ['1'], ['2', '21', '22', '23', '231', '24'], ['3'], ['4', '41']]
+
+    @pytest.mark.parametrize('model', NS_MODELS, ids=lambda m: m.__name__)
+    def test_concurrent_writes(self, model, monkeypatch):
+        tree = self.get_tree(model, monkeypatch)
+        model.load_bulk(BASE_DATA)
+        get = lambda desc: model.objects.get(desc=desc)
+        nodes = dict((desc, get(desc)) for desc in ('21', '22', '231', '24', '41'))
+
+        async def write_all():
+            # the nodes of the later writes are stale when their turn comes
+            await asyncio.gather(
+                tree.add_child(nodes['21'], desc='211'),
+                tree.add_sibling(nodes['22'], 'left', desc='215'),
+                tree.add_child(nodes['231'], desc='2311'),
+                tree.move(nodes['41'], nodes['24'], 'first-child'),
+                tree.add_child(nodes['24'], desc='242'))
+
+        run(write_all())
+        assert model.find_problems() == ([], [], [], [], [])
+        assert [(o.desc, o.depth) for o in model.get_tree(get('2'))] == [
+            ('2', 1), ('21', 2), ('211', 3), ('215', 2), ('22', 2), ('23', 2),
+            ('231', 3), ('2311', 4), ('24', 2), ('41', 3), ('242', 3)]
+
+    def test_sorted(self, monkeypatch):
+        model = models.NS_TestNodeSorted
+        tree = self.get_tree(model, monkeypatch)
+        root = run(tree.add_root(val1=0, val2=0, desc='aaa'))
+        for val1, val2, desc in [(3, 3, 'zxy'), (1, 4, 'bcd'), (2, 5, 'zxy'),
+                                 (3, 3, 'abc'), (2, 2, 'qwe')]:
+            run(tree.add_child(root, val1=val1, val2=val2, desc=desc))
+        run(tree.add_root(val1=-1, val2=0, desc='first'))
+        assert [(o.desc, o.depth) for o in model.get_tree()] == [
+            ('first', 1), ('aaa', 1), ('bcd', 2), ('qwe', 2), ('zxy', 2),
+            ('abc', 2), ('zxy', 2)]
+        node = model.objects.get(desc='qwe')
+        run(tree.move(node, model.objects.get(desc='first'), 'sorted-child'))
+        assert [(o.desc, o.depth) for o in model.get_tree()][:3] == [
+            ('first', 1), ('qwe', 2), ('aaa', 1)]
+
+    def test_errors(self, monkeypatch):
+        model = models.NS_TestNode
+        tree = self.get_tree(model, monkeypatch)
+        model.load_bulk(BASE_DATA)
+        with pytest.raises(InvalidMoveToDescendant):
+            run(tree.move(model.objects.get(desc='2'),
+                          model.objects.get(desc='231'), 'first-child'))
+        monkeypatch.setattr(model, 'nested_set_optimistic', True)
+        with pytest.raises(ValueError):
+            nested_set_aio(model, async_database(
+                model._get_collection().database))
@@ -0,0 +1,45 @@
+from mongoengine import connect, disconnect
+import pytest
+
+from benchmarks import run
+from benchmarks.models import BACKENDS
+from benchmarks.shapes import SHAPES
+
+OPERATIONS = [
+    'load_bulk', 'dump_bulk', 'get_descendants', 'get_ancestors',
+    'get_descendants_group_count', 'add_child_left', 'add_child_right',
+    'move', 'delete',
+]
+
+
+def count_nodes(data):
+    stack = list(data)
+    count = 0
+    while stack:
+        count += 1
+        stack.extend(stack.pop().get('children', []))
+    return count
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_shape_size(shape):
+    assert count_nodes(SHAPES[shape](250, seed=1)) == 250
+
+
+class TestRun(object):
+
+    def setup_method(self):
+        connect('mongoenginetest', host='mongomock://localhost')
+
+    def teardown_method(self):
+        disconnect()
+
+    @pytest.mark.parametrize('backend', sorted(BACKENDS))
+    def test_run(self, backend):
+        results = list(run(backend, 'random', 30, ops=2, seed=1))
+        assert [result['operation'] for result in results] == OPERATIONS
+        for result in results:
+            assert result['backend'] == backend
+            assert result['size'] == 30
+            assert result['seconds'] >= 0
+        assert BACKENDS[backend].objects.count() == 0
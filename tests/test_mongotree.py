@@ -1,8 +1,18 @@
-from mongoengine import connect, disconnect
+import operator
+import random
+import re
+import time
+from datetime import datetime, timedelta
+
+from mongoengine import connect, disconnect, NotUniqueError
+from bson import ObjectId
+from pymongo.errors import OperationFailure, WriteError
 import pytest
 
 from . import models
-from mongotree.exceptions import InvalidPosition, MissingNodeOrderBy, NodeAlreadySaved, InvalidMoveToDescendant
+from mongotree.tree import nested_set_cache
+from mongotree.exceptions import InvalidPosition, MissingNodeOrderBy, NodeAlreadySaved, InvalidMoveToDescendant, PathOverflow, \
+    TreeWriteConflict
 
 BASE_DATA = [
     {'data': {'desc': '1'}},
@@ -45,6 +55,10 @@ def model(request):
 def sorted_model(request):
     return _prepare_db_test(request)
 
+@pytest.fixture(scope='function', params=models.NS_MODELS, ids=idfn)
+def ns_model(request):
+    return _prepare_db_test(request)
+
 
 @pytest.fixture(scope='function', params=models.RELATED_MODELS, ids=idfn)
 def related_model(request):
@@ -65,7 +79,7 @@ class TestTreeBase(object):
         disconnect()
 
     def got(self, model):
-        if model in [models.NS_TestNode]:
+        if model in [models.NS_TestNode, models.NS_TestNodeUnique]:
             # this slows down nested sets tests quite a bit, but it has the
             # advantage that we'll check the node edges are correct
             d = {}
@@ -77,6 +91,61 @@ class TestTreeBase(object):
                 assert len(got_edges) == max(got_edges)
                 good_edges = list(range(1, len(got_edges) + 1))
                 assert sorted(got_edges) == good_edges
+            if model.nested_set_numchild:
+                # the denormalized numchild must match the numbering
+                nodes = list(model.objects.values_list(
+                    'tree_id', 'lft', 'rgt', 'depth', 'numchild'))
+                for tree_id, lft, rgt, depth, numchild in nodes:
+                    assert numchild == len([
+                        node for node in nodes if node[0] == tree_id and
+                        lft < node[1] < rgt and node[3] == depth + 1])
+        elif model in [models.AL_TestNode]:
+            # every parent must exist, and the siblings have unique orders
+            nodes = list(model.objects.values_list('id', 'parent', 'sib_order'))
+            ids = set(node[0] for node in nodes)
+            orders = set()
+            for pk, parent, sib_order in nodes:
+                assert parent is None or parent in ids
+                assert (parent, sib_order) not in orders
+                orders.add((parent, sib_order))
+        elif model in [models.CT_TestNode]:
+            # the closure rows must match the chains of parents
+            parents = dict(model.objects.values_list('id', 'parent'))
+            expected = set()
+            for pk in parents:
+                ancestor, distance = pk, 0
+                while ancestor is not None:
+                    expected.add((ancestor, pk, distance))
+                    ancestor, distance = parents[ancestor], distance + 1
+            rows = set((row['ancestor'], row['descendant'], row['distance'])
+                       for row in model._get_closure_collection().find())
+            assert rows == expected
+        elif model in [models.MP_TestNode]:
+            # the denormalized depth/numchild must match the paths
+            paths = set(model.objects.values_list('path'))
+            for path, depth, numchild in model.objects.values_list(
+                    'path', 'depth', 'numchild'):
+                assert len(path) == depth * model.steplen
+                assert depth == 1 or path[:-model.steplen] in paths
+                assert numchild == len([
+                    p for p in paths
+                    if len(p) == len(path) + model.steplen and
+                    p.startswith(path)])
+        elif model in [models.NS_TestNodeGapped]:
+            # sparse numbering: the edges must be unique and properly nested
+            stack = []
+            for tree_id, lft, rgt, depth in model.objects.values_list(
+                    'tree_id', 'lft', 'rgt', 'depth'):
+                while stack and (stack[-1][0] != tree_id or
+                                 stack[-1][2] < lft):
+                    stack.pop()
+                assert lft < rgt
+                if stack:
+                    assert rgt < stack[-1][2]
+                else:
+                    assert lft == 1
+                assert depth == len(stack) + 1
+                stack.append((tree_id, lft, rgt))
 
         return [(o.desc, o.get_depth(), o.get_children_count())
                 for o in model.get_tree()]
@@ -167,6 +236,14 @@ class TestClassMethods(TestNonEmptyTree):
         assert sorted(got_descs) == sorted(expected_descs)
         assert self.got(model) == expected
 
+    def test_load_bulk_ids_in_preorder(self, model):
+        node = model.objects.get(desc='2')
+        ids = model.load_bulk(BASE_DATA, node)
+        node = model.objects.get(pk=node.pk)
+        got = [o.pk for o in model.get_tree(node)][-len(ids):]
+        assert got == ids
+        assert node.get_descendant_count() == 5 + len(ids)
+
     def test_get_tree_all(self, model):
         nodes = model.get_tree()
         got = [(o.desc, o.get_depth(), o.get_children_count())
@@ -177,6 +254,18 @@ class TestClassMethods(TestNonEmptyTree):
     def test_dump_bulk_all(self, model):
         assert model.dump_bulk(keep_ids=False) == BASE_DATA
 
+    def test_iter_dump_bulk_all(self, model):
+        got = model.iter_dump_bulk(keep_ids=False)
+        assert not isinstance(got, list)
+        assert list(got) == BASE_DATA
+
+    def test_iter_dump_bulk_keeping_ids(self, model):
+        got = list(model.iter_dump_bulk())
+        assert [branch['id'] for branch in got] == [
+            node.pk for node in model.get_root_nodes()]
+        assert got[1]['children'][2]['children'][0]['id'] == \
+            model.objects.get(desc='231').pk
+
     def test_get_tree_node(self, model):
         node = model.objects.get(desc='231')
         model.load_bulk(BASE_DATA, node)
@@ -237,7 +326,7 @@ class TestClassMethods(TestNonEmptyTree):
     def test_load_and_dump_bulk_with_fk(self, related_model):
         related_model.objects.all().delete()
         related = models.RelatedModel.objects.modify(
-            desc="Test %s" % related_model.__name__, upsert=True)
+            desc="Test %s" % related_model.__name__, upsert=True, new=True)
     
         related_data = [
             {'data': {'desc': '1', 'related': related.pk}},
@@ -257,6 +346,45 @@ class TestClassMethods(TestNonEmptyTree):
         got = related_model.dump_bulk(keep_ids=False)
         assert got == related_data
 
+    def test_load_bulk_with_fk_without_fetching(self, related_model):
+        related = models.RelatedModel(desc='related').save()
+        data = [{'data': {'desc': '1', 'related': related.pk}, 'children': [
+            {'data': {'desc': '11', 'related': str(related.pk)}}]}]
+        related_model.load_bulk(data, fetch_foreign_keys=False)
+        node = related_model.objects.get(desc='11')
+        assert node.related == related
+        # the string id is stored as an ObjectId, so it matches the reference
+        assert related_model.objects(related=related).count() == 2
+        assert related_model.dump_bulk(keep_ids=False)[0]['data'] == \
+            data[0]['data']
+
+    def test_load_bulk_with_missing_fk(self, related_model):
+        data = [{'data': {'desc': '1', 'related': ObjectId()}}]
+        with pytest.raises(models.RelatedModel.DoesNotExist):
+            related_model.load_bulk(data)
+        assert related_model.objects.count() == 0
+
+    def test_get_descendants_group_count_root(self, model):
+        got = [(node.desc, node.descendants_count)
+               for node in model.get_descendants_group_count()]
+        assert got == [('1', 0), ('2', 5), ('3', 0), ('4', 1)]
+        assert all(type(count) == int for desc, count in got)
+
+    def test_get_descendants_group_count_node(self, model):
+        parent = model.objects.get(desc='2')
+        got = [(node.desc, node.descendants_count)
+               for node in model.get_descendants_group_count(parent)]
+        assert got == [('21', 0), ('22', 0), ('23', 1), ('24', 0)]
+
+    def test_get_descendants_group_count_filtered(self, model):
+        got = [(node.desc, node.descendants_count) for node in
+               model.get_descendants_group_count(desc__in=['22', '231', '41'])]
+        assert got == [('1', 0), ('2', 2), ('3', 0), ('4', 1)]
+        parent = model.objects.get(desc='2')
+        got = [(node.desc, node.descendants_count) for node in
+               model.get_descendants_group_count(parent, desc__ne='231')]
+        assert got == [('21', 0), ('22', 0), ('23', 0), ('24', 0)]
+
     def test_get_root_nodes(self, model):
         got = model.get_root_nodes()
         expected = ['1', '2', '3', '4']
@@ -837,6 +965,99 @@ class TestAddSibling(TestNonEmptyTree):
             node_wchildren.add_sibling('last-sibling', instance=existing_node)
 
 
+class TestAddMany(TestNonEmptyTree):
+    def children(self, model, desc):
+        return [(o.desc, o.get_depth())
+                for o in model.objects.get(desc=desc).get_children()]
+
+    def test_add_children_last(self, model):
+        newobjs = model.objects.get(desc='2').add_children(
+            [{'desc': '25'}, {'desc': '26'}])
+        assert [o.desc for o in newobjs] == ['25', '26']
+        assert self.children(model, '2') == [
+            ('21', 2), ('22', 2), ('23', 2), ('24', 2), ('25', 2), ('26', 2)]
+        assert self.got(model)[-3:] == [('3', 1, 0), ('4', 1, 1), ('41', 2, 0)]
+
+    def test_add_children_first(self, model):
+        model.objects.get(desc='2').add_children(
+            [{'desc': '20'}, {'desc': '205'}], 'first-child')
+        assert self.children(model, '2') == [
+            ('20', 2), ('205', 2), ('21', 2), ('22', 2), ('23', 2), ('24', 2)]
+
+    def test_add_children_to_leaf(self, model):
+        model.objects.get(desc='231').add_children(
+            [{'desc': '2311'}, {'desc': '2312'}, {'desc': '2313'}],
+            'first-child')
+        expected = [('1', 1, 0),
+                    ('2', 1, 4),
+                    ('21', 2, 0),
+                    ('22', 2, 0),
+                    ('23', 2, 1),
+                    ('231', 3, 3),
+                    ('2311', 4, 0),
+                    ('2312', 4, 0),
+                    ('2313', 4, 0),
+                    ('24', 2, 0),
+                    ('3', 1, 0),
+                    ('4', 1, 1),
+                    ('41', 2, 0)]
+        assert self.got(model) == expected
+
+    def test_add_children_with_instances(self, model):
+        child = model(desc='2311')
+        newobjs = model.objects.get(desc='231').add_children(
+            [{'instance': child}, {'desc': '2312'}])
+        assert newobjs[0] == child
+        assert self.children(model, '231') == [('2311', 4), ('2312', 4)]
+        with pytest.raises(NodeAlreadySaved):
+            model.objects.get(desc='2').add_children([{'instance': child}])
+
+    def test_add_children_invalid_pos(self, model):
+        with pytest.raises(InvalidPosition):
+            model.objects.get(desc='2').add_children([{'desc': '25'}], 'left')
+        with pytest.raises(MissingNodeOrderBy):
+            model.objects.get(desc='2').add_children([{'desc': '25'}],
+                                                     'sorted-child')
+
+    @pytest.mark.parametrize('pos, expected', [
+        ('first-sibling', ['a', 'b', '21', '22', '23', '24']),
+        ('left', ['21', '22', 'a', 'b', '23', '24']),
+        ('right', ['21', '22', '23', 'a', 'b', '24']),
+        ('last-sibling', ['21', '22', '23', '24', 'a', 'b'])])
+    def test_add_siblings(self, model, pos, expected):
+        newobjs = model.objects.get(desc='23').add_siblings(
+            [{'desc': 'a'}, {'desc': 'b'}], pos)
+        assert [o.desc for o in newobjs] == ['a', 'b']
+        assert self.children(model, '2') == [(desc, 2) for desc in expected]
+        assert self.children(model, '23') == [('231', 3)]
+
+    @pytest.mark.parametrize('pos, expected', [
+        ('first-sibling', ['a', 'b', '1', '2', '3', '4']),
+        ('left', ['1', 'a', 'b', '2', '3', '4']),
+        ('right', ['1', '2', 'a', 'b', '3', '4']),
+        ('last-sibling', ['1', '2', '3', '4', 'a', 'b'])])
+    def test_add_siblings_root(self, model, pos, expected):
+        model.objects.get(desc='2').add_siblings(
+            [{'desc': 'a'}, {'desc': 'b'}], pos)
+        assert [o.desc for o in model.get_root_nodes()] == expected
+        assert self.children(model, '2') == [
+            ('21', 2), ('22', 2), ('23', 2), ('24', 2)]
+        assert self.children(model, '4') == [('41', 2)]
+
+    def test_add_many_nested_sets(self, ns_model):
+        model = ns_model
+        node = model.objects.get(desc='22')
+        node.add_children([{'desc': '22%d' % i} for i in range(20)])
+        node.add_children([{'desc': '220'}] * 3, 'first-child')
+        model.objects.get(desc='225').add_siblings(
+            [{'desc': '2250'}] * 5, 'right')
+        model.objects.get(desc='4').add_siblings([{'desc': '5'}] * 2, 'left')
+        assert model.find_problems() == ([], [], [], [], [])
+        assert model.objects.get(desc='22').get_children_count() == 28
+        assert [o.desc for o in model.get_root_nodes()] == [
+            '1', '2', '3', '5', '5', '4']
+
+
 class TestDelete(TestNonEmptyTree):
 
     # @classmethod
@@ -1461,6 +1682,63 @@ class TestTreeSorted(TestTreeBase):
                     (0, 0, 'av', 2, 0)]
         assert self.got(sorted_model) == expected
 
+    def test_add_many_sorted(self, sorted_model):
+        root = sorted_model.add_root(val1=0, val2=0, desc='a')
+        root.add_children([{'val1': 0, 'val2': 0, 'desc': 'ac'},
+                           {'val1': 0, 'val2': 0, 'desc': 'aa'}])
+        root = sorted_model.objects.get(pk=root.pk)
+        root.add_children([{'val1': 0, 'val2': 0, 'desc': 'av'},
+                           {'val1': 0, 'val2': 0, 'desc': 'ab'},
+                           {'val1': 0, 'val2': 0, 'desc': 'a0'},
+                           {'val1': 0, 'val2': 0, 'desc': 'ab'}])
+        sorted_model.objects.get(desc='ac').add_siblings(
+            [{'val1': 0, 'val2': 0, 'desc': 'ad'}])
+        sorted_model.objects.get(desc='a').add_siblings(
+            [{'val1': 1, 'val2': 0, 'desc': 'b'},
+             {'val1': -1, 'val2': 0, 'desc': 'z'}])
+        expected = [(-1, 0, 'z', 1, 0),
+                    (0, 0, 'a', 1, 7),
+                    (0, 0, 'a0', 2, 0),
+                    (0, 0, 'aa', 2, 0),
+                    (0, 0, 'ab', 2, 0),
+                    (0, 0, 'ab', 2, 0),
+                    (0, 0, 'ac', 2, 0),
+                    (0, 0, 'ad', 2, 0),
+                    (0, 0, 'av', 2, 0),
+                    (1, 0, 'b', 1, 0)]
+        assert self.got(sorted_model) == expected
+
+    def test_move_many_sorted(self):
+        model = models.NS_TestNodeSorted
+        root = model.add_root(val1=0, val2=0, desc='aaa')
+        other = model.add_root(val1=9, val2=9, desc='zzz')
+        for val1, val2, desc in [(3, 3, 'zxy'), (1, 4, 'bcd'), (2, 5, 'zxy'),
+                                 (3, 3, 'abc'), (2, 2, 'qwe')]:
+            other.add_child(val1=val1, val2=val2, desc=desc)
+            other = model.objects.get(pk=other.pk)
+        model.move_many([(node, root, 'sorted-child')
+                         for node in other.get_children()][::-1])
+        assert [(o.desc, o.get_depth()) for o in model.get_tree()] == [
+            ('aaa', 1), ('bcd', 2), ('qwe', 2), ('zxy', 2), ('abc', 2),
+            ('zxy', 2), ('zzz', 1)]
+        assert model.find_problems() == ([], [], [], [], [])
+
+    def test_load_bulk_sorted(self, sorted_model):
+        sorted_model.add_root(val1=2, val2=2, desc='bbb')
+        data = [
+            {'data': {'val1': 3, 'val2': 3, 'desc': 'ccc'}, 'children': [
+                {'data': {'val1': 2, 'val2': 1, 'desc': 'cb'}},
+                {'data': {'val1': 1, 'val2': 1, 'desc': 'ca'}},
+            ]},
+            {'data': {'val1': 1, 'val2': 1, 'desc': 'aaa'}}]
+        sorted_model.load_bulk(data)
+        expected = [(1, 1, 'aaa', 1, 0),
+                    (2, 2, 'bbb', 1, 0),
+                    (3, 3, 'ccc', 1, 2),
+                    (1, 1, 'ca', 2, 0),
+                    (2, 1, 'cb', 2, 0)]
+        assert self.got(sorted_model) == expected
+
     def test_move_sorted(self, sorted_model):
         sorted_model.add_root(val1=3, val2=3, desc='zxy')
         sorted_model.add_root(val1=1, val2=4, desc='bcd')
@@ -1516,6 +1794,896 @@ class TestTreeSorted(TestTreeBase):
                     (2, 1, 'fgh', 1, 0)]
         assert self.got(sorted_model) == expected
 
+class TestMoveMany(TestNonEmptyTree):
+    def test_move_many(self, ns_model):
+        model = ns_model
+        moves = [('231', '4', 'first-child'),
+                 ('21', '24', 'right'),
+                 ('22', '22', 'left'),
+                 ('41', '2', 'last-child'),
+                 ('23', '3', 'left'),
+                 ('24', '41', 'first-sibling'),
+                 ('22', '41', 'first-child'),
+                 ('21', '21', 'last-sibling')]
+        for desc, target, pos in moves:
+            model.objects.get(desc=desc).move(model.objects.get(desc=target),
+                                              pos)
+        expected = self.got(model)
+        raw = [(o.desc, o.tree_id, o.lft, o.rgt, o.depth)
+               for o in model.objects.all()]
+
+        model.objects.delete()
+        model.load_bulk(BASE_DATA)
+        # the nodes aren't reloaded between the moves
+        nodes = dict((node.desc, node) for node in model.objects.all())
+        model.move_many([(nodes[desc], nodes[target], pos)
+                         for desc, target, pos in moves])
+        assert self.got(model) == expected
+        assert model.find_problems() == ([], [], [], [], [])
+        if model.nested_set_gap == 1 and model.nested_set_tree_gap == 1:
+            assert [(o.desc, o.tree_id, o.lft, o.rgt, o.depth)
+                    for o in model.objects.all()] == raw
+        assert (nodes['22'].lft, nodes['22'].depth) == \
+            (model.objects.get(desc='22').lft, 3)
+
+    def test_move_many_random(self, ns_model):
+        model = ns_model
+        descs = [o.desc for o in model.objects.all()]
+        positions = ('first-child', 'last-child', 'first-sibling', 'left',
+                     'right', 'last-sibling')
+        rnd = random.Random(0)
+        for i in range(40):
+            moves = [(rnd.choice(descs), rnd.choice(descs),
+                      rnd.choice(positions))
+                     for j in range(rnd.randint(1, 6))]
+            # a node moved inside itself isn't caught by move
+            moves = [(desc, target, pos) for desc, target, pos in moves
+                     if desc != target or not pos.endswith('-child')]
+            for run_moves in (self.run_moves, self.run_move_many):
+                model.objects.delete()
+                model.load_bulk(BASE_DATA)
+                try:
+                    run_moves(model, moves)
+                except InvalidMoveToDescendant:
+                    pass
+                if run_moves == self.run_moves:
+                    expected = self.got(model)
+            assert self.got(model) == expected, moves
+            assert model.find_problems() == ([], [], [], [], []), moves
+
+    def run_moves(self, model, moves):
+        for desc, target, pos in moves:
+            model.objects.get(desc=desc).move(model.objects.get(desc=target),
+                                              pos)
+
+    def run_move_many(self, model, moves):
+        nodes = dict((node.desc, node) for node in model.objects.all())
+        model.move_many([(nodes[desc], nodes[target], pos)
+                         for desc, target, pos in moves])
+
+    def test_move_many_to_descendant(self):
+        model = models.NS_TestNode
+        nodes = dict((node.desc, node) for node in model.objects.all())
+        with pytest.raises(InvalidMoveToDescendant):
+            model.move_many([(nodes['21'], nodes['24'], 'right'),
+                             (nodes['2'], nodes['231'], 'first-child'),
+                             (nodes['22'], nodes['24'], 'right')])
+        # the moves before the invalid one are written
+        assert [o.desc for o in model.objects.get(desc='2').get_children()] \
+            == ['22', '23', '24', '21']
+
+
+class TestGappedTree(TestNonEmptyTree):
+
+    def edges(self, model):
+        return dict((desc, (lft, rgt)) for desc, lft, rgt in
+                    model.objects.values_list('desc', 'lft', 'rgt'))
+
+    def test_load_bulk_gapped(self):
+        model = models.NS_TestNodeGapped
+        assert self.edges(model)['2'] == (1, 89)
+        assert self.edges(model)['231'] == (49, 57)
+
+    def test_add_child_in_free_interval(self):
+        model = models.NS_TestNodeGapped
+        before = self.edges(model)
+        model.objects.get(desc='22').add_child(desc='221')
+        after = self.edges(model)
+        assert after.pop('221') == (27, 29)
+        assert after == before
+        assert self.got(model) == [('1', 1, 0),
+                                   ('2', 1, 4),
+                                   ('21', 2, 0),
+                                   ('22', 2, 1),
+                                   ('221', 3, 0),
+                                   ('23', 2, 1),
+                                   ('231', 3, 0),
+                                   ('24', 2, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 1),
+                                   ('41', 2, 0)]
+
+    def test_add_sibling_exhausted_interval(self):
+        model = models.NS_TestNodeGapped
+        for i in range(5):
+            model.objects.get(desc='23').add_sibling('left', desc='new')
+        edges = self.edges(model)
+        assert edges['2'][1] > 89
+        assert edges['1'] == (1, 9)
+        assert self.got(model)[:4] == [('1', 1, 0),
+                                       ('2', 1, 9),
+                                       ('21', 2, 0),
+                                       ('22', 2, 0)]
+
+    def test_delete_keeps_free_interval(self):
+        model = models.NS_TestNodeGapped
+        model.objects.get(desc='23').delete()
+        assert self.edges(model)['24'] == (73, 81)
+        model.objects.get(desc='24').add_sibling('left', desc='23')
+        assert self.edges(model)['24'] == (73, 81)
+
+    def test_rebalance(self):
+        model = models.NS_TestNodeGapped
+        model.objects.get(desc='22').add_child(desc='221')
+        model.rebalance()
+        edges = self.edges(model)
+        assert edges['2'] == (1, 105)
+        assert edges['221'] == (33, 41)
+        assert self.got(model)[3:5] == [('22', 2, 1), ('221', 3, 0)]
+
+    def test_rebalance_dense(self):
+        model = models.NS_TestNode
+        model.objects(desc='231').update(inc__rgt=10)
+        model.objects(desc__in=['23', '2']).update(inc__rgt=10)
+        model.objects(desc='24').update(inc__lft=10, inc__rgt=10)
+        model.rebalance(tree_id=2)
+        assert self.got(model) == UNCHANGED
+
+
+class TestTreeGap(TestNonEmptyTree):
+    def test_free_tree_ids(self, monkeypatch):
+        model = models.NS_TestNodeTreeGapped
+        roots = lambda: [(o.desc, o.tree_id) for o in model.get_root_nodes()]
+        assert roots() == [('1', 4), ('2', 8), ('3', 12), ('4', 16)]
+        shifts = []
+        move_tree_right = model._move_tree_right
+        monkeypatch.setattr(model, '_move_tree_right', classmethod(
+            lambda cls, *args: shifts.append(args) or move_tree_right(*args)))
+
+        # the new roots take the free ids between their neighbours
+        model.objects.get(desc='2').add_sibling('left', desc='a')
+        model.objects.get(desc='2').add_sibling('first-sibling', desc='b')
+        model.objects.get(desc='4').move(model.objects.get(desc='1'), 'right')
+        model.add_root(desc='c')
+        model.objects.get(desc='231').move(model.objects.get(desc='3'),
+                                           'left')
+        assert roots() == [('b', 2), ('1', 4), ('4', 5), ('a', 6), ('2', 8),
+                           ('231', 10), ('3', 12), ('c', 16)]
+        assert shifts == []
+        assert model.get_last_root_node().desc == 'c'
+        assert [o.desc for o in model.get_tree(model.objects.get(desc='4'))] \
+            == ['4', '41']
+
+        # and the following trees are shifted once there are none left
+        model.objects.get(desc='4').add_sibling('left', desc='d')
+        assert shifts == [(5, 5)]
+        model.objects.get(desc='b').add_siblings(
+            [{'desc': 'e'}, {'desc': 'f'}], 'right')
+        assert shifts == [(5, 5), (4, 5)]
+        assert roots() == [('b', 2), ('e', 4), ('f', 6), ('1', 9), ('d', 12),
+                           ('4', 15), ('a', 16), ('2', 18), ('231', 20),
+                           ('3', 22), ('c', 26)]
+        assert model.find_problems() == ([], [], [], [], [])
+
+
+class TestNestedSetTree(TestNonEmptyTree):
+
+    def test_compound_indexes(self):
+        indexes = models.NS_TestNode._get_collection().index_information()
+        keys = [tuple(field for field, direction in index['key'])
+                for index in indexes.values()]
+        assert ('tree_id', 'lft') in keys
+        assert ('tree_id', 'rgt') in keys
+        assert ('tree_id', 'depth', 'lft') in keys
+        assert not indexes['tree_id_1_lft_1'].get('unique')
+
+    def test_unique_lft_index(self):
+        model = models.NS_TestNodeUnique
+        indexes = model._get_collection().index_information()
+        assert indexes['tree_id_1_lft_1']['unique']
+        with pytest.raises(NotUniqueError):
+            model(desc='dup', tree_id=2, lft=1, rgt=2, depth=1).save()
+
+    def test_explain_queries(self, monkeypatch):
+        model = models.NS_TestNode
+        index = lambda name: {'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': name}}
+
+        def explain(qset):
+            # plans in the shapes the servers return them (mongomock has no
+            # explain)
+            if qset._ordering[0][1] < 0:
+                plan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+            elif 'tree_id' not in qset._query:
+                # a sharded plan, without the queryPlanner wrapper
+                return {'winningPlan': {'stage': 'SHARD_MERGE', 'inputStages': [
+                    index('lft_1_tree_id_1'), index('lft_1_tree_id_1')]}}
+            else:
+                plan = index('tree_id_1_lft_1')
+            return {'queryPlanner': {'winningPlan': plan}}
+
+        monkeypatch.setattr(model.objects.__class__, 'explain', explain)
+        report = model.explain_queries(model.objects.get(desc='23'))
+        assert sorted(report) == [
+            'get_ancestors', 'get_children', 'get_root_nodes', 'get_tree',
+            'prev_lft', 'prev_rgt', 'shift_lft', 'shift_rgt']
+        assert report['get_tree'] == {'indexes': ['tree_id_1_lft_1'],
+                                      'in_memory_sort': False}
+        assert report['get_root_nodes'] == {
+            'indexes': ['lft_1_tree_id_1', 'lft_1_tree_id_1'],
+            'in_memory_sort': False}
+        assert report['prev_lft'] == {'indexes': [], 'in_memory_sort': True}
+
+    def test_unique_lft_shifts(self):
+        model = models.NS_TestNodeUnique
+        model.objects.get(desc='3').add_sibling('first-sibling', desc='0')
+        model.objects.get(desc='231').add_sibling('left', desc='230')
+        model.objects.get(desc='2').move(model.objects.get(desc='41'),
+                                         'first-child')
+        model.objects.get(desc='22').delete()
+        model.objects(desc='1').update(inc__rgt=10)
+        model.rebalance()
+        assert self.got(model) == [('0', 1, 0),
+                                   ('1', 1, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 1),
+                                   ('41', 2, 1),
+                                   ('2', 3, 3),
+                                   ('21', 4, 0),
+                                   ('23', 4, 2),
+                                   ('230', 5, 0),
+                                   ('231', 5, 0),
+                                   ('24', 4, 0)]
+
+    def pipeline_collection(self, model, monkeypatch, error=None):
+        """Makes the collection of ``model`` run the pipeline updates (which
+        mongomock doesn't have) node by node, or fail with ``error``."""
+        collection = model._get_collection()
+        update_many = collection.update_many
+        operators = {'$add': operator.add, '$gt': operator.gt,
+                     '$gte': operator.ge,
+                     '$cond': lambda test, then, other: then if test else other}
+        calls = []
+
+        def value(expression, doc):
+            if isinstance(expression, str) and expression.startswith('$'):
+                return doc.get(expression[1:])
+            if isinstance(expression, dict):
+                (name, args), = expression.items()
+                return operators[name](*[value(arg, doc) for arg in args])
+            return expression
+
+        def pipeline_update_many(query, update, **kwargs):
+            if not isinstance(update, list):
+                return update_many(query, update, **kwargs)
+            calls.append(update)
+            if error is not None:
+                raise error
+            for doc in list(collection.find(query)):
+                collection.update_one({'_id': doc['_id']}, {'$set': dict(
+                    (field, value(expression, doc))
+                    for field, expression in update[0]['$set'].items())})
+
+        monkeypatch.setattr(collection, 'update_many', pipeline_update_many)
+        monkeypatch.setattr(model, 'use_pipeline_updates', True)
+        return calls
+
+    def test_pipeline_updates(self, monkeypatch):
+        model = models.NS_TestNode
+        calls = self.pipeline_collection(model, monkeypatch)
+        model.objects.get(desc='231').add_child(desc='2311')
+        model.objects.get(desc='2').delete()
+        assert len(calls) == 2
+        assert model.use_pipeline_updates
+        assert self.got(model) == [('1', 1, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 1),
+                                   ('41', 2, 0)]
+
+    def test_pipeline_updates_unsupported(self, monkeypatch):
+        model = models.NS_TestNode
+        calls = self.pipeline_collection(model, monkeypatch, OperationFailure(
+            "BSON field 'update.updates.u' is the wrong type 'array'",
+            code=14))
+        model.objects.get(desc='231').add_child(desc='2311')
+        model.objects.get(desc='231').add_child(desc='2312')
+        # the bulk writes are used from then on
+        assert len(calls) == 1
+        assert not model.use_pipeline_updates
+        assert [o.desc for o in model.objects.get(desc='231').get_children()] \
+            == ['2311', '2312']
+        self.got(model)
+
+    @pytest.mark.parametrize('error', [
+        OperationFailure('Transaction aborted', code=251),
+        WriteError('E11000 duplicate key error', code=11000)],
+        ids=['transaction', 'write'])
+    def test_pipeline_update_errors(self, monkeypatch, error):
+        model = models.NS_TestNode
+        self.pipeline_collection(model, monkeypatch, error)
+        with pytest.raises(type(error)):
+            model.objects.get(desc='231').add_child(desc='2311')
+        # the update isn't done again with a bulk write
+        assert model.use_pipeline_updates
+        assert model.objects.get(desc='2').rgt == 12
+
+    def test_delete_ranges_in_batches(self, monkeypatch):
+        model = models.NS_TestNode
+        monkeypatch.setattr(model, 'nested_set_batch_size', 1)
+        model.objects.filter(desc__in=('1', '22', '23', '231', '41')).delete()
+        assert self.got(model) == [('2', 1, 2),
+                                   ('21', 2, 0),
+                                   ('24', 2, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 0)]
+
+    @pytest.mark.parametrize('model', [models.NS_TestNode,
+                                       models.NS_TestNodeUnique], ids=idfn)
+    def test_delete_close_gaps_of_tree(self, model):
+        model.objects.filter(desc__in=('21', '231', '24', '41')).delete()
+        assert self.got(model) == [('1', 1, 0),
+                                   ('2', 1, 2),
+                                   ('22', 2, 0),
+                                   ('23', 2, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 0)]
+
+    @pytest.mark.parametrize('model', [models.NS_TestNode,
+                                       models.NS_TestNodeGapped], ids=idfn)
+    def test_prefetched_navigation(self, model):
+        nodes = dict((node.desc, node)
+                     for node in model.get_tree(prefetch=True))
+        # the answers can only come from memory
+        model._get_collection().delete_many({})
+        node = nodes['231']
+        assert node.get_parent() is nodes['23']
+        assert node.get_root() is nodes['2']
+        assert node.is_leaf()
+        assert [o.desc for o in nodes['2'].get_children()] == ['21', '22', '23', '24']
+        assert nodes['2'].get_children_count() == 4
+        assert nodes['2'].get_last_child() is nodes['24']
+        assert [o.desc for o in nodes['22'].get_siblings()] == ['21', '22', '23', '24']
+        assert nodes['23'].get_next_sibling() is nodes['24']
+        assert [o.desc for o in nodes['3'].get_siblings()] == ['1', '2', '3', '4']
+        assert nodes['41'].is_sibling_of(nodes['41'])
+
+    def test_prefetched_branch(self):
+        model = models.NS_TestNode
+        nodes = model.get_tree(model.objects.get(desc='23'), prefetch=True)
+        assert [o.desc for o in nodes] == ['23', '231']
+        assert nodes[1].get_parent() is nodes[0]
+        assert nodes[1].get_root().desc == '2'
+        assert [o.desc for o in nodes[0].get_siblings()] == ['21', '22', '23', '24']
+
+    def test_prefetch_invalidated_by_changes(self):
+        model = models.NS_TestNode
+        nodes = model.get_tree(model.objects.get(desc='2'), prefetch=True)
+        nodes[1].add_sibling('right', desc='new')
+        assert [o.desc for o in nodes[1].get_siblings()] == ['21', 'new', '22', '23', '24']
+        nodes = model.get_tree(prefetch=True)
+        nodes[-1].invalidate_prefetch()
+        model.objects.get(desc='41').delete()
+        assert nodes[-2].get_children_count() == 0
+
+    def test_recompute_numchild(self):
+        model = models.NS_TestNodeUnique
+        model.objects.update(numchild=7)
+        model.recompute_numchild(tree_id=2)
+        assert dict(model.objects.values_list('desc', 'numchild')) == {
+            '1': 7, '2': 4, '21': 0, '22': 0, '23': 1, '231': 0, '24': 0,
+            '3': 7, '4': 7, '41': 7}
+        model.recompute_numchild()
+        assert self.got(model) == UNCHANGED
+
+    def test_numchild_reads(self):
+        model = models.NS_TestNodeUnique
+        node = model.objects.get(desc='2')
+        model._get_collection().delete_many({'desc': {'$ne': '2'}})
+        # answered from the node itself
+        assert node.get_children_count() == 4
+        assert not node.is_leaf()
+
+    def test_projected_tree(self):
+        model = models.NS_TestNode
+        parent = model.objects.get(desc='2')
+        model.objects(desc='23').update(set__payload='x' * 100)
+        nodes = list(model.get_tree(parent, only=['desc']))
+        assert [o.desc for o in nodes] == ['2', '21', '22', '23', '231', '24']
+        assert not any(hasattr(o, 'payload') for o in nodes)
+        assert [o.desc for o in nodes[3].get_children(only=['desc'])] == ['231']
+        assert [o.desc for o in nodes[4].get_ancestors(only=['desc'])] == ['2', '23']
+        assert nodes[4].get_parent().payload == 'x' * 100
+
+    def test_tree_refs(self):
+        model = models.NS_TestNode
+        refs = list(model.get_tree_refs(model.objects.get(desc='23')))
+        node = model.objects.get(desc='231')
+        assert [(ref.pk, ref.lft, ref.rgt, ref.depth) for ref in refs][1] == \
+            (node.pk, node.lft, node.rgt, 3)
+        with pytest.raises(AttributeError):
+            refs[0].desc
+
+    @pytest.mark.parametrize('model', [models.NS_TestNode,
+                                       models.NS_TestNodeGapped], ids=idfn)
+    def test_snapshot(self, model):
+        snapshot = model.get_snapshot()
+        nodes = dict((node.desc, node) for node in model.objects.all())
+        pks = dict((node.pk, desc) for desc, node in nodes.items())
+        assert len(snapshot) == 10
+        node = nodes['231']
+        assert snapshot.get_depth(node) == 3
+        assert pks[snapshot.get_parent(node)] == '23'
+        assert pks[snapshot.get_root(node)] == '2'
+        assert [pks[pk] for pk in snapshot.get_ancestors(node)] == ['2', '23']
+        assert snapshot.get_parent(nodes['1']) is None
+        assert [pks[pk] for pk in snapshot.get_children(nodes['2'])] == \
+            ['21', '22', '23', '24']
+        assert [pks[pk] for pk in snapshot.get_descendants(nodes['2'])] == \
+            ['21', '22', '23', '231', '24']
+        assert snapshot.get_descendant_count(nodes['23']) == 1
+        assert snapshot.get_subtree_size(nodes['2']) == 6
+        assert snapshot.is_descendant_of(node, nodes['2'])
+        assert not snapshot.is_descendant_of(node, nodes['22'])
+        assert pks[snapshot.get_lowest_common_ancestor(node, nodes['24'])] == '2'
+        assert pks[snapshot.get_lowest_common_ancestor(nodes['23'], node)] == '23'
+        assert snapshot.get_lowest_common_ancestor(node, nodes['41']) is None
+        with pytest.raises(KeyError):
+            snapshot.get_depth(model(tree_id=2, lft=1000))
+
+    def test_snapshot_of_tree(self):
+        model = models.NS_TestNode
+        snapshot = model.get_snapshot(tree_id=4)
+        refs = list(model.get_tree_refs(model.objects.get(desc='4')))
+        assert snapshot.pks == [ref.pk for ref in refs]
+        assert list(snapshot.parents) == [-1, 0]
+        assert snapshot.get_children(refs[0]) == [refs[1].pk]
+
+    @pytest.mark.parametrize('model, bad_trees', [
+        (models.NS_TestNode, [2, 3, 4]),
+        (models.NS_TestNodeGapped, [3]),
+        (models.NS_TestNodeUnique, [2, 3, 4])],
+        ids=['NS_TestNode', 'NS_TestNodeGapped', 'NS_TestNodeUnique'])
+    def test_find_problems_and_fix_tree(self, model, bad_trees):
+        assert model.find_problems() == ([], [], [], [], [])
+        nodes = dict((node.desc, node) for node in model.objects.all())
+        model.objects(desc='22').update(rgt=nodes['22'].lft)
+        model.objects(desc='231').update(depth=5)
+        model.objects(desc='24').update(rgt=nodes['2'].rgt + 3)
+        # a second top level node in the tree of 3
+        model.objects(desc='41').update(tree_id=3, lft=nodes['3'].rgt + 1,
+                                        rgt=nodes['3'].rgt + 2, depth=1)
+        descs = lambda pks: [model.objects.get(pk=pk).desc for pk in pks]
+        problems = model.find_problems()
+        assert [descs(pks) for pks in problems[:4]] == [
+            ['22'], ['24'], ['231'],
+            ['2', '4'] if model.nested_set_numchild else []]
+        assert problems[4] == bad_trees
+        assert model.find_problems(tree_id=1) == ([], [], [], [], [])
+
+        model.fix_tree()
+        assert model.find_problems() == ([], [], [], [], [])
+        assert [(o.desc, o.tree_id) for o in model.get_root_nodes()] == [
+            ('1', 1), ('2', 2), ('3', 3), ('4', 4), ('41', 5)]
+        assert self.got(model) == [('1', 1, 0),
+                                   ('2', 1, 4),
+                                   ('21', 2, 0),
+                                   ('22', 2, 0),
+                                   ('23', 2, 1),
+                                   ('231', 3, 0),
+                                   ('24', 2, 0),
+                                   ('3', 1, 0),
+                                   ('4', 1, 0),
+                                   ('41', 1, 0)]
+
+    def test_fix_tree_claims_forest_for_new_trees(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        write_optimistic = model._write_optimistic
+        scopes = []
+
+        def spy(get_scope, refresh, write):
+            scopes.append(get_scope())
+            return write_optimistic(get_scope, refresh, write)
+
+        monkeypatch.setattr(model, '_write_optimistic', spy)
+        model.fix_tree(2)
+        model.rebalance(2)
+        # a second top level node in the tree of 3 gets a new tree
+        node = model.objects.get(desc='3')
+        model.objects(desc='41').update(tree_id=3, lft=node.rgt + 1,
+                                        rgt=node.rgt + 2, depth=1)
+        model.fix_tree(3)
+        assert scopes == [{2}, {2}, None]
+        assert [(o.desc, o.tree_id) for o in model.get_root_nodes()] == [
+            ('1', 1), ('2', 2), ('3', 3), ('4', 4), ('41', 5)]
+
+    def test_versions(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        # the optimistic writes increase the counters of the trees they claim
+        monkeypatch.setattr(model, 'nested_set_optimistic', False)
+        model._get_versions_collection().drop()
+        versions = lambda: dict((tree_id, model.get_tree_version(tree_id)['version'])
+                                for tree_id in range(6))
+        assert versions() == {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+        model.objects.get(desc='231').add_child(desc='2311')
+        assert versions() == {0: 1, 1: 0, 2: 1, 3: 0, 4: 0, 5: 0}
+        # the trees from 3 on are renumbered
+        model.objects.get(desc='3').add_sibling('left', desc='25')
+        assert versions() == {0: 3, 1: 0, 2: 1, 3: 2, 4: 1, 5: 1}
+        model.objects.get(desc='41').move(model.objects.get(desc='1'),
+                                          'first-child')
+        assert versions() == {0: 4, 1: 1, 2: 1, 3: 2, 4: 1, 5: 2}
+        model.objects.filter(desc__in=('1', '21')).delete()
+        assert versions() == {0: 5, 1: 2, 2: 2, 3: 2, 4: 1, 5: 2}
+
+    def test_versions_read_without_writing(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        model._get_versions_collection().drop()
+        created = model.get_tree_version(2)
+        assert created['version'] == 0
+
+        def write(*args, **kwargs):
+            raise AssertionError('a known counter is written')
+
+        versions = model._get_versions_collection()
+        monkeypatch.setattr(versions.__class__, 'find_one_and_update', write)
+        assert model.get_tree_version(2) == created
+
+    def test_optimistic_refreshes_stale_nodes(self):
+        model = models.NS_TestNodeUnique
+        node, stale = model.objects.get(desc='22'), model.objects.get(desc='22')
+        node.add_child(desc='221')
+        # the stale copy still looks like a leaf
+        stale.add_child(desc='222')
+        stale.add_sibling('right', desc='225')
+        assert [(o.desc, o.get_depth(), o.get_children_count())
+                for o in model.get_tree(model.objects.get(desc='2'))] == [
+            ('2', 1, 5), ('21', 2, 0), ('22', 2, 2), ('221', 3, 0),
+            ('222', 3, 0), ('225', 2, 0), ('23', 2, 1), ('231', 3, 0),
+            ('24', 2, 0)]
+        self.got(model)
+
+    def test_optimistic_retries_conflicts(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        monkeypatch.setattr(model, 'nested_set_retry_delay', 0)
+        refresh = model._refresh_structure
+        refreshed = []
+
+        def concurrent_refresh(node):
+            # another writer changes the tree between the version read and
+            # the claim of the first attempt
+            if not refreshed:
+                model._get_versions_collection().update_one(
+                    {'_id': node.tree_id}, {'$inc': {'version': 1}})
+            refreshed.append(node.desc)
+            refresh(node)
+
+        monkeypatch.setattr(model, '_refresh_structure', concurrent_refresh)
+        model.objects.get(desc='22').add_sibling('left', desc='215')
+        assert refreshed == ['22', '22']
+        assert [o.desc for o in model.objects.get(desc='2').get_children()] == \
+            ['21', '215', '22', '23', '24']
+
+    def test_optimistic_claims(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        monkeypatch.setattr(model, 'nested_set_retries', 1)
+        monkeypatch.setattr(model, 'nested_set_retry_delay', 0)
+        versions = model._get_versions_collection()
+        model.get_tree_version(2)
+        versions.update_one({'_id': 2}, {'$set': {
+            'writer': ObjectId(), 'claimed': datetime.utcnow()}})
+        with pytest.raises(TreeWriteConflict):
+            model.objects.get(desc='22').add_sibling('left', desc='215')
+        # the forest writes wait for all the trees
+        with pytest.raises(TreeWriteConflict):
+            model.add_root(desc='5')
+        model.objects.get(desc='41').add_child(desc='411')
+        # the claims of crashed writers expire
+        versions.update_one({'_id': 2}, {'$set': {
+            'writer': ObjectId(), 'claimed': datetime(2000, 1, 1)}})
+        model.objects.get(desc='22').add_sibling('left', desc='215')
+        model.add_root(desc='5')
+        # and every claim is released
+        assert versions.count_documents({'writer': {'$exists': True}}) == 0
+        assert versions.count_documents({'claimed': {'$exists': True}}) == 0
+
+    def test_optimistic_claims_renewed(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        monkeypatch.setattr(model, 'nested_set_claim_timeout', 0.3)
+        versions = model._get_versions_collection()
+        model.get_tree_version(2)
+
+        def write():
+            time.sleep(0.5)
+            # a long write keeps its claim past the timeout
+            claim = versions.find_one({'_id': 2})
+            assert claim['claimed'] > datetime.utcnow() - timedelta(seconds=0.3)
+            return 42
+
+        assert model._write_optimistic(lambda: {2}, lambda: None, write) == 42
+        assert 'writer' not in versions.find_one({'_id': 2})
+
+    def test_optimistic_claims_lost(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        versions = model._get_versions_collection()
+        model.get_tree_version(2)
+
+        def write():
+            # the claim expired and another writer took it
+            versions.update_one({'_id': 2}, {'$set': {
+                'writer': ObjectId(), 'claimed': datetime.utcnow()}})
+
+        with pytest.raises(TreeWriteConflict):
+            model._write_optimistic(lambda: {2}, lambda: None, write)
+        versions.update_one({'_id': 2}, {'$unset': {'writer': '', 'claimed': ''}})
+
+    def fake_sessions(self, model, monkeypatch, commit_errors=()):
+        """Replaces the sessions (which mongomock doesn't have) with fakes
+        that record their calls."""
+        calls = []
+        commit_errors = list(commit_errors)
+
+        class session(object):
+            in_transaction = False
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def start_transaction(self):
+                calls.append('start')
+                self.in_transaction = True
+
+            def commit_transaction(self):
+                calls.append('commit')
+                if commit_errors:
+                    raise commit_errors.pop(0)
+                self.in_transaction = False
+
+            def abort_transaction(self):
+                calls.append('abort')
+                self.in_transaction = False
+
+        client = model.objects._collection.database.client
+        monkeypatch.setattr(client, 'start_session', session, raising=False)
+        monkeypatch.setattr(model, 'nested_set_retry_delay', 0)
+        return calls
+
+    def test_transaction_retries(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        transient = OperationFailure('conflict', 112, {
+            'errorLabels': ['TransientTransactionError']})
+        unknown = OperationFailure('timeout', 50, {
+            'errorLabels': ['UnknownTransactionCommitResult']})
+        calls = self.fake_sessions(model, monkeypatch, [unknown])
+        attempts = []
+
+        def batch(value):
+            attempts.append(model._get_collection())
+            if len(attempts) == 1:
+                raise transient
+            return value
+
+        assert model.run_in_transaction(batch, 42) == 42
+        assert calls == ['start', 'abort', 'start', 'commit', 'commit']
+        # the model operations run in the session of the transaction
+        assert attempts[0]._session is not attempts[1]._session
+        assert model._get_collection() is model.objects._collection
+
+        del calls[:], attempts[:]
+        monkeypatch.setattr(model, 'nested_set_transaction_retries', 0)
+        with pytest.raises(OperationFailure):
+            model.run_in_transaction(batch, 42)
+        assert calls == ['start', 'abort']
+
+    def test_transaction_block(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        calls = self.fake_sessions(model, monkeypatch)
+        with model.transaction() as session:
+            with model.transaction() as inner:
+                assert inner is session
+        assert calls == ['start', 'commit']
+        with pytest.raises(ValueError):
+            with model.transaction():
+                raise ValueError
+        assert calls == ['start', 'commit', 'start', 'abort']
+
+    def test_transaction_session_on_every_call(self, monkeypatch):
+        model = models.NS_TestNodeUnique
+        monkeypatch.setattr(model, 'nested_set_optimistic', False)
+        self.fake_sessions(model, monkeypatch)
+        collection = model.objects._collection
+        sessions, depth = [], [0]
+
+        def record(method):
+            # the copies made by with_options share the class, and the calls
+            # mongomock makes internally are skipped
+            def call(self, *args, **kwargs):
+                session = kwargs.pop('session', None)
+                if self.full_name == collection.full_name and not depth[0]:
+                    sessions.append((method.__name__, session))
+                depth[0] += 1
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    depth[0] -= 1
+            return call
+
+        for name in dir(collection.__class__):
+            if re.match(r'(aggregate|bulk_write|count|delete|distinct|find|'
+                        r'insert|remove|replace|save|update)', name):
+                monkeypatch.setattr(collection.__class__, name,
+                                    record(getattr(collection.__class__, name)))
+
+        with model.transaction() as session:
+            node = model.objects.get(desc='22')
+            node.add_child(desc='221')
+            node.move(model.objects.get(desc='24'), 'right')
+            model.objects.get(desc='231').delete()
+            node.desc = 'changed'
+            node.save()
+        assert len(sessions) > 10
+        assert [call for call in sessions if call[1] is not session] == []
+
+    def test_cache(self):
+        model = models.NS_TestNodeUnique
+        cache = nested_set_cache(max_size=3)
+        node = model.objects.get(desc='23')
+        assert [o.desc for o in cache.get_children(model.objects.get(desc='2'))] == \
+            ['21', '22', '23', '24']
+        assert [o.desc for o in cache.get_ancestors(model.objects.get(desc='231'))] == \
+            ['2', '23']
+        assert [o.desc for o in cache.get_tree(model, node)] == ['23', '231']
+        assert (cache.hits, cache.misses) == (0, 3)
+        # the nodes are fresh copies of the cached documents
+        cache.get_tree(model, node)[0].desc = 'changed'
+        assert [o.desc for o in cache.get_tree(model, node)] == ['23', '231']
+        assert (cache.hits, cache.misses) == (2, 3)
+
+        # writes to other trees don't invalidate the tree
+        model.objects.get(desc='41').add_child(desc='411')
+        assert [o.desc for o in cache.get_tree(model, node)] == ['23', '231']
+        assert (cache.hits, cache.misses) == (3, 3)
+        node.add_child(desc='232')
+        node.reload()
+        assert [o.desc for o in cache.get_tree(model, node)] == ['23', '231', '232']
+        assert (cache.hits, cache.misses) == (3, 4)
+
+        assert [o.desc for o in cache.get_root_nodes(model)] == ['1', '2', '3', '4']
+        model.objects.get(desc='1').add_sibling('first-sibling', desc='0')
+        assert [o.desc for o in cache.get_root_nodes(model)] == ['0', '1', '2', '3', '4']
+        assert len(cache) == 3
+        cache.clear()
+        assert (len(cache), cache.hits, cache.misses) == (0, 0, 0)
+
+    def test_cache_needs_versions(self):
+        with pytest.raises(ValueError):
+            nested_set_cache().get_root_nodes(models.NS_TestNode)
+
+    def test_plan_usage(self):
+        plan = {'stage': 'FETCH', 'inputStage': {
+            'stage': 'SORT', 'inputStage': {
+                'stage': 'OR', 'inputStages': [
+                    {'stage': 'IXSCAN', 'indexName': 'tree_id_1_rgt_1'},
+                    {'stage': 'COLLSCAN'}]}}}
+        usage = models.NS_TestNode._get_plan_usage(plan)
+        assert usage == {'indexes': ['tree_id_1_rgt_1'],
+                         'in_memory_sort': True}
+
+
+class TestAdjacencyListTree(TestNonEmptyTree):
+
+    def raw(self, model):
+        return dict((node['desc'], node)
+                    for node in model.objects.as_pymongo())
+
+    def test_move_updates_one_node(self):
+        model = models.AL_TestNode
+        before = self.raw(model)
+        node = model.objects.get(desc='2')
+        model.objects.get(desc='4').move(node, 'last-child')
+        after = self.raw(model)
+        assert after.pop('4') != before.pop('4')
+        assert after == before
+
+    def test_move_left_reorders_siblings(self):
+        model = models.AL_TestNode
+        before = self.raw(model)
+        node = model.objects.get(desc='22')
+        model.objects.get(desc='4').move(node, 'left')
+        after = self.raw(model)
+        assert after['4']['parent'] == before['22']['parent']
+        assert [after[desc]['sib_order'] for desc in ('21', '4', '22', '23')] == [1, 2, 3, 4]
+        assert after['231'] == before['231']
+
+    def test_get_descendants_depth(self):
+        model = models.AL_TestNode
+        node = model.objects.get(desc='2')
+        got = [(o.desc, o.get_depth()) for o in node.get_descendants()]
+        assert got == [('21', 2), ('22', 2), ('23', 2), ('231', 3), ('24', 2)]
+
+
+class TestClosureTableTree(TestNonEmptyTree):
+
+    def test_is_descendant_of_stale_node(self):
+        model = models.CT_TestNode
+        node = model.objects.get(desc='231')
+        model.objects.get(desc='23').move(model.objects.get(desc='4'),
+                                          'last-child')
+        # the instance still has the old parent
+        assert node.is_descendant_of(model.objects.get(desc='4'))
+        assert not node.is_descendant_of(model.objects.get(desc='2'))
+        assert [o.desc for o in node.get_ancestors()] == ['4', '23']
+
+    def test_get_descendants_bounded_depth(self):
+        model = models.CT_TestNode
+        node = model.objects.get(desc='2')
+        got = [(o.desc, o.get_depth()) for o in node.get_descendants(depth=1)]
+        assert got == [('21', 2), ('22', 2), ('23', 2), ('24', 2)]
+
+    def test_delete_removes_rows(self):
+        model = models.CT_TestNode
+        model.objects.get(desc='2').delete()
+        closure = model._get_closure_collection()
+        assert closure.count_documents({}) == 5
+        assert self.got(model) == [('1', 1, 0), ('3', 1, 0), ('4', 1, 1),
+                                   ('41', 2, 0)]
+
+
+class TestMaterializedPathTree(TestNonEmptyTree):
+
+    def paths(self, model):
+        return dict(model.objects.values_list('desc', 'path'))
+
+    def test_load_bulk_paths(self):
+        paths = self.paths(models.MP_TestNode)
+        assert paths['2'] == '002'
+        assert paths['231'] == '002003001'
+        assert paths['41'] == '004001'
+
+    def test_add_sibling_left_shifts_siblings(self):
+        model = models.MP_TestNode
+        model.objects.get(desc='23').add_sibling('left', desc='new')
+        paths = self.paths(model)
+        assert paths['new'] == '002003'
+        assert paths['23'] == '002004'
+        assert paths['231'] == '002004001'
+        assert paths['24'] == '002005'
+        assert paths['22'] == '002002'
+
+    def test_add_sibling_left_in_free_step(self):
+        model = models.MP_TestNode
+        model.objects.get(desc='22').delete()
+        model.objects.get(desc='23').add_sibling('left', desc='new')
+        paths = self.paths(model)
+        assert paths['new'] == '002002'
+        assert paths['23'] == '002003'
+
+    def test_get_tree_uses_path_prefix(self):
+        model = models.MP_TestNode
+        node = model.objects.get(desc='23')
+        assert model.get_tree(node)._query['path'] == re.compile('^002003')
+
+    def test_path_overflow(self):
+        # one step of a 10 digits alphabet
+        root = models.MP_TestNodeRelated.add_root(desc='root')
+        for i in range(9):
+            root.add_child(desc=str(i))
+        with pytest.raises(PathOverflow):
+            root.add_child(desc='overflow')
+
+
 class TestInheritedModels(TestTreeBase):
 
     def setup_method(self):